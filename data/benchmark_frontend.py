@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Compare reading precomputed features from HDF5 with computing log mel
+spectrograms on the fly from waveforms (`models.LogmelFrontEnd`).
+
+    python data/benchmark_frontend.py data/clotho_v2/dev/wav.csv data/clotho_v2/dev/lms.csv --cuda
+"""
+import os
+import sys
+import time
+import argparse
+
+import pandas as pd
+import torch
+
+sys.path.append(os.getcwd())
+import models
+import datasets.caption_dataset as ac_dataset
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('wav_csv', type=str)
+parser.add_argument('feat_csv', type=str)
+parser.add_argument('-sample_rate', type=int, default=32000)
+parser.add_argument('-window_size', type=int, default=1024)
+parser.add_argument('-hop_size', type=int, default=320)
+parser.add_argument('-mel_bins', type=int, default=64)
+parser.add_argument('-fmin', type=int, default=50)
+parser.add_argument('-fmax', type=int, default=14000)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--num_clips', type=int, default=1000)
+parser.add_argument('--cache_size', type=int, default=256,
+                    help="decoded waveforms cached by each worker")
+parser.add_argument('--cuda', default=False, action='store_true')
+args = parser.parse_args()
+
+device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+wav_df = pd.read_csv(args.wav_csv, sep="\t")
+feat_df = pd.read_csv(args.feat_csv, sep="\t")
+audio_ids = list(wav_df["audio_id"][:args.num_clips])
+wav_dict = dict(zip(wav_df["audio_id"], wav_df["file_name"]))
+feat_dict = dict(zip(feat_df["audio_id"], feat_df["hdf5_path"]))
+
+frontend = models.LogmelFrontEnd(
+    sample_rate=args.sample_rate,
+    window_size=args.window_size,
+    hop_size=args.hop_size,
+    mel_bins=args.mel_bins,
+    fmin=args.fmin,
+    fmax=args.fmax).to(device)
+
+
+def run(dataloader, frontend=None, epochs=1):
+    """clips/s of each epoch, features end up on `device`"""
+    throughputs = []
+    for _ in range(epochs):
+        num_clips = 0
+        start = time.time()
+        with torch.no_grad():
+            for batch in dataloader:
+                feats = batch[1].float().to(device, non_blocking=True)
+                if frontend is not None:
+                    feats, _ = frontend(feats, batch[-1])
+                num_clips += feats.size(0)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        throughputs.append(num_clips / (time.time() - start))
+    return throughputs
+
+
+dataloader_args = {
+    "batch_size": args.batch_size,
+    "num_workers": args.num_workers,
+    "collate_fn": ac_dataset.collate_fn([1,]),
+    "pin_memory": device.type == "cuda"
+}
+
+h5_dataset = ac_dataset.CaptionEvalDataset({audio_id: feat_dict[audio_id] for audio_id in audio_ids})
+h5_throughput = run(torch.utils.data.DataLoader(h5_dataset, **dataloader_args))[0]
+print("HDF5 features: {:.1f} clips/s".format(h5_throughput))
+
+# the first epoch decodes every clip, the second one reads the waveform cache
+# (all clips are cached when num_clips <= cache_size * num_workers)
+wav_dataset = ac_dataset.CaptionWaveformEvalDataset(
+    {audio_id: wav_dict[audio_id] for audio_id in audio_ids}, args.sample_rate, args.cache_size)
+wav_dataloader = torch.utils.data.DataLoader(
+    wav_dataset, persistent_workers=args.num_workers > 0, **dataloader_args)
+cold, warm = run(wav_dataloader, frontend, epochs=2)
+print("On the fly, decoding: {:.1f} clips/s ({:.2f}x of HDF5)".format(cold, cold / h5_throughput))
+print("On the fly, cached waveforms: {:.1f} clips/s ({:.2f}x of HDF5)".format(warm, warm / h5_throughput))
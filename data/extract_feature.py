@@ -3,6 +3,9 @@
 # @Date:   2018-03-29
 # @Last Modified by:   xuenan xu
 # @Last Modified time: 2021-07-02
+import os
+import json
+import functools
 import librosa
 import kaldiio
 import numpy as np
@@ -26,6 +29,51 @@ def load_audio(specifier: str, mono=True):
         y, sr = librosa.load(specifier, sr=None, mono=mono)
     return y, sr
 
+@functools.lru_cache(maxsize=None)
+def cached_mel_basis(sr, n_fft, n_mels, fmin, fmax, htk):
+    """Mel filterbank, built once per process for each parameter set"""
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax, htk=htk)
+
+@functools.lru_cache(maxsize=None)
+def cached_window(n_fft, win_length):
+    """Periodic hann window of `win_length` zero-padded to `n_fft` in the center, as in librosa.stft"""
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(win_length) / win_length)
+    lpad = (n_fft - win_length) // 2
+    return np.pad(window, (lpad, n_fft - win_length - lpad), mode="constant")
+
+def melspectrogram(y, sr, n_fft, hop_length, win_length, n_mels, fmin, fmax, htk,
+                   backend="numpy", frame_batch=4096):
+    """Mel power spectrogram [n_mels, frames] (centered, reflect padding, as librosa.feature.melspectrogram).
+    Frames are strided views of the waveform, `frame_batch` frames are transformed by one rfft call
+    and projected onto the mel basis by one matrix product.
+    backend: "numpy" (float64) or "torch" (float32, faster)"""
+    window = cached_window(n_fft, win_length)
+    mel_basis = cached_mel_basis(sr, n_fft, n_mels, fmin, fmax, htk)
+    if backend == "torch":
+        import torch
+        y = torch.as_tensor(y, dtype=torch.float32)
+        y = torch.nn.functional.pad(y[None, None], (n_fft // 2, n_fft // 2), mode="reflect")[0, 0]
+        frames = y.unfold(0, n_fft, hop_length)
+        window = torch.as_tensor(window, dtype=torch.float32)
+        mel_basis = torch.as_tensor(mel_basis, dtype=torch.float32)
+        n_frames = frames.size(0)
+        rfft, matmul = functools.partial(torch.fft.rfft, dim=-1), torch.matmul
+        mel_spectrum = torch.empty(n_mels, n_frames)
+    else:
+        y = np.pad(y, n_fft // 2, mode="reflect")
+        n_frames = 1 + (len(y) - n_fft) // hop_length
+        frames = np.lib.stride_tricks.as_strided(
+            y, shape=(n_frames, n_fft), strides=(y.strides[0] * hop_length, y.strides[0]))
+        rfft, matmul = functools.partial(np.fft.rfft, axis=-1), np.dot
+        mel_spectrum = np.empty((n_mels, n_frames), dtype=np.float32)
+    for start in range(0, n_frames, frame_batch):
+        spectrum = rfft(frames[start: start + frame_batch] * window)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        mel_spectrum[:, start: start + frame_batch] = matmul(mel_basis, power.T)
+    if backend == "torch":
+        mel_spectrum = mel_spectrum.numpy()
+    return mel_spectrum
+
 def extractmfcc(y, fs=44100, **mfcc_params):
     eps = np.spacing(1)
     # Calculate Static Coefficients
@@ -37,12 +85,12 @@ def extractmfcc(y, fs=44100, **mfcc_params):
                                             hop_length=mfcc_params[
                                                 'hop_length'],
                                             ))**2
-    mel_basis = librosa.filters.mel(sr=fs,
-                                    n_fft=mfcc_params['n_fft'],
-                                    n_mels=mfcc_params['n_mels'],
-                                    fmin=mfcc_params['fmin'],
-                                    fmax=mfcc_params['fmax'],
-                                    htk=mfcc_params['htk'])
+    mel_basis = cached_mel_basis(fs,
+                                 mfcc_params['n_fft'],
+                                 mfcc_params['n_mels'],
+                                 mfcc_params['fmin'],
+                                 mfcc_params['fmax'],
+                                 mfcc_params['htk'])
     mel_spectrum = np.dot(mel_basis, power_spectrogram)
     if mfcc_params['no_mfcc']:
         return np.log(mel_spectrum + eps)
@@ -53,6 +101,19 @@ def extractmfcc(y, fs=44100, **mfcc_params):
 
 def extractlms(y, fs=44100, **lms_params):
     eps = np.spacing(1)
+    if lms_params.get('backend', 'librosa') != 'librosa':
+        return np.log(melspectrogram(
+            y,
+            sr=fs,
+            n_fft=lms_params['n_fft'],
+            hop_length=lms_params['hop_length'],
+            win_length=lms_params['win_length'],
+            n_mels=lms_params['n_mels'],
+            fmin=lms_params['fmin'],
+            fmax=lms_params['fmax'],
+            htk=lms_params['htk'],
+            backend=lms_params['backend']
+        ) + eps)
     mel_spectrum = np.log(librosa.feature.melspectrogram(
         y, 
         sr=fs, 
@@ -108,92 +169,131 @@ def extractraw(y, fs, **params):
 
 
 
-parser = argparse.ArgumentParser()
-""" Arguments: wavfilelist, n_mfcc, n_fft, win_length, hop_length, htk, fmin, fmax """
-parser.add_argument('wav_csv', type=str)
-parser.add_argument('feat_h5', type=str)
-parser.add_argument('feat_csv', type=str)
-parser.add_argument('-norm', default='mean')
-parser.add_argument('-nomono', default=False, action="store_true")
-parser.add_argument('--process_num', type=int, default=4)
-subparsers = parser.add_subparsers(help="subcommand help")
-
-stftparser = subparsers.add_parser('stft')
-stftparser.add_argument('-n_fft', type=int, default=2048)
-stftparser.add_argument('-win_length', type=int, default=2048)
-stftparser.add_argument('-hop_length', type=int, default=1024)
-stftparser.add_argument('-center', default=False, action="store_true")
-stftparser.add_argument('-power', default=False, action="store_true")
-stftparser.set_defaults(extractfeat=extractstft)
-
-lmsparser = subparsers.add_parser('lms')
-lmsparser.add_argument('-n_mels', type=int, default=128)
-lmsparser.add_argument('-n_fft', type=int, default=2048)
-lmsparser.add_argument('-win_length', type=int, default=2048)
-lmsparser.add_argument('-hop_length', type=int, default=1024)
-lmsparser.add_argument('-htk', default=False,
-                        action="store_true", help="Uses htk formula for LMS est.")
-lmsparser.add_argument('-fmin', type=int, default=0)
-lmsparser.add_argument('-fmax', type=int, default=8000)
-lmsparser.set_defaults(extractfeat=extractlms)
-
-mfccparser = subparsers.add_parser('mfcc')
-mfccparser.add_argument('-n_mfcc', type=int, default=20)
-mfccparser.add_argument('-n_mels', type=int, default=128)
-mfccparser.add_argument('-n_fft', type=int, default=2048)
-mfccparser.add_argument('-win_length', type=int, default=2048)
-mfccparser.add_argument('-hop_length', type=int, default=1024)
-mfccparser.add_argument('-htk', default=True,
-                        action="store_true", help="Uses htk formula for MFCC est.")
-mfccparser.add_argument('-fmin', type=int, default=12)
-mfccparser.add_argument('-fmax', type=int, default=8000)
-
-rawparser = subparsers.add_parser('raw')
-rawparser.add_argument('-hop_length', type=int, default=1024)
-rawparser.add_argument('-frame_length', type=int, default=2048)
-rawparser.set_defaults(extractfeat=extractraw)
-
-waveletparser = subparsers.add_parser('wave')
-waveletparser.add_argument('-level', default=10, type=int)
-waveletparser.add_argument('-type', default='db4', type=str)
-waveletparser.set_defaults(extractfeat=extractwavelet)
-
-args = parser.parse_args()
-if not hasattr(args, "feat_h5"):
-    args.feat_h5 = Path(args.wav_csv).with_name("feat.h5")
-if not hasattr(args, "feat_csv"):
-    args.feat_csv = Path(args.wav_csv).with_name("feat.csv")
-argsdict = vars(args).copy()
-
-del argsdict["extractfeat"]
-
-def pypeln_wrapper(extractfeat, **params):
-    def extract(row):
-        row = row[1]
-        y, sr = load_audio(row["file_name"], mono=not args.nomono)
-        # feature = extractfeat(row["file_name"], sr, **params)
-        if y.ndim > 1:
-            feat = np.array([extractfeat(i, sr, **params) for i in y])
-        else:
-            feat = extractfeat(y, sr, **params)
-        return row["audio_id"], feat
-    return extract
-
-wav_df = pd.read_csv(args.wav_csv, sep="\t")
-feat_csv_data = []
-with h5py.File(args.feat_h5, "w") as feat_store, tqdm(total=wav_df.shape[0]) as pbar:
-    for audio_id, feat in pr.map(pypeln_wrapper(args.extractfeat, **argsdict),
-                                 wav_df.iterrows(),
-                                 workers=args.process_num,
-                                 maxsize=4):
-        # Transpose feat, nsamples to nsamples, feat
-        feat = np.vstack(feat).transpose()
-        feat_store[audio_id] = feat
-        feat_csv_data.append({
-            "audio_id": audio_id,
-            "hdf5_path": str(Path(args.feat_h5).absolute())
-        })
-        pbar.update()
-
-pd.DataFrame(feat_csv_data).to_csv(args.feat_csv, sep="\t", index=False)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    """ Arguments: wavfilelist, n_mfcc, n_fft, win_length, hop_length, htk, fmin, fmax """
+    parser.add_argument('wav_csv', type=str)
+    parser.add_argument('feat_h5', type=str)
+    parser.add_argument('feat_csv', type=str)
+    parser.add_argument('-norm', default='mean')
+    parser.add_argument('-nomono', default=False, action="store_true")
+    parser.add_argument('--process_num', type=int, default=4)
+    parser.add_argument('--overwrite', default=False, action="store_true",
+                        help="extract all clips again instead of only new or changed clips")
+    subparsers = parser.add_subparsers(help="subcommand help")
+
+    stftparser = subparsers.add_parser('stft')
+    stftparser.add_argument('-n_fft', type=int, default=2048)
+    stftparser.add_argument('-win_length', type=int, default=2048)
+    stftparser.add_argument('-hop_length', type=int, default=1024)
+    stftparser.add_argument('-center', default=False, action="store_true")
+    stftparser.add_argument('-power', default=False, action="store_true")
+    stftparser.set_defaults(extractfeat=extractstft)
+
+    lmsparser = subparsers.add_parser('lms')
+    lmsparser.add_argument('-n_mels', type=int, default=128)
+    lmsparser.add_argument('-n_fft', type=int, default=2048)
+    lmsparser.add_argument('-win_length', type=int, default=2048)
+    lmsparser.add_argument('-hop_length', type=int, default=1024)
+    lmsparser.add_argument('-htk', default=False,
+                            action="store_true", help="Uses htk formula for LMS est.")
+    lmsparser.add_argument('-fmin', type=int, default=0)
+    lmsparser.add_argument('-fmax', type=int, default=8000)
+    lmsparser.add_argument('-backend', type=str, default='librosa', choices=['librosa', 'numpy', 'torch'],
+                            help="numpy / torch: batched rfft and cached mel basis, close to librosa")
+    lmsparser.set_defaults(extractfeat=extractlms)
+
+    mfccparser = subparsers.add_parser('mfcc')
+    mfccparser.add_argument('-n_mfcc', type=int, default=20)
+    mfccparser.add_argument('-n_mels', type=int, default=128)
+    mfccparser.add_argument('-n_fft', type=int, default=2048)
+    mfccparser.add_argument('-win_length', type=int, default=2048)
+    mfccparser.add_argument('-hop_length', type=int, default=1024)
+    mfccparser.add_argument('-htk', default=True,
+                            action="store_true", help="Uses htk formula for MFCC est.")
+    mfccparser.add_argument('-fmin', type=int, default=12)
+    mfccparser.add_argument('-fmax', type=int, default=8000)
+
+    rawparser = subparsers.add_parser('raw')
+    rawparser.add_argument('-hop_length', type=int, default=1024)
+    rawparser.add_argument('-frame_length', type=int, default=2048)
+    rawparser.set_defaults(extractfeat=extractraw)
+
+    waveletparser = subparsers.add_parser('wave')
+    waveletparser.add_argument('-level', default=10, type=int)
+    waveletparser.add_argument('-type', default='db4', type=str)
+    waveletparser.set_defaults(extractfeat=extractwavelet)
+
+    args = parser.parse_args()
+    if not hasattr(args, "feat_h5"):
+        args.feat_h5 = Path(args.wav_csv).with_name("feat.h5")
+    if not hasattr(args, "feat_csv"):
+        args.feat_csv = Path(args.wav_csv).with_name("feat.csv")
+    argsdict = vars(args).copy()
+
+    del argsdict["extractfeat"]
+
+    def pypeln_wrapper(extractfeat, **params):
+        def extract(row):
+            row = row[1]
+            y, sr = load_audio(row["file_name"], mono=not args.nomono)
+            # feature = extractfeat(row["file_name"], sr, **params)
+            if y.ndim > 1:
+                feat = np.array([extractfeat(i, sr, **params) for i in y])
+            else:
+                feat = extractfeat(y, sr, **params)
+            return row["audio_id"], feat
+        return extract
+
+    # parameters that change the extracted features
+    feat_params = {key: value for key, value in argsdict.items()
+                   if key not in ("wav_csv", "feat_h5", "feat_csv", "process_num", "overwrite")}
+    feat_params["extractfeat"] = args.extractfeat.__name__
+
+    def fingerprint(file_name):
+        """Identifies the audio file and the extraction parameters, a clip is extracted again
+        when its fingerprint changes"""
+        stat = {"size": None, "mtime": None}
+        if not file_name.endswith("|") and os.path.exists(file_name):
+            file_stat = os.stat(file_name)
+            stat = {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns}
+        return json.dumps({"file_name": file_name, **stat, "params": feat_params}, sort_keys=True)
+
+    wav_df = pd.read_csv(args.wav_csv, sep="\t")
+    audio_id2fingerprint = {row["audio_id"]: fingerprint(row["file_name"])
+                            for _, row in wav_df.iterrows()}
+    mode = "w" if args.overwrite else "a"
+    with h5py.File(args.feat_h5, mode) as feat_store:
+        # features of clips removed from wav_csv are dropped, unchanged clips are kept,
+        # clips without a fingerprint (e.g. interrupted writing) are extracted again
+        for audio_id in list(feat_store.keys()):
+            if audio_id not in audio_id2fingerprint:
+                del feat_store[audio_id]
+        todo_df = wav_df[[feat_store.get(audio_id) is None or
+                          feat_store[audio_id].attrs.get("fingerprint") != audio_id2fingerprint[audio_id]
+                          for audio_id in wav_df["audio_id"]]]
+        print("{} of {} clips to extract".format(todo_df.shape[0], wav_df.shape[0]))
+        with tqdm(total=todo_df.shape[0]) as pbar:
+            for audio_id, feat in pr.map(pypeln_wrapper(args.extractfeat, **argsdict),
+                                         todo_df.iterrows(),
+                                         workers=args.process_num,
+                                         maxsize=4):
+                # Transpose feat, nsamples to nsamples, feat
+                feat = np.vstack(feat).transpose()
+                if audio_id in feat_store:
+                    del feat_store[audio_id]
+                feat_store[audio_id] = feat
+                feat_store[audio_id].attrs["fingerprint"] = audio_id2fingerprint[audio_id]
+                pbar.update()
+                # flush regularly so that an interrupted run resumes from the flushed clips
+                if pbar.n % 100 == 0:
+                    feat_store.flush()
+        feat_csv_data = [{
+                "audio_id": audio_id,
+                "hdf5_path": str(Path(args.feat_h5).absolute())
+            } for audio_id in wav_df["audio_id"] if audio_id in feat_store]
 
+    # write to a temporary file first so that an existing feat_csv is never left half-written
+    tmp_feat_csv = "{}.{}.tmp".format(args.feat_csv, os.getpid())
+    pd.DataFrame(feat_csv_data).to_csv(tmp_feat_csv, sep="\t", index=False)
+    os.replace(tmp_feat_csv, args.feat_csv)
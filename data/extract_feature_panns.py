@@ -4,6 +4,8 @@
 # @Last Modified by:   xuenan xu
 # @Last Modified time: 2021-07-02
 import sys
+import json
+import time
 import kaldiio
 import librosa
 import numpy as np
@@ -65,10 +67,14 @@ class ConvBlock(nn.Module):
         return x
 
 class Cnn10(nn.Module):
+
+    time_downsample = 16
+
     def __init__(self, sample_rate, window_size, hop_size, mel_bins, fmin, 
         fmax, classes_num):
         
         super(Cnn10, self).__init__()
+        self.hop_size = hop_size
 
         window = 'hann'
         center = True
@@ -107,11 +113,19 @@ class Cnn10(nn.Module):
         # init_bn(self.bn0)
         # init_layer(self.fc1)
         # init_layer(self.fc_audioset)
+
+    def output_lengths(self, lengths, max_length):
+        """Number of output frames (`attn_feat`) of each input, the spectrogram is centered"""
+        if lengths is None:
+            return None
+        frames = lengths // self.hop_size + 1
+        return torch.clamp(frames // self.time_downsample, 1, max_length)
  
     # def forward(self, input, mixup_lambda=None):
-    def forward(self, input):
+    def forward(self, input, lengths=None):
         """
-        Input: (batch_size, data_length)"""
+        Input: (batch_size, data_length)
+        lengths: (batch_size,) number of valid samples of zero-padded input, None if not padded"""
 
         x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
         x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
@@ -138,8 +152,7 @@ class Cnn10(nn.Module):
         x = torch.mean(x, dim=3)
         attn_feats = x.transpose(1, 2)
         
-        (x1, _) = torch.max(x, dim=2)
-        x2 = torch.mean(x, dim=2)
+        x1, x2 = temporal_pooling(x, self.output_lengths(lengths, x.size(2)))
         x = x1 + x2
         x = F.dropout(x, p=0.5, training=self.training)
         x = F.relu_(self.fc1(x))
@@ -156,10 +169,14 @@ class Cnn10(nn.Module):
 
 
 class Cnn14(nn.Module):
+
+    time_downsample = 32
+
     def __init__(self, sample_rate, window_size, hop_size, mel_bins, fmin, 
         fmax, classes_num):
         
         super(Cnn14, self).__init__()
+        self.hop_size = hop_size
 
         window = 'hann'
         center = True
@@ -200,10 +217,18 @@ class Cnn14(nn.Module):
         # init_bn(self.bn0)
         # init_layer(self.fc1)
         # init_layer(self.fc_audioset)
+
+    def output_lengths(self, lengths, max_length):
+        """Number of output frames (`attn_feat`) of each input, the spectrogram is centered"""
+        if lengths is None:
+            return None
+        frames = lengths // self.hop_size + 1
+        return torch.clamp(frames // self.time_downsample, 1, max_length)
  
-    def forward(self, input):
+    def forward(self, input, lengths=None):
         """
-        Input: (batch_size, data_length)"""
+        Input: (batch_size, data_length)
+        lengths: (batch_size,) number of valid samples of zero-padded input, None if not padded"""
 
         x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
         x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
@@ -234,8 +259,7 @@ class Cnn14(nn.Module):
         x = torch.mean(x, dim=3)
         attn_feats = x.transpose(1, 2)
         
-        (x1, _) = torch.max(x, dim=2)
-        x2 = torch.mean(x, dim=2)
+        x1, x2 = temporal_pooling(x, self.output_lengths(lengths, x.size(2)))
         x = x1 + x2
         x = F.dropout(x, p=0.5, training=self.training)
         x = F.relu_(self.fc1(x))
@@ -250,6 +274,19 @@ class Cnn14(nn.Module):
 
         return output_dict
 
+def temporal_pooling(x, lengths=None):
+    """Max and mean of `x` (batch_size, channels, time_steps) over valid time steps"""
+    if lengths is None:
+        (x1, _) = torch.max(x, dim=2)
+        x2 = torch.mean(x, dim=2)
+        return x1, x2
+    mask = torch.arange(x.size(2), device=x.device)[None, :] < lengths[:, None].to(x.device)
+    mask = mask.unsqueeze(1)
+    (x1, _) = torch.max(x.masked_fill(~mask, float("-inf")), dim=2)
+    x2 = (x * mask).sum(dim=2) / lengths[:, None].to(x)
+    return x1, x2
+
+
 def load_audio(specifier: str, sr=None):
     if specifier.endswith("|"):
         fd = kaldiio.utils.open_like_kaldi(specifier, "rb")
@@ -274,6 +311,18 @@ parser.add_argument('-fmax', type=int, default=14000)
 parser.add_argument('--cuda', default=False, action='store_true')
 parser.add_argument('--model_type', type=str, default='Cnn10')
 parser.add_argument('--process_num', type=int, default=4)
+parser.add_argument('--batch_size', type=int, default=16,
+                    help="number of clips in a forward pass, clips are zero-padded so the last frames "
+                         "of shorter clips differ slightly from extracting them one by one (batch_size 1)")
+parser.add_argument('--bucket_size', type=int, default=8,
+                    help="decoded clips are buffered for `bucket_size` batches and sorted by length")
+parser.add_argument('--compression', type=str, default="gzip",
+                    choices=["gzip", "lzf", "none"])
+parser.add_argument('--overwrite', default=False, action='store_true',
+                    help="extract all clips again instead of resuming from existing outputs")
+parser.add_argument('--flush_interval', type=int, default=10,
+                    help="stores are flushed every `flush_interval` batches so that an interrupted run "
+                         "resumes from the flushed clips")
 parser.add_argument('--fc_feat_h5', type=str)
 parser.add_argument('--fc_feat_csv', type=str)
 parser.add_argument('--attn_feat_h5', type=str)
@@ -308,43 +357,105 @@ checkpoint = torch.load(args.pretrained_model, map_location='cpu')
 model.load_state_dict(checkpoint['model'])
 model = model.to(device)
 model.eval()
+compression = None if args.compression == "none" else args.compression
 
-def extract_feature(row):
+def load_waveform(row):
+    # run in background processes, only decoding is done here
     row = row[1]
     waveform, _ = load_audio(row["file_name"], sr=args.sample_rate)
-    waveform = waveform[None, :]
-    waveform = torch.as_tensor(waveform).float().to(device)
-    output_dict = model(waveform)
-    fc_feat = output_dict["fc_feat"].cpu().numpy()[0]
-    attn_feat = output_dict["attn_feat"].cpu().numpy()[0]
-    return row["audio_id"], fc_feat, attn_feat
+    return row["audio_id"], waveform.astype(np.float32)
+
+def extract_feature(batch):
+    # batch: [(audio_id, waveform), ...], clips are zero-padded to the longest one
+    lengths = torch.as_tensor([len(waveform) for _, waveform in batch])
+    waveforms = torch.zeros(len(batch), int(lengths.max()))
+    for idx, (_, waveform) in enumerate(batch):
+        waveforms[idx, :len(waveform)] = torch.as_tensor(waveform)
+    output_dict = model(waveforms.to(device), lengths.to(device))
+    attn_lens = model.output_lengths(lengths, output_dict["attn_feat"].size(1))
+    fc_feats = output_dict["fc_feat"].cpu().numpy()
+    attn_feats = output_dict["attn_feat"].cpu().numpy()
+    for idx, (audio_id, _) in enumerate(batch):
+        yield audio_id, fc_feats[idx], attn_feats[idx, :int(attn_lens[idx])]
+
+def length_batches(clips):
+    # group streamed clips of similar lengths into batches
+    buffer = []
+    for clip in clips:
+        buffer.append(clip)
+        if len(buffer) == args.batch_size * args.bucket_size:
+            buffer.sort(key=lambda x: len(x[1]))
+            for start in range(0, len(buffer), args.batch_size):
+                yield buffer[start: start + args.batch_size]
+            buffer = []
+    buffer.sort(key=lambda x: len(x[1]))
+    for start in range(0, len(buffer), args.batch_size):
+        yield buffer[start: start + args.batch_size]
+
+def write_feature(store, audio_id, feature):
+    if audio_id in store:
+        del store[audio_id]
+    store.create_dataset(audio_id, data=feature, chunks=True if compression else None,
+                         compression=compression)
+
+# the model and the front-end parameters that the features depend on, stored as attributes of the stores
+feat_params = json.dumps({
+    "model_type": args.model_type,
+    "pretrained_model": Path(args.pretrained_model).name,
+    "sample_rate": args.sample_rate,
+    "window_size": args.window_size,
+    "hop_size": args.hop_size,
+    "mel_bins": args.mel_bins,
+    "fmin": args.fmin,
+    "fmax": args.fmax,
+}, sort_keys=True)
+
+def check_feat_params(store):
+    # clips extracted with other parameters are not mixed into the store when resuming
+    if len(store) > 0 and store.attrs.get("feat_params") != feat_params:
+        raise ValueError("{} was extracted with other parameters ({}), use --overwrite to extract "
+                         "all clips again".format(store.filename, store.attrs.get("feat_params")))
+    store.attrs["feat_params"] = feat_params
 
 wav_df = pd.read_csv(args.wav_csv, sep="\t")
-fc_feat_csv_data = []
-attn_feat_csv_data = []
+mode = "w" if args.overwrite else "a"
 
-with h5py.File(args.fc_feat_h5, "w") as fc_store, \
-    h5py.File(args.attn_feat_h5, "w") as attn_store, \
-    tqdm(total=wav_df.shape[0]) as pbar, \
+with h5py.File(args.fc_feat_h5, mode) as fc_store, \
+    h5py.File(args.attn_feat_h5, mode) as attn_store, \
     torch.no_grad():
-    # for audio_id, fc_feat, attn_feat in pr.map(extract_feature,
-                                               # wav_df.iterrows(),
-                                               # workers=args.process_num,
-                                               # maxsize=4):
-    for row in wav_df.iterrows():
-        audio_id, fc_feat, attn_feat = extract_feature(row)
-        fc_store[audio_id] = fc_feat
-        attn_store[audio_id] = attn_feat
-        fc_feat_csv_data.append({
+    check_feat_params(fc_store)
+    check_feat_params(attn_store)
+    # resume: clips written to both stores are skipped
+    done = set(fc_store.keys()) & set(attn_store.keys())
+    todo_df = wav_df[~wav_df["audio_id"].isin(done)]
+    if len(done) > 0:
+        print("Resuming: {} of {} clips are already extracted".format(
+            wav_df.shape[0] - todo_df.shape[0], wav_df.shape[0]))
+    start_time = time.time()
+    with tqdm(total=todo_df.shape[0], unit="clip") as pbar:
+        clips = pr.map(load_waveform,
+                       todo_df.iterrows(),
+                       workers=args.process_num,
+                       maxsize=args.batch_size * args.bucket_size)
+        for batch_idx, batch in enumerate(length_batches(clips), 1):
+            for audio_id, fc_feat, attn_feat in extract_feature(batch):
+                write_feature(fc_store, audio_id, fc_feat)
+                write_feature(attn_store, audio_id, attn_feat)
+            pbar.update(len(batch))
+            if batch_idx % args.flush_interval == 0:
+                fc_store.flush()
+                attn_store.flush()
+    elapsed = time.time() - start_time
+    print("Extracted {} clips in {:.1f}s ({:.2f} clips/s)".format(
+        todo_df.shape[0], elapsed, todo_df.shape[0] / max(elapsed, 1e-8)))
+    fc_feat_csv_data = [{
             "audio_id": audio_id,
             "hdf5_path": str(Path(args.fc_feat_h5).absolute())
-        })
-        attn_feat_csv_data.append({
+        } for audio_id in wav_df["audio_id"] if audio_id in fc_store]
+    attn_feat_csv_data = [{
             "audio_id": audio_id,
             "hdf5_path": str(Path(args.attn_feat_h5).absolute())
-        })
-        pbar.update()
+        } for audio_id in wav_df["audio_id"] if audio_id in attn_store]
 
 pd.DataFrame(fc_feat_csv_data).to_csv(args.fc_feat_csv, sep="\t", index=False)
 pd.DataFrame(attn_feat_csv_data).to_csv(args.attn_feat_csv, sep="\t", index=False)
-
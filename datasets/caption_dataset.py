@@ -1,7 +1,11 @@
 import math
 import gc
+import hashlib
+import json
+import os
 import random
 import sys
+from collections import OrderedDict
 from typing import List, Optional, Dict, Tuple
 from pathlib import Path
 
@@ -9,24 +13,256 @@ import numpy as np
 import pandas as pd
 import torch
 import h5py
+from tqdm import tqdm
 
 sys.path.append(str(Path.cwd()))
 from utils.build_vocab import Vocabulary
 
+class H5HandlePool(object):
+
+    def __init__(self, max_open: int = 16):
+        """Pool of read-only HDF5 handles keyed by file path, least recently used
+        handles are closed when more than `max_open` files are opened.
+        Handles are opened lazily and the pool is reset in a forked process
+        (e.g. a DataLoader worker), so each worker opens its own handles.
+
+        Args:
+            max_open (int, optional): Defaults to 16. Maximum number of open handles
+        """
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+
+    def get(self, h5_path: str):
+        if self._pid != os.getpid():
+            # handles inherited from the parent process must not be reused
+            self._handles = OrderedDict()
+            self._pid = os.getpid()
+            self.hits, self.misses = 0, 0
+        if h5_path in self._handles:
+            self.hits += 1
+            self._handles.move_to_end(h5_path)
+        else:
+            self.misses += 1
+            self._handles[h5_path] = h5py.File(h5_path, "r")
+            if len(self._handles) > self.max_open:
+                _, handle = self._handles.popitem(last=False)
+                handle.close()
+        return self._handles[h5_path]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "open": len(self._handles)}
+
+    def close(self):
+        if self._pid == os.getpid():
+            for handle in self._handles.values():
+                try:
+                    handle.close()
+                except:
+                    pass
+        self._handles = OrderedDict()
+
+    def __getstate__(self):
+        # never pickle open handles (e.g. DataLoader workers started by spawn)
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        return state
+
+
+class FeatureStore(object):
+
+    def __init__(self,
+                 h5file_dict: Dict,
+                 audio_ids: Optional[List] = None,
+                 dtype: str = "float32"):
+        """Preload features into one contiguous arena in shared memory, indexed by
+        (<start>, <end>) frame offsets, so DataLoader workers read them without copies.
+
+        Args:
+            h5file_dict (Dict): Dictionary (<audio_id>: <hdf5_path>)
+            audio_ids (List, optional): Defaults to None. Audio ids to load, all by default
+            dtype (str, optional): Defaults to "float32". Storage type, "float16" halves the memory
+        """
+        if audio_ids is None:
+            audio_ids = h5file_dict.keys()
+        audio_ids = list(dict.fromkeys(audio_ids))
+        pool = H5HandlePool()
+        self._offsets = {}
+        total_len = 0
+        for audio_id in audio_ids:
+            shape = pool.get(h5file_dict[audio_id])[audio_id].shape
+            self._offsets[audio_id] = (total_len, total_len + shape[0])
+            total_len += shape[0]
+        self._arena = torch.empty((total_len,) + shape[1:], dtype=getattr(torch, dtype))
+        for audio_id in tqdm(audio_ids, leave=False, ascii=True):
+            start, end = self._offsets[audio_id]
+            feature = pool.get(h5file_dict[audio_id])[audio_id][()]
+            self._arena[start: end] = torch.as_tensor(feature)
+        pool.close()
+        self._arena.share_memory_()
+
+    def __contains__(self, audio_id):
+        return audio_id in self._offsets
+
+    def __getitem__(self, audio_id):
+        start, end = self._offsets[audio_id]
+        return self._arena[start: end].numpy()
+
+    def length(self, audio_id):
+        start, end = self._offsets[audio_id]
+        return end - start
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def nbytes(self):
+        return self._arena.numel() * self._arena.element_size()
+
+
+class CaptionTokenIds(object):
+
+    def __init__(self,
+                 caption_info: List,
+                 vocabulary: Vocabulary,
+                 caption_file: Optional[str] = None):
+        """Word indices of all captions (with <start> and <end>) packed into one int32 array,
+        caption (audio_idx, cap_idx) is `tokens[offsets[i]: offsets[i + 1]]` where
+        `i = audio_offsets[audio_idx] + cap_idx`.
+        When `caption_file` is given, the arrays are cached to `<caption_file>.tokens.npz`
+        together with a hash of the caption file and the vocabulary, and are rebuilt when
+        either of them changes.
+
+        Args:
+            caption_info (List): "audios" of the caption json
+            vocabulary (Vocabulary): Preloaded vocabulary object
+            caption_file (str, optional): Defaults to None. Path of the caption json, no cache when None
+        """
+        cache_file = None
+        if caption_file is not None:
+            cache_file = str(caption_file) + ".tokens.npz"
+            digest = self.compute_hash(caption_file, vocabulary)
+            if os.path.exists(cache_file):
+                cache = np.load(cache_file)
+                if str(cache["hash"]) == digest and \
+                        len(cache["audio_offsets"]) == len(caption_info) + 1:
+                    self.tokens = cache["tokens"]
+                    self.offsets = cache["offsets"]
+                    self.audio_offsets = cache["audio_offsets"]
+                    return
+        self._build(caption_info, vocabulary)
+        if cache_file is not None:
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            try:
+                with open(tmp_file, "wb") as writer:
+                    np.savez(writer, tokens=self.tokens, offsets=self.offsets,
+                             audio_offsets=self.audio_offsets, hash=np.array(digest))
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                # read-only data directory, the token ids are only kept in memory
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    def _build(self, caption_info, vocabulary):
+        start, end = vocabulary("<start>"), vocabulary("<end>")
+        tokens = []
+        offsets = [0]
+        audio_offsets = [0]
+        for audio_item in caption_info:
+            for caption in audio_item["captions"]:
+                tokens.append(start)
+                tokens.extend(vocabulary(token) for token in caption["tokens"].split())
+                tokens.append(end)
+                offsets.append(len(tokens))
+            audio_offsets.append(len(offsets) - 1)
+        self.tokens = np.array(tokens, dtype=np.int32)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.audio_offsets = np.array(audio_offsets, dtype=np.int64)
+
+    @staticmethod
+    def compute_hash(caption_file, vocabulary):
+        hasher = hashlib.sha1()
+        with open(caption_file, "rb") as reader:
+            for chunk in iter(lambda: reader.read(1 << 20), b""):
+                hasher.update(chunk)
+        word2idx = sorted(vocabulary.word2idx.items(), key=lambda x: x[1])
+        hasher.update(json.dumps(word2idx).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def _index(self, audio_idx, cap_idx):
+        return self.audio_offsets[audio_idx] + cap_idx
+
+    def __getitem__(self, index: Tuple):
+        i = self._index(*index)
+        return self.tokens[self.offsets[i]: self.offsets[i + 1]]
+
+    def length(self, audio_idx, cap_idx):
+        i = self._index(audio_idx, cap_idx)
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class WaveformCache(object):
+
+    def __init__(self, sample_rate: int, max_size: int = 256):
+        """LRU cache of decoded (and resampled) waveforms keyed by file path, each
+        DataLoader worker keeps its own cache of at most `max_size` clips.
+
+        Args:
+            sample_rate (int): Sampling rate to decode the audio with
+            max_size (int, optional): Defaults to 256. Maximum number of cached waveforms
+        """
+        self.sample_rate = sample_rate
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._waveforms = OrderedDict()
+
+    def get(self, audio_path: str):
+        if audio_path in self._waveforms:
+            self.hits += 1
+            self._waveforms.move_to_end(audio_path)
+        else:
+            import librosa
+            self.misses += 1
+            waveform, _ = librosa.load(audio_path, sr=self.sample_rate)
+            self._waveforms[audio_path] = waveform.astype(np.float32)
+            if len(self._waveforms) > self.max_size:
+                self._waveforms.popitem(last=False)
+        return self._waveforms[audio_path]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self._waveforms)}
+
+    def __getstate__(self):
+        # decoded waveforms are not sent to DataLoader workers
+        state = self.__dict__.copy()
+        state["_waveforms"] = OrderedDict()
+        return state
+
+
 class CaptionEvalDataset(torch.utils.data.Dataset):
     
     def __init__(self,
                  h5file_dict: Dict,
-                 transform: Optional[List] = None):
+                 transform: Optional[List] = None,
+                 max_open_files: int = 16,
+                 feature_store: Optional[FeatureStore] = None):
         """audio captioning dataset object for inference and evaluation
 
         Args:
             h5file_dict (Dict): Dictionary (<audio_id>: <hdf5_path>)
             transform (List, optional): Defaults to None. Transformation onto the data (List of function)
+            max_open_files (int, optional): Defaults to 16. Maximum number of HDF5 files kept open by each worker
+            feature_store (FeatureStore, optional): Defaults to None. Preloaded features, read before HDF5
         """
         self._h5file_dict = h5file_dict
         self._audio_ids = list(self._h5file_dict.keys())
-        self._dataset_cache = {}
+        self._h5_pool = H5HandlePool(max_open_files)
+        self._feature_store = feature_store
         self._transform = transform
         first_audio_id = next(iter(self._h5file_dict.keys()))
         with h5py.File(self._h5file_dict[first_audio_id], 'r') as store:
@@ -34,29 +270,49 @@ class CaptionEvalDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         audio_id = self._audio_ids[index]
-        h5_path = self._h5file_dict[audio_id]
-        if not audio_id in self._dataset_cache:
-            self._dataset_cache[audio_id] = h5py.File(h5_path, "r")
-        feature = self._dataset_cache[audio_id][audio_id][()]
+        feature = self._load_feature(audio_id)
         if self._transform:
             for transform in self._transform:
                 feature = transform(feature)
         return audio_id, torch.as_tensor(feature)
 
+    def _load_feature(self, audio_id):
+        if self._feature_store is not None and audio_id in self._feature_store:
+            return self._feature_store[audio_id]
+        h5_path = self._h5file_dict[audio_id]
+        return self._h5_pool.get(h5_path)[audio_id][()]
+
     def __len__(self):
         return len(self._audio_ids)
 
     def __del__(self):
-        for k, cache in self._dataset_cache.items():
-            if cache:
-                try:
-                    cache.close()
-                except:
-                    pass
-        # for obj in gc.get_objects():
-            # if isinstance(obj, h5py.File):
-                # obj.close()
-        
+        if hasattr(self, "_h5_pool"):
+            self._h5_pool.close()
+
+
+class CaptionWaveformEvalDataset(CaptionEvalDataset):
+
+    def __init__(self,
+                 wav_dict: Dict,
+                 sample_rate: int,
+                 cache_size: int = 256):
+        """Inference dataset returning raw waveforms, features are computed on the fly
+        by a front end (`models.LogmelFrontEnd`) on the training device
+
+        Args:
+            wav_dict (Dict): Dictionary (<audio_id>: <audio_path>)
+            sample_rate (int): Sampling rate of the front end
+            cache_size (int, optional): Defaults to 256. Number of decoded waveforms cached by each worker
+        """
+        self._h5file_dict = wav_dict
+        self._audio_ids = list(wav_dict.keys())
+        self._feature_store = None
+        self._transform = None
+        self._waveform_cache = WaveformCache(sample_rate, cache_size)
+        self.data_dim = 1
+
+    def _load_feature(self, audio_id):
+        return self._waveform_cache.get(self._h5file_dict[audio_id])
 
 
 class CaptionDataset(CaptionEvalDataset):
@@ -65,20 +321,26 @@ class CaptionDataset(CaptionEvalDataset):
                  h5file_dict: Dict,
                  caption_info: List,
                  vocabulary: Vocabulary,
-                 transform: Optional[List] = None):
+                 transform: Optional[List] = None,
+                 max_open_files: int = 16,
+                 feature_store: Optional[FeatureStore] = None,
+                 caption_file: Optional[str] = None):
         """Dataloader for audio captioning dataset
 
         Args:
             h5file_dict (Dict): Dictionary (<audio_id>: <hdf5_path>)
             vocabulary (Vocabulary): Preloaded vocabulary object 
             transform (List, optional): Defaults to None. Transformation onto the data (List of function)
+            max_open_files (int, optional): Defaults to 16. Maximum number of HDF5 files kept open by each worker
+            feature_store (FeatureStore, optional): Defaults to None. Preloaded features, read before HDF5
+            caption_file (str, optional): Defaults to None. Caption json of `caption_info`, used to cache token ids
         """
-        super().__init__(h5file_dict, transform)
+        super().__init__(h5file_dict, transform, max_open_files, feature_store)
         # Important!!! reset audio id list, otherwise there is problem in matching!
         self._audio_ids = [info["audio_id"] for info in caption_info]
-        self._dataset_cache = {}
         self._caption_info = caption_info
         self._vocabulary = vocabulary
+        self._token_ids = CaptionTokenIds(caption_info, vocabulary, caption_file)
 
     def __getitem__(self, index: Tuple):
         """
@@ -88,19 +350,170 @@ class CaptionDataset(CaptionEvalDataset):
         audio_id, feature = super().__getitem__(audio_idx)
         if "raw_name" in self._caption_info[audio_idx]:
             audio_id = self._caption_info[audio_idx]["raw_name"]
-        # cap_id = self._caption_info[audio_idx]["captions"][cap_idx]["cap_id"]
-        tokens = self._caption_info[audio_idx]["captions"][cap_idx]["tokens"].split()
-        caption = [self._vocabulary('<start>')] + \
-            [self._vocabulary(token) for token in tokens] + \
-            [self._vocabulary('<end>')]
-        caption = torch.as_tensor(caption)
+        caption = self._get_caption(audio_idx, cap_idx)
         return feature, caption, audio_id
 
+    def _get_caption(self, audio_idx, cap_idx):
+        # cap_id = self._caption_info[audio_idx]["captions"][cap_idx]["cap_id"]
+        caption = self._token_ids[audio_idx, cap_idx]
+        caption = torch.from_numpy(caption.astype(np.int64))
+        return caption
+
+    def __len__(self):
+        return len(self._token_ids)
+
+    def get_feature_lens(self):
+        """Number of feature frames of each audio (indexed by audio_idx), read from HDF5 metadata"""
+        pool = H5HandlePool()
+        feat_lens = []
+        for audio_id in self._audio_ids:
+            if self._feature_store is not None and audio_id in self._feature_store:
+                feat_lens.append(self._feature_store.length(audio_id))
+            else:
+                feat_lens.append(pool.get(self._h5file_dict[audio_id])[audio_id].shape[0])
+        pool.close()
+        return feat_lens
+
+    def get_caption_len(self, audio_idx, cap_idx):
+        """Caption length including <start> and <end>"""
+        return self._token_ids.length(audio_idx, cap_idx)
+
+    def get_reference_token_ids(self, audio_ids=None):
+        """<audio_id>: word indices (without <start> and <end>) of all captions of each audio,
+        keyed by the same audio ids as `__getitem__`, e.g. references of CIDEr-D rewards
+
+        Args:
+            audio_ids (Iterable, optional): Defaults to None. Only return these audios (e.g. the training split)
+        """
+        if audio_ids is not None:
+            audio_ids = set(audio_ids)
+        key2refs = {}
+        for audio_idx, info in enumerate(self._caption_info):
+            if audio_ids is not None and info["audio_id"] not in audio_ids:
+                continue
+            audio_id = info.get("raw_name", info["audio_id"])
+            key2refs[audio_id] = [self._token_ids[audio_idx, cap_idx][1:-1]
+                                  for cap_idx in range(len(info["captions"]))]
+        return key2refs
+
+
+class CaptionDistillDataset(CaptionDataset):
+
+    def __init__(self,
+                 h5file_dict: Dict,
+                 caption_info: List,
+                 vocabulary: Vocabulary,
+                 soft_target_file: str,
+                 transform: Optional[List] = None,
+                 **kwargs):
+        """Training dataset with the top-k word distributions of a teacher (e.g. an ensemble) for
+        each caption, written by `write_soft_targets`. Rows of the soft targets are aligned with the
+        token ids of `CaptionTokenIds`, row `offsets[i] + t` is the distribution of the t-th word
+        (after <start>) of caption i, so an item has as many rows as its caption has tokens and
+        the first one (<start>) is unused.
+
+        Args:
+            soft_target_file (str): HDF5 file of soft targets ("indices", "probs": [num_tokens, k])
+            other arguments are the same as CaptionDataset
+        """
+        super().__init__(h5file_dict, caption_info, vocabulary, transform, **kwargs)
+        with h5py.File(soft_target_file, "r") as store:
+            self._soft_target_indices = store["indices"][()]
+            self._soft_target_probs = store["probs"][()]
+        assert len(self._soft_target_indices) == len(self._token_ids.tokens), \
+            "soft targets of {} do not match the captions".format(soft_target_file)
+
+    def __getitem__(self, index: Tuple):
+        feature, caption, audio_id = super().__getitem__(index)
+        i = self._token_ids._index(*index)
+        start, end = self._token_ids.offsets[i], self._token_ids.offsets[i + 1]
+        target_indices = torch.from_numpy(self._soft_target_indices[start: end].astype(np.int64))
+        target_probs = torch.from_numpy(self._soft_target_probs[start: end].astype(np.float32))
+        return feature, caption, audio_id, target_indices, target_probs
+
+
+def write_soft_targets(soft_target_file: str,
+                       token_ids: CaptionTokenIds,
+                       indices: np.ndarray,
+                       probs: np.ndarray,
+                       **attrs):
+    """Store the top-k soft targets of all captions (see `CaptionDistillDataset`) compactly:
+    word indices as uint16 when the vocabulary allows, probabilities as float16"""
+    assert len(indices) == len(token_ids.tokens)
+    index_dtype = np.uint16 if indices.max() < np.iinfo(np.uint16).max else np.int32
+    tmp_file = "{}.{}.tmp".format(soft_target_file, os.getpid())
+    with h5py.File(tmp_file, "w") as store:
+        store["indices"] = indices.astype(index_dtype)
+        store["probs"] = probs.astype(np.float16)
+        for key, value in attrs.items():
+            store.attrs[key] = value
+    os.replace(tmp_file, soft_target_file)
+
+
+def read_soft_target_attrs(soft_target_file: str):
+    with h5py.File(soft_target_file, "r") as store:
+        return dict(store.attrs)
+
+
+class CaptionAudioDataset(CaptionDataset):
+
+    def __init__(self,
+                 h5file_dict: Dict,
+                 caption_info: List,
+                 vocabulary: Vocabulary,
+                 transform: Optional[List] = None,
+                 audio_subset_indices: Optional[List] = None,
+                 **kwargs):
+        """Audio-level dataset: an item is one audio clip with all of its captions,
+        so that each clip is only encoded once for all its captions
+
+        Args:
+            audio_subset_indices (List, optional): Defaults to None. Audio indices to use, all by default
+            other arguments are the same as CaptionDataset
+        """
+        super().__init__(h5file_dict, caption_info, vocabulary, transform, **kwargs)
+        if audio_subset_indices is None:
+            audio_subset_indices = range(len(caption_info))
+        self._audio_subset_indices = list(audio_subset_indices)
+
+    def __getitem__(self, index: int):
+        audio_idx = self._audio_subset_indices[index]
+        audio_id, feature = CaptionEvalDataset.__getitem__(self, audio_idx)
+        if "raw_name" in self._caption_info[audio_idx]:
+            audio_id = self._caption_info[audio_idx]["raw_name"]
+        captions = [self._get_caption(audio_idx, cap_idx)
+            for cap_idx in range(len(self._caption_info[audio_idx]["captions"]))]
+        return feature, captions, audio_id
+
     def __len__(self):
-        length = 0
-        for audio_item in self._caption_info:
-            length += len(audio_item["captions"])
-        return length
+        return len(self._audio_subset_indices)
+
+
+class CaptionWaveformDataset(CaptionDataset):
+
+    def __init__(self,
+                 wav_dict: Dict,
+                 caption_info: List,
+                 vocabulary: Vocabulary,
+                 sample_rate: int,
+                 cache_size: int = 256,
+                 caption_file: Optional[str] = None):
+        """Training dataset returning raw waveforms instead of HDF5 features, so that
+        front end parameters (`models.LogmelFrontEnd`) can change without re-extraction
+
+        Args:
+            wav_dict (Dict): Dictionary (<audio_id>: <audio_path>)
+            sample_rate (int): Sampling rate of the front end
+            cache_size (int, optional): Defaults to 256. Number of decoded waveforms cached by each worker
+            other arguments are the same as CaptionDataset
+        """
+        CaptionWaveformEvalDataset.__init__(self, wav_dict, sample_rate, cache_size)
+        self._audio_ids = [info["audio_id"] for info in caption_info]
+        self._caption_info = caption_info
+        self._vocabulary = vocabulary
+        self._token_ids = CaptionTokenIds(caption_info, vocabulary, caption_file)
+
+    _load_feature = CaptionWaveformEvalDataset._load_feature
 
 
 class CaptionSentenceDataset(CaptionDataset):
@@ -161,8 +574,18 @@ class CaptionSampler(torch.utils.data.Sampler):
 
 class CaptionDistributedSampler(torch.utils.data.distributed.DistributedSampler):
 
-    def __init__(self, dataset, audio_subset_indices: List = None, shuffle: bool = True):
-        super().__init__(dataset, None, None, shuffle, 0, False)
+    def __init__(self,
+                 dataset,
+                 audio_subset_indices: List = None,
+                 shuffle: bool = True,
+                 num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None,
+                 seed: int = 0,
+                 drop_last: bool = False):
+        """Distributed version of CaptionSampler: (<audio_idx>, <cap_idx>) pairs are shuffled
+        the same way on all ranks (by `seed` and the epoch set by `set_epoch`) and each rank
+        takes every `num_replicas`-th pair"""
+        super().__init__(dataset, num_replicas, rank, shuffle, seed, drop_last)
         self._caption_info = dataset._caption_info
         self._audio_subset_indices = audio_subset_indices
         elems = []
@@ -174,26 +597,24 @@ class CaptionDistributedSampler(torch.utils.data.distributed.DistributedSampler)
             for cap_idx in range(len(self._caption_info[audio_idx]["captions"])):
                 elems.append((audio_idx, cap_idx))
         self.indices = elems
-        self.num_samples = len(elems)
-        if self.drop_last and len(self.num_samples) % self.num_replicas != 0:  # type: ignore[arg-type]
+        if self.drop_last and len(self.indices) % self.num_replicas != 0:  # type: ignore[arg-type]
             # Split to nearest available length that is evenly divisible.
             # This is to ensure each rank receives the same amount of data when
             # using this Sampler.
             self.num_samples = math.ceil(
                 # `type:ignore` is required because Dataset cannot provide a default __len__
                 # see NOTE in pytorch/torch/utils/data/sampler.py
-                (self.num_samples - self.num_replicas) / self.num_replicas  # type: ignore[arg-type]
+                (len(self.indices) - self.num_replicas) / self.num_replicas  # type: ignore[arg-type]
             )
         else:
-            self.num_samples = math.ceil(self.num_samples / self.num_replicas)  # type: ignore[arg-type]
+            self.num_samples = math.ceil(len(self.indices) / self.num_replicas)  # type: ignore[arg-type]
         self.total_size = self.num_samples * self.num_replicas
 
     def __iter__(self):
+        indices = list(self.indices)
         if self.shuffle:
             # deterministically shuffle based on epoch and seed
-            random.seed(self.seed + self.epoch)
-            random.shuffle(self.indices)
-        indices = self.indices
+            random.Random(self.seed + self.epoch).shuffle(indices)
 
         if not self.drop_last:
             # add extra samples to make it evenly divisible
@@ -211,6 +632,184 @@ class CaptionDistributedSampler(torch.utils.data.distributed.DistributedSampler)
         assert len(indices) == self.num_samples
         return iter(indices)
 
+class CaptionBucketBatchSampler(torch.utils.data.Sampler):
+
+    def __init__(self,
+                 data_source: CaptionDataset,
+                 audio_subset_indices: List = None,
+                 batch_size: int = 32,
+                 max_frames: Optional[int] = None,
+                 bucket_size: int = 100,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seed: int = 0):
+        """Batch sampler grouping (<audio_idx>, <cap_idx>) pairs of similar feature and caption
+        lengths to reduce padding. Pairs are shuffled and split into buckets of `bucket_size`
+        batches, each bucket is sorted by lengths and cut into batches, then all batches are shuffled.
+        Shuffling is seeded by `seed` and the epoch, which advances at each `__iter__` (or is set
+        by `set_epoch`), so the batches of an epoch do not depend on the global random state.
+
+        Args:
+            data_source (CaptionDataset): Dataset to sample from
+            audio_subset_indices (List, optional): Defaults to None. Audio indices to use, all by default
+            batch_size (int, optional): Defaults to 32. Number of pairs in a batch
+            max_frames (int, optional): Defaults to None. If given, batches are capped by the number of
+                padded feature frames (batch size * longest feature) instead of `batch_size`. The number
+                of batches would then vary between epochs, every epoch is padded (by repeating batches)
+                or trimmed to the number of batches of the first epoch, which is `len(sampler)`
+            bucket_size (int, optional): Defaults to 100. Number of batches in a bucket
+            shuffle (bool, optional): Defaults to True.
+            drop_last (bool, optional): Defaults to False. Drop incomplete batches (only with `batch_size`)
+            seed (int, optional): Defaults to 0. Seed of the shuffling
+        """
+        self._batch_size = batch_size
+        self._max_frames = max_frames
+        self._bucket_size = bucket_size
+        self._shuffle = shuffle
+        self._drop_last = drop_last
+        if audio_subset_indices is not None:
+            audio_idxs = audio_subset_indices
+        else:
+            audio_idxs = range(len(data_source._caption_info))
+        feat_lens = data_source.get_feature_lens()
+        # elem: (<audio_idx>, <cap_idx>, <feat_len>, <cap_len>)
+        self._elems = []
+        for audio_idx in audio_idxs:
+            for cap_idx in range(len(data_source._caption_info[audio_idx]["captions"])):
+                self._elems.append((audio_idx, cap_idx, feat_lens[audio_idx],
+                                    data_source.get_caption_len(audio_idx, cap_idx)))
+        self.seed = seed
+        self.epoch = 0
+        self._padding_stats = None
+        # the same in all epochs, also without `max_frames` where it is given by the number of pairs
+        self._num_batches = len(self._make_batches(random.Random(self.seed)))
+
+    def _is_full(self, batch, max_feat_len):
+        if self._max_frames is not None:
+            return (len(batch) + 1) * max_feat_len > self._max_frames
+        return len(batch) >= self._batch_size
+
+    def _make_batches(self, rng):
+        elems = list(self._elems)
+        if self._shuffle:
+            rng.shuffle(elems)
+        batches = []
+        bucket_elems = self._batch_size * self._bucket_size
+        for start in range(0, len(elems), bucket_elems):
+            bucket = sorted(elems[start: start + bucket_elems], key=lambda x: (x[2], x[3]))
+            batch = []
+            max_feat_len = 0
+            for elem in bucket:
+                max_feat_len = max(max_feat_len, elem[2])
+                if batch and self._is_full(batch, max_feat_len):
+                    batches.append(batch)
+                    batch = []
+                    max_feat_len = elem[2]
+                batch.append(elem)
+            if batch and (not self._drop_last or self._max_frames is not None or \
+                    len(batch) == self._batch_size):
+                batches.append(batch)
+        if self._shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def _update_padding_stats(self, batches):
+        feat_real, feat_padded, cap_real, cap_padded = 0, 0, 0, 0
+        for batch in batches:
+            feat_real += sum(elem[2] for elem in batch)
+            feat_padded += len(batch) * max(elem[2] for elem in batch)
+            cap_real += sum(elem[3] for elem in batch)
+            cap_padded += len(batch) * max(elem[3] for elem in batch)
+        self._padding_stats = (feat_real, feat_padded, cap_real, cap_padded)
+
+    def padding_ratio(self):
+        """Fraction of padded feature frames / caption tokens in batches of the latest epoch"""
+        if self._padding_stats is None:
+            return None
+        feat_real, feat_padded, cap_real, cap_padded = self._padding_stats
+        return {
+            "feature": 1 - feat_real / max(feat_padded, 1),
+            "caption": 1 - cap_real / max(cap_padded, 1)
+        }
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+
+    def _epoch_batches(self):
+        batches = self._make_batches(random.Random(self.seed + self.epoch))
+        if len(batches) > self._num_batches:
+            # shuffled, the dropped pairs differ between epochs
+            batches = batches[:self._num_batches]
+        elif len(batches) < self._num_batches:
+            batches += (batches * math.ceil(self._num_batches / len(batches)))[:self._num_batches - len(batches)]
+        return batches
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        self.epoch += 1
+        self._update_padding_stats(batches)
+        return iter([[(elem[0], elem[1]) for elem in batch] for batch in batches])
+
+    def __len__(self):
+        return self._num_batches
+
+
+class CaptionDistributedBucketBatchSampler(CaptionBucketBatchSampler):
+
+    def __init__(self,
+                 data_source: CaptionDataset,
+                 audio_subset_indices: List = None,
+                 num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None,
+                 **kwargs):
+        """Distributed version of CaptionBucketBatchSampler: all ranks build the same batches
+        (deterministically shuffled by `seed` and the epoch) and each rank takes every
+        `num_replicas`-th batch. Batches are padded (or dropped with `drop_last`) so that all
+        ranks get the same number of batches.
+        """
+        super().__init__(data_source, audio_subset_indices, **kwargs)
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def _epoch_batches(self):
+        batches = super()._epoch_batches()
+        if self._drop_last:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+        else:
+            padding_size = math.ceil(len(batches) / self.num_replicas) * self.num_replicas - len(batches)
+            if padding_size <= len(batches):
+                batches += batches[:padding_size]
+            else:
+                batches += (batches * math.ceil(padding_size / len(batches)))[:padding_size]
+        return batches[self.rank::self.num_replicas]
+
+    def __len__(self):
+        if self._drop_last:
+            return self._num_batches // self.num_replicas
+        return math.ceil(self._num_batches / self.num_replicas)
+
+
+def merge_seq(dataseq, dim=0):
+    """Pad sequences (lengths in the first dimension) in one call, lengths are returned as
+    an int64 tensor. Pinning is left to the DataLoader (`pin_memory: True` in dataloader_args)"""
+    assert dim == 0, "only sequences with lengths in the first dimension are supported"
+    dataseq = [torch.as_tensor(seq) for seq in dataseq]
+    lengths = torch.as_tensor([seq.size(0) for seq in dataseq], dtype=torch.long)
+    padded = torch.nn.utils.rnn.pad_sequence(dataseq, batch_first=True)
+    return padded, lengths
+
+
 def collate_fn(length_idxs: List = [], sort_idx = None):
 
     def collate_wrapper(data_batches):
@@ -219,18 +818,6 @@ def collate_fn(length_idxs: List = [], sort_idx = None):
         if sort_idx:
             data_batches.sort(key=lambda x: len(x[sort_idx]), reverse=True)
 
-        def merge_seq(dataseq, dim=0):
-            lengths = [seq.shape for seq in dataseq]
-            # Assuming duration is given in the first dimension of each sequence
-            maxlengths = tuple(np.max(lengths, axis=dim))
-            # For the case that the lengths are 2 dimensional
-            lengths = np.array(lengths)[:, dim]
-            padded = torch.zeros((len(dataseq),) + maxlengths)
-            for i, seq in enumerate(dataseq):
-                end = lengths[i]
-                padded[i, :end] = seq[:end]
-            return padded, lengths
-        
         data_out = []
         data_len = []
         for idx, data in enumerate(zip(*data_batches)):
@@ -252,6 +839,26 @@ def collate_fn(length_idxs: List = [], sort_idx = None):
     return collate_wrapper
 
 
+def audio_collate_fn():
+
+    def collate_wrapper(data_batches):
+        # data_batches: [[feat1, [cap1_1, cap1_2, ...], audio_id1], ...]
+        # captions of all clips are flattened and sorted by length, caption i belongs
+        # to the `caption_audio_idxs[i]`-th clip of `feats`
+        feats, feat_lens = merge_seq([data[0] for data in data_batches])
+        captions = []
+        for audio_pos, (_, caps, audio_id) in enumerate(data_batches):
+            for cap in caps:
+                captions.append((cap, audio_pos, audio_id))
+        captions.sort(key=lambda x: len(x[0]), reverse=True)
+        caps, cap_lens = merge_seq([cap for cap, _, _ in captions])
+        keys = tuple(audio_id for _, _, audio_id in captions)
+        caption_audio_idxs = torch.as_tensor([audio_pos for _, audio_pos, _ in captions])
+        return [feats, caps, keys, caption_audio_idxs, feat_lens, cap_lens]
+
+    return collate_wrapper
+
+
 if __name__ == "__main__":
     import argparse
     import json
@@ -282,7 +889,8 @@ if __name__ == "__main__":
     dataset = CaptionDataset(
         dict(zip(feature_df["audio_id"], feature_df["hdf5_path"])),
         caption_info,
-        vocabulary
+        vocabulary,
+        caption_file=args.annotation_file
     )
     # for feat, target in dataset:
         # print(feat.shape, target.shape)
@@ -4,3 +4,4 @@ from .word_model import *
 from .seq_train_model import *
 from .attn_model import *
 from .transformer_model import *
+from .ensemble_model import *
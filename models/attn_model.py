@@ -79,21 +79,23 @@ class Seq2SeqAttnModel(CaptionModel):
 
     def prepare_beamsearch_output(self, output, beam_size, encoded, max_length):
         super(Seq2SeqAttnModel, self).prepare_beamsearch_output(output, beam_size, encoded, max_length)
-        output["attn_weights"] = torch.empty(beam_size, max(encoded["audio_embeds_lens"]), max_length)
+        output["attn_weights"] = torch.empty(output["top_k_logprobs"].size(0),
+                                             max(encoded["audio_embeds_lens"]),
+                                             max_length).to(encoded["audio_embeds"].device)
 
-    def prepare_beamsearch_decoder_input(self, decoder_input, encoded, output, i, t, beam_size):
-        super(Seq2SeqAttnModel, self).prepare_beamsearch_decoder_input(decoder_input, encoded, output, i, t, beam_size)
+    def prepare_beamsearch_decoder_input(self, decoder_input, encoded, output, t, beam_size):
+        super(Seq2SeqAttnModel, self).prepare_beamsearch_decoder_input(decoder_input, encoded, output, t, beam_size)
         if t == 0:
-            enc_mem = encoded["audio_embeds"][i]
-            decoder_input["enc_mem"] = enc_mem.unsqueeze(0).repeat(beam_size, 1, 1)
-            enc_mem_lens = encoded["audio_embeds_lens"][i]
-            decoder_input["enc_mem_lens"] = enc_mem_lens.repeat(beam_size)
+            enc_mem = encoded["audio_embeds"]
+            decoder_input["enc_mem"] = enc_mem.repeat_interleave(beam_size, 0)
+            enc_mem_lens = torch.as_tensor(encoded["audio_embeds_lens"])
+            decoder_input["enc_mem_lens"] = enc_mem_lens.repeat_interleave(beam_size, 0)
             if decoder_input["state"] is None:
-                decoder_input["state"] = self.decoder.init_hidden(beam_size)
+                decoder_input["state"] = self.decoder.init_hidden(decoder_input["enc_mem"].size(0))
                 decoder_input["state"] = decoder_input["state"].to(decoder_input["enc_mem"].device)
 
-    def beamsearch_step(self, decoder_input, encoded, output, i, t, beam_size):
-        output_t = super(Seq2SeqAttnModel, self).beamsearch_step(decoder_input, encoded, output, i, t, beam_size)
+    def beamsearch_step(self, decoder_input, encoded, output, t, beam_size):
+        output_t = super(Seq2SeqAttnModel, self).beamsearch_step(decoder_input, encoded, output, t, beam_size)
         output["attn_weights"][:, :, t] = output_t["weights"]
         return output_t
 
@@ -101,9 +103,9 @@ class Seq2SeqAttnModel(CaptionModel):
         super().beamsearch_process_step(output, output_t)
         output["attn_weights"] = output["attn_weights"][output["prev_word_inds"], :, :]
 
-    def beamsearch_process(self, output, output_i, i):
-        output["seqs"][i] = output_i["seqs"][0]
-        output["attn_weights"][i] = output_i["attn_weights"][0]
+    def beamsearch_process(self, output, output_b):
+        super().beamsearch_process(output, output_b)
+        output["attn_weights"] = output_b["attn_weights"][output_b["best_inds"]]
 
 
 class Seq2SeqAttnEnsemble():
@@ -205,11 +205,19 @@ class TransformerDecoder(BaseDecoder):
         return mask
 
     def forward(self, **kwargs):
+        """
+        When `state` is passed, the decoder works in incremental mode: only the newest
+        words are fed and keys / values of the previous words are taken from `state`
+        (None for the first step). Otherwise the whole prefix is decoded at once.
+        """
         words = kwargs["words"]
         enc_mem = kwargs["enc_mem"]
         enc_mem_lens = kwargs["enc_mem_lens"]
         tgt_key_padding_mask = kwargs["caps_padding_mask"]
 
+        if "state" in kwargs:
+            return self.incremental_forward(words, kwargs["state"], enc_mem,
+                                            enc_mem_lens, tgt_key_padding_mask)
 
         enc_mem = enc_mem.transpose(0, 1) # [T_src, N, emb_size]
         words = words.to(enc_mem.device)
@@ -224,7 +232,101 @@ class TransformerDecoder(BaseDecoder):
                             memory_key_padding_mask=memory_key_padding_mask)
         output = output.transpose(0, 1)
         output = {
+            "states": None,
             "output": output,
             "logits": self.outputlayer(output),
         }
         return output
+
+    @staticmethod
+    def _split_heads(x, nhead):
+        # x: [N, T, emb_size] -> [N, nhead, T, head_dim]
+        N, T, E = x.size()
+        return x.view(N, T, nhead, E // nhead).transpose(1, 2)
+
+    @staticmethod
+    def _in_projection(attn, x, idx):
+        """project `x` by the query (idx=0), key (idx=1) or value (idx=2) weights of `attn`"""
+        E = attn.embed_dim
+        weight = attn.in_proj_weight[idx * E: (idx + 1) * E]
+        bias = attn.in_proj_bias[idx * E: (idx + 1) * E]
+        return nn.functional.linear(x, weight, bias)
+
+    def _cached_attention(self, attn, x, keys, values, key_padding_mask):
+        """
+        x: [N, T, emb_size], keys / values: [N, nhead, S, head_dim], key_padding_mask: [N, S]
+        """
+        N, T, E = x.size()
+        q = self._split_heads(self._in_projection(attn, x, 0), self.nhead)
+        q = q * (E // self.nhead) ** -0.5
+        score = q @ keys.transpose(-2, -1) # [N, nhead, T, S]
+        score = score.masked_fill(key_padding_mask[:, None, None, :], float("-inf"))
+        weights = torch.softmax(score, dim=-1)
+        weights = nn.functional.dropout(weights, p=attn.dropout, training=self.training)
+        out = (weights @ values).transpose(1, 2).reshape(N, T, E)
+        return attn.out_proj(out)
+
+    def init_state(self, enc_mem, enc_mem_lens):
+        """Cache of incremental decoding: self attention keys / values of each layer
+        (empty at the beginning) and the cross attention projections of `enc_mem`"""
+        N = enc_mem.size(0)
+        state = {
+            "keys": [], "values": [], "mem_keys": [], "mem_values": [],
+            "padding_mask": torch.zeros(N, 0, dtype=torch.bool, device=enc_mem.device),
+            "mem_padding_mask": ~generate_length_mask(enc_mem_lens).to(enc_mem.device)
+        }
+        enc_mem = enc_mem[:, :state["mem_padding_mask"].size(1)]
+        for layer in self.model.layers:
+            empty = enc_mem.new_zeros(N, self.nhead, 0, self.embed_size // self.nhead)
+            state["keys"].append(empty)
+            state["values"].append(empty)
+            attn = layer.multihead_attn
+            state["mem_keys"].append(self._split_heads(self._in_projection(attn, enc_mem, 1), self.nhead))
+            state["mem_values"].append(self._split_heads(self._in_projection(attn, enc_mem, 2), self.nhead))
+        return state
+
+    def reorder_state(self, state, idxs):
+        """Select the cached prefixes `idxs` (e.g. `prev_word_inds` in beam search), encoder
+        memory projections are kept since `idxs` always come from the same audio clip"""
+        state = dict(state)
+        state["keys"] = [key[idxs] for key in state["keys"]]
+        state["values"] = [value[idxs] for value in state["values"]]
+        state["padding_mask"] = state["padding_mask"][idxs]
+        return state
+
+    def incremental_forward(self, words, state, enc_mem, enc_mem_lens, tgt_key_padding_mask):
+        """
+        words: [N, 1] the newest word, state: the cache returned by the previous step or None
+        """
+        if state is None:
+            state = self.init_state(enc_mem, enc_mem_lens)
+        else:
+            state = dict(state)
+        words = words.to(enc_mem.device)
+        t = state["padding_mask"].size(1)
+        embed = self.dropoutlayer(self.word_embeddings(words)) * math.sqrt(self.embed_size) # [N, 1, emb_size]
+        x = self.pos_encoder.dropout(embed + self.pos_encoder.pe[t].unsqueeze(0))
+
+        padding_mask = torch.cat((state["padding_mask"], tgt_key_padding_mask.to(x.device)), dim=1)
+        keys, values = [], []
+        for i, layer in enumerate(self.model.layers):
+            attn = layer.self_attn
+            k = self._split_heads(self._in_projection(attn, x, 1), self.nhead)
+            v = self._split_heads(self._in_projection(attn, x, 2), self.nhead)
+            keys.append(torch.cat((state["keys"][i], k), dim=2))
+            values.append(torch.cat((state["values"][i], v), dim=2))
+            x2 = self._cached_attention(attn, x, keys[i], values[i], padding_mask)
+            x = layer.norm1(x + layer.dropout1(x2))
+            x2 = self._cached_attention(layer.multihead_attn, x, state["mem_keys"][i],
+                                        state["mem_values"][i], state["mem_padding_mask"])
+            x = layer.norm2(x + layer.dropout2(x2))
+            x2 = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+            x = layer.norm3(x + layer.dropout3(x2))
+        state["keys"] = keys
+        state["values"] = values
+        state["padding_mask"] = padding_mask
+        return {
+            "states": state,
+            "output": x,
+            "logits": self.outputlayer(x),
+        }
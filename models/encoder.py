@@ -50,6 +50,34 @@ def load_espnet_encoder(model_path, pretrained=True):
     encoder = E2EASREncoder(model.enc)
     return encoder
 
+class LogmelFrontEnd(nn.Module):
+
+    def __init__(self, sample_rate=32000, window_size=1024, hop_size=320, mel_bins=64,
+                 fmin=50, fmax=14000):
+        """Log mel spectrogram of raw waveforms computed on the training device, the same
+        (torchlibrosa) front end as PANNs in `data/extract_feature_panns.py`.
+        Parameters are fixed, they are not trained."""
+        super(LogmelFrontEnd, self).__init__()
+        from torchlibrosa.stft import Spectrogram, LogmelFilterBank
+        self.sample_rate = sample_rate
+        self.hop_size = hop_size
+        self.mel_bins = mel_bins
+        self.spectrogram_extractor = Spectrogram(n_fft=window_size, hop_length=hop_size,
+            win_length=window_size, window="hann", center=True, pad_mode="reflect",
+            freeze_parameters=True)
+        self.logmel_extractor = LogmelFilterBank(sr=sample_rate, n_fft=window_size,
+            n_mels=mel_bins, fmin=fmin, fmax=fmax, ref=1.0, amin=1e-10, top_db=None,
+            freeze_parameters=True)
+
+    def forward(self, waveforms, lens):
+        """waveforms: [N, L] zero-padded, lens: [N,] number of samples
+        returns log mel spectrogram [N, T, mel_bins] and number of frames [N,]"""
+        x = self.spectrogram_extractor(waveforms) # [N, 1, T, F]
+        x = self.logmel_extractor(x)
+        feat_lens = torch.div(torch.as_tensor(lens), self.hop_size, rounding_mode="floor") + 1
+        return x.squeeze(1), feat_lens
+
+
 class BaseEncoder(nn.Module):
     
     """
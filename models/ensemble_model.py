@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+
+
+class EnsembleCaptionModel(nn.Module):
+
+    def __init__(self, models, combine="mean_prob", num_workers=None):
+        """Ensemble of captioning models (`CaptionModel`) sharing the vocabulary, decoded together
+        by batched beam search. Members run concurrently on a thread pool (PyTorch operators release
+        the GIL), the intra-op threads of the process are divided among the workers.
+
+        Args:
+            models (List): Members, e.g. `Seq2SeqAttnModel`, `TransformerModel`, may be of different architectures
+            combine (str, optional): Defaults to "mean_prob". How word distributions of members are merged:
+                mean_prob: log of the averaged probabilities (log-sum-exp of log probabilities)
+                log_linear: averaged log probabilities
+            num_workers (int, optional): Defaults to None. Members run in parallel, one thread per member if None,
+                members run one after another if 1
+        """
+        super(EnsembleCaptionModel, self).__init__()
+        assert combine in ("mean_prob", "log_linear"), "unknown combination {}".format(combine)
+        assert len(set(model.vocab_size for model in models)) == 1, "members must share the vocabulary"
+        self.models = nn.ModuleList(models)
+        self.start_idx = models[0].start_idx
+        self.end_idx = models[0].end_idx
+        self.vocab_size = models[0].vocab_size
+        self.max_length = models[0].max_length
+        self.combine = combine
+        self.num_workers = min(len(models), num_workers or len(models))
+        # created at the first call, not copied or pickled with the module
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._num_threads = torch.get_num_threads()
+            num_threads = max(1, self._num_threads // self.num_workers)
+            self._executor = ThreadPoolExecutor(
+                self.num_workers, initializer=torch.set_num_threads, initargs=(num_threads,))
+        return self._executor
+
+    def _map(self, fn, *iterables):
+        """fn(model, ...) of each member"""
+        if self.num_workers == 1:
+            return list(map(fn, self.models, *iterables))
+        return list(self._get_executor().map(fn, self.models, *iterables))
+
+    def forward(self, feats, feat_lens, **kwargs):
+        """Only inference is supported, kwargs: {'method': 'greedy' | 'beam', 'beam_size': int, 'max_length': int}"""
+        method = kwargs.get("method", "greedy")
+        assert method in ("greedy", "beam"), "ensemble decoding by {} is not supported".format(method)
+        max_length = kwargs.get("max_length", self.max_length)
+        length_penalty = kwargs.get("length_penalty", 0.0)
+        encoded = self._map(lambda model: model.encoder(feats, feat_lens))
+        if method == "beam":
+            return self.beam_search(encoded, max_length, kwargs.get("beam_size", 5), length_penalty)
+        # greedy decoding is the beam search with a single beam
+        return self.beam_search(encoded, max_length, 1)
+
+    def combine_logprobs(self, logprobs):
+        """Merge log probabilities of members, [num_models, ...] -> [...]"""
+        if self.combine == "mean_prob":
+            return torch.logsumexp(logprobs, dim=0) - math.log(logprobs.size(0))
+        return logprobs.mean(dim=0)
+
+    def forced_logprobs(self, feats, feat_lens, caps, cap_lens):
+        """Ensemble log probabilities of the next words of `caps` (teacher forcing), [N, max_cap_len - 1, vocab_size]"""
+        def member_logprobs(model):
+            output = model(feats, feat_lens, caps, cap_lens, ss_ratio=1.0)
+            return torch.log_softmax(output["logits"], dim=-1).to(caps.device)
+        return self.combine_logprobs(torch.stack(self._map(member_logprobs)))
+
+    def beam_search(self, encoded, max_length, beam_size, length_penalty=0.0):
+        """Batched beam search, rows are folded as in `CaptionModel.beam_search` (row `n * beam_size + b`
+        is the b-th beam of the n-th clip), each member keeps its own decoder states and the beams are shared"""
+        # encoded: [{"audio_embeds": ..., "audio_embeds_lens": ...}, {"audio_embeds": ..., "audio_embeds_lens": ...}, ...]
+        N = encoded[0]["audio_embeds"].size(0)
+        num_models = len(self.models)
+        seqs = torch.empty(N, max_length, dtype=torch.long).fill_(self.end_idx)
+
+        decoder_inputs = [{} for _ in range(num_models)]
+        outputs_b = [{} for _ in range(num_models)]
+        for model, model_encoded, model_output_b in zip(self.models, encoded, outputs_b):
+            model.prepare_beamsearch_output(model_output_b, beam_size, model_encoded, max_length)
+        output_b = {"top_k_logprobs": outputs_b[0]["top_k_logprobs"]}
+        device = output_b["top_k_logprobs"].device
+        beam_offsets = torch.arange(N, device=device).unsqueeze(1) * beam_size
+
+        def member_step(model, decoder_input, model_encoded, model_output_b, t):
+            output_t = model.beamsearch_step(decoder_input, model_encoded, model_output_b, t, beam_size)
+            logprobs_t = torch.log_softmax(output_t["logits"].squeeze(1), dim=-1)
+            return output_t, logprobs_t.to(device)
+
+        for t in range(max_length):
+            outputs_t, logprobs_t = zip(*self._map(
+                member_step, decoder_inputs, encoded, outputs_b, [t] * num_models))
+            # ensemble word distributions: [N * beam_size, vocab_size]
+            logprobs_t = self.combine_logprobs(torch.stack(logprobs_t))
+            if t > 0: # finished hypotheses can only be extended by <end>, with no extra cost
+                finished = output_b["finished"]
+                logprobs_t[finished] = float("-inf")
+                logprobs_t[finished, self.end_idx] = 0
+            logprobs_t = output_b["top_k_logprobs"].unsqueeze(1).expand_as(logprobs_t) + logprobs_t
+            logprobs_t = logprobs_t.view(N, -1)
+            if t == 0: # for the first step, all k seqs of a clip have the same probs
+                logprobs_t = logprobs_t[:, :self.vocab_size]
+            # unroll and find top logprobs, and their unrolled indices
+            top_k_logprobs, top_k_words = logprobs_t.topk(beam_size, 1, True, True) # [N, beam_size]
+            output_b["top_k_logprobs"] = top_k_logprobs.view(-1)
+            prev_word_inds = (top_k_words // self.vocab_size + beam_offsets).view(-1)
+            next_word_inds = (top_k_words % self.vocab_size).view(-1)
+            if t == 0:
+                output_b["seqs"] = next_word_inds.unsqueeze(1)
+            else:
+                output_b["seqs"] = torch.cat([output_b["seqs"][prev_word_inds],
+                                              next_word_inds.unsqueeze(1)], dim=1)
+            output_b["finished"] = next_word_inds == self.end_idx
+            # reorder decoder states of each member by the selected beams
+            for model, model_output_b, output_t in zip(self.models, outputs_b, outputs_t):
+                model_output_b["prev_word_inds"] = prev_word_inds.to(model_output_b["top_k_logprobs"].device)
+                model_output_b["next_word_inds"] = next_word_inds.to(model_output_b["top_k_logprobs"].device)
+                model.beamsearch_process_step(model_output_b, output_t)
+            if output_b["finished"].all():
+                break
+        self.models[0].beamsearch_select(output_b, N, beam_size, length_penalty)
+        best_seqs = output_b["seqs"][output_b["best_inds"]]
+        seqs[:, :best_seqs.size(1)] = best_seqs
+        return {"seqs": seqs}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            torch.set_num_threads(self._num_threads)
@@ -74,6 +74,16 @@ class ScstWrapper(nn.Module):
         greedy_seqs = greedy_seqs.cpu().numpy()
         sampled_seqs = sampled_seqs.cpu().numpy()
 
+        if isinstance(scorer, score_util.BatchCiderD):
+            # sampled and greedy captions are scored in a single batch, on word indices
+            scores = scorer.score(list(keys) + list(keys),
+                                  list(sampled_seqs) + list(greedy_seqs),
+                                  self.model.end_idx,
+                                  self.model.start_idx)
+            sampled_score = scores[:len(keys)]
+            greedy_score = scores[len(keys):]
+            return {"reward": sampled_score - greedy_score, "score": sampled_score}
+
         sampled_score = score_util.compute_batch_score(sampled_seqs,
                                                        key2refs,
                                                        keys,
@@ -90,3 +100,78 @@ class ScstWrapper(nn.Module):
                                                       scorer)
         reward = sampled_score - greedy_score
         return {"reward": reward, "score": sampled_score}
+
+
+class MultiSampleScstWrapper(ScstWrapper):
+
+    def __init__(self, model, num_samples=5):
+        """SCST with `num_samples` sampled captions of each clip, the baseline of a sample
+        is the mean reward of the other samples of the same clip, so no greedy decoding is needed
+        """
+        super(MultiSampleScstWrapper, self).__init__(model)
+        assert num_samples > 1, "at least 2 samples are needed for the mean-of-samples baseline"
+        self.num_samples = num_samples
+
+    def scst(self, feats, feat_lens, keys, key2refs, vocabulary, **kwargs):
+        output = {}
+        K = self.num_samples
+
+        sample_kwargs = {
+            "temperature": kwargs.get("temperature", 1.0),
+            "max_length": kwargs["max_length"]
+        }
+
+        # captions of the same clip in a batch share its samples, each clip is encoded once
+        key2idx = {}
+        for idx, key in enumerate(keys):
+            key2idx.setdefault(key, idx)
+        clip_keys = list(key2idx.keys())
+        clip_idxs = torch.as_tensor(list(key2idx.values()))
+        clip_lens = torch.as_tensor(feat_lens)[clip_idxs]
+        clip_feats = feats[clip_idxs.to(feats.device)][:, :int(clip_lens.max())]
+
+        self.model.train()
+        encoded = self.model.encoder(clip_feats, clip_lens)
+        # row `n * K + k` is the k-th sample of the n-th clip
+        encoded = self.model.expand_encoded(
+            encoded, torch.arange(len(clip_keys)).repeat_interleave(K))
+        sampled = self.model.inference_forward(encoded, method="sample", **sample_kwargs)
+        output["sampled_seqs"] = sampled["seqs"]
+
+        sample_keys = [key for key in clip_keys for _ in range(K)]
+        score = self.get_sample_score(sampled["seqs"], sample_keys, key2refs,
+                                      vocabulary, kwargs["scorer"])
+        score_k = score.reshape(-1, K)
+        baseline = (score_k.sum(1, keepdims=True) - score_k) / (K - 1)
+        reward = (score_k - baseline).reshape(-1)
+        # reward: [N * K, ]
+        output["reward"] = torch.as_tensor(reward)
+        output["score"] = torch.as_tensor(score)
+
+        reward = np.repeat(reward[:, np.newaxis], sampled["seqs"].size(-1), 1)
+        reward = torch.as_tensor(reward).float()
+        mask = (sampled["seqs"] != self.model.end_idx).float()
+        mask = torch.cat([torch.ones(mask.size(0), 1), mask[:, :-1]], 1)
+        loss = - sampled["sampled_logprobs"] * reward * mask
+        loss = loss.to(feats.device)
+        # loss: [N * K, max_length]
+        loss = torch.sum(loss, dim=1).mean()
+        output["loss"] = loss
+
+        return output
+
+    def get_sample_score(self, sampled_seqs, sample_keys, key2refs, vocabulary, scorer):
+        # sampled_seqs: [N * K, max_length]
+        sampled_seqs = sampled_seqs.cpu().numpy()
+        if isinstance(scorer, score_util.BatchCiderD):
+            return scorer.score(sample_keys, sampled_seqs, self.model.end_idx, self.model.start_idx)
+        # `compute_batch_score` scores one caption per key, samples are given distinct keys
+        sample_ids = ["{}_{}".format(key, i) for i, key in enumerate(sample_keys)]
+        return score_util.compute_batch_score(sampled_seqs,
+                                              {sample_id: key2refs[key] for sample_id, key
+                                                  in zip(sample_ids, sample_keys)},
+                                              sample_ids,
+                                              self.model.start_idx,
+                                              self.model.end_idx,
+                                              vocabulary,
+                                              scorer)
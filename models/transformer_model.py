@@ -37,35 +37,43 @@ class TransformerModel(CaptionModel):
 
     def prepare_decoder_input(self, decoder_input, encoded, caps, output, t, **kwargs):
         """Prepare the input dict `decoder_input` for the decoder and timestep t"""
-        super(TransformerModel, self).prepare_decoder_input(decoder_input, encoded, caps, output, t, **kwargs)
+        N = output["seqs"].size(0)
         if t == 0:
             decoder_input["enc_mem"] = encoded["audio_embeds"]
             decoder_input["enc_mem_lens"] = encoded["audio_embeds_lens"]
-            words = torch.tensor([self.start_idx,] * output["seqs"].size(0)).unsqueeze(1).long()
-        else:
-            words = output["seqs"][:, :t]
-            if caps is not None and random.random() < kwargs["ss_ratio"]: # training, scheduled sampling
-                words = caps[:, :t]
+            words = torch.tensor([self.start_idx,] * N).unsqueeze(1).long()
+            if caps is None: # inference, keys / values of previous words are cached
+                decoder_input["state"] = None
+        elif caps is None: # inference, only feed the last word
+            words = output["seqs"][:, t - 1].unsqueeze(1).clone()
+            decoder_input["state"] = output["state"]
+        else: # scheduled sampling training, feed the whole prefix
+            words = torch.cat((torch.tensor([self.start_idx,] * N).unsqueeze(1).long(),
+                               output["seqs"][:, :t]), dim=1)
+            if random.random() < kwargs["ss_ratio"]:
+                words = caps[:, :t + 1]
         decoder_input["words"] = words
         caps_padding_mask = (words == self.pad_idx).to(encoded["audio_embeds"].device)
         decoder_input["caps_padding_mask"] = caps_padding_mask
 
-    def beamsearch_step(self, decoder_input, encoded, output, i, t, beam_size):
-        self.prepare_beamsearch_decoder_input(decoder_input, encoded, output, i, t, beam_size)
+    def beamsearch_step(self, decoder_input, encoded, output, t, beam_size):
+        self.prepare_beamsearch_decoder_input(decoder_input, encoded, output, t, beam_size)
         output_t = self.decoder(**decoder_input)
         output_t["logits"] = output_t["logits"][:, -1, :].unsqueeze(1)
         return output_t
 
-    def prepare_beamsearch_decoder_input(self, decoder_input, encoded, output, i, t, beam_size):
+    def prepare_beamsearch_decoder_input(self, decoder_input, encoded, output, t, beam_size):
         if t == 0:
-            enc_mem_lens = encoded["audio_embeds_lens"][i]
-            decoder_input["enc_mem_lens"] = enc_mem_lens.repeat(beam_size)
-            enc_mem = encoded["audio_embeds"][i, :enc_mem_lens]
-            decoder_input["enc_mem"] = enc_mem.unsqueeze(0).repeat(beam_size, 1, 1)
+            enc_mem_lens = torch.as_tensor(encoded["audio_embeds_lens"])
+            decoder_input["enc_mem_lens"] = enc_mem_lens.repeat_interleave(beam_size, 0)
+            enc_mem = encoded["audio_embeds"][:, :max(enc_mem_lens)]
+            decoder_input["enc_mem"] = enc_mem.repeat_interleave(beam_size, 0)
+            decoder_input["state"] = None
 
-            words = torch.tensor([self.start_idx,] * beam_size).unsqueeze(1).long()
+            words = torch.tensor([self.start_idx,] * decoder_input["enc_mem"].size(0)).unsqueeze(1).long()
         else:
-            words = output["seqs"]
+            words = output["next_word_inds"].unsqueeze(1)
+            decoder_input["state"] = self.decoder.reorder_state(output["state"], output["prev_word_inds"])
         decoder_input["words"] = words
         caps_padding_mask = (words == self.pad_idx).to(encoded["audio_embeds"].device)
         decoder_input["caps_padding_mask"] = caps_padding_mask
@@ -3,6 +3,7 @@
 import pdb
 import random
 
+import h5py
 import numpy as np
 import torch
 import torch.nn as nn
@@ -10,6 +11,92 @@ import torch.nn as nn
 import utils.score_util as score_util
 from utils.train_util import mean_with_lens
 
+class EncoderOutputCache(object):
+
+    def __init__(self, cache_file: str):
+        """HDF5 store of the outputs of a frozen encoder, keyed by audio_id.
+        Outputs of each clip are computed (in eval mode, without gradients) the first time the
+        clip is seen and read back afterwards. Sequence outputs ([N, T, E]) are stored without
+        padding, "state" ([num_layers, N, hs]) is stored per clip.
+        Only valid when the input features do not change, i.e. without data augmentation.
+
+        Args:
+            cache_file (str): HDF5 file to store encoder outputs, overwritten if exists
+        """
+        self.cache_file = cache_file
+        self._store = h5py.File(cache_file, "w")
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, audio_id):
+        return audio_id in self._store
+
+    def __len__(self):
+        return len(self._store)
+
+    def _write(self, audio_id, encoded, i):
+        group = self._store.create_group(audio_id)
+        lens = torch.as_tensor(encoded["audio_embeds_lens"])
+        length = int(lens[i])
+        group.attrs["audio_embeds_lens"] = length
+        for key, value in encoded.items():
+            if key == "audio_embeds_lens":
+                continue
+            if value is None:
+                group.attrs["none_" + key] = True
+                continue
+            if key == "state":
+                value = value[:, i]
+            elif value.dim() == 3:
+                value = value[i, :length]
+            else:
+                value = value[i]
+            if value.is_floating_point(): # outputs under autocast may be bf16, which numpy lacks
+                value = value.float()
+            group.create_dataset(key, data=value.cpu().numpy())
+
+    def _read(self, audio_ids, device):
+        groups = [self._store[audio_id] for audio_id in audio_ids]
+        lens = torch.as_tensor([group.attrs["audio_embeds_lens"] for group in groups])
+        encoded = {"audio_embeds_lens": lens}
+        for key in groups[0].attrs:
+            if key.startswith("none_"):
+                encoded[key[len("none_"):]] = None
+        for key in groups[0].keys():
+            values = [torch.as_tensor(group[key][()]) for group in groups]
+            if key == "state":
+                value = torch.stack(values, dim=1)
+            elif values[0].dim() == 2:
+                value = torch.nn.utils.rnn.pad_sequence(values, batch_first=True)
+            else:
+                value = torch.stack(values)
+            encoded[key] = value.to(device)
+        return encoded
+
+    def encode(self, encoder, feats, feat_lens, audio_ids):
+        missing = {}
+        for i, audio_id in enumerate(audio_ids):
+            if audio_id not in self._store and audio_id not in missing:
+                missing[audio_id] = i
+        self.misses += len(missing)
+        self.hits += len(audio_ids) - len(missing)
+        if missing:
+            idxs = torch.as_tensor(list(missing.values()))
+            lens = torch.as_tensor(feat_lens)[idxs]
+            training = encoder.training
+            encoder.eval()
+            with torch.no_grad():
+                encoded = encoder(feats[idxs.to(feats.device)][:, :int(lens.max())], lens)
+            encoder.train(training)
+            for i, audio_id in enumerate(missing):
+                self._write(audio_id, encoded, i)
+        return self._read(audio_ids, feats.device)
+
+    def close(self):
+        if self._store:
+            self._store.close()
+
+
 class CaptionModel(nn.Module):
     """
     Encoder-decoder captioning model.
@@ -33,9 +120,12 @@ class CaptionModel(nn.Module):
                 """number of layers not compatible while use hidden!
                 please either set use_hidden as False or use the same number of layers"""
 
-        if "freeze_encoder" in kwargs and kwargs["freeze_encoder"]:
+        self.freeze_encoder = "freeze_encoder" in kwargs and kwargs["freeze_encoder"]
+        if self.freeze_encoder:
             for param in self.encoder.parameters():
                 param.requires_grad = False
+        # set by the runner for decoder-only training, see `EncoderOutputCache`
+        self.encoder_cache = None
 
     @classmethod
     def set_index(cls, start_idx, end_idx):
@@ -49,10 +139,20 @@ class CaptionModel(nn.Module):
             state: rnn style hidden states, [num_dire * num_layers, N, hs_enc]
             audio_embeds_lens: [N,] 
         }
+        in training, when `caption_audio_idxs` is given, `caps` come from an audio-level batch: each
+        clip is encoded once and `encoded` is expanded to its captions by `caption_audio_idxs`;
+        when `audio_ids` is given and `encoder_cache` is set, encoder outputs are read from the cache
         """
         if len(input) == 4:
             feats, feat_lens, caps, cap_lens = input
-            encoded = self.encoder(feats, feat_lens)
+            caption_audio_idxs = kwargs.pop("caption_audio_idxs", None)
+            audio_ids = kwargs.pop("audio_ids", None)
+            if audio_ids is not None and self.encoder_cache is not None:
+                encoded = self.encoder_cache.encode(self.encoder, feats, feat_lens, audio_ids)
+            else:
+                encoded = self.encoder(feats, feat_lens)
+            if caption_audio_idxs is not None:
+                encoded = self.expand_encoded(encoded, caption_audio_idxs)
             output = self.train_forward(encoded, caps, cap_lens, **kwargs)
         elif len(input) == 2:
             feats, feat_lens = input
@@ -63,6 +163,20 @@ class CaptionModel(nn.Module):
 
         return output
 
+    @staticmethod
+    def expand_encoded(encoded, idxs):
+        """Select (with repetition) the clips `idxs` of `encoded`"""
+        expanded = {}
+        for key, value in encoded.items():
+            if value is None:
+                expanded[key] = None
+            elif key == "state": # rnn style hidden states, [num_dire * num_layers, N, hs_enc]
+                expanded[key] = value[:, idxs.to(value.device)]
+            else:
+                value = torch.as_tensor(value)
+                expanded[key] = value[idxs.to(value.device)]
+        return expanded
+
     def prepare_output(self, encoded, output, max_length):
         N = encoded["audio_embeds"].size(0)
         output["seqs"] = torch.empty(N, max_length, dtype=torch.long).fill_(self.end_idx)
@@ -91,13 +205,14 @@ class CaptionModel(nn.Module):
         max_length = kwargs.get("max_length", self.max_length)
         if method == "beam":
             beam_size = kwargs.get("beam_size", 5)
-            return self.beam_search(encoded, max_length, beam_size)
+            return self.beam_search(encoded, max_length, beam_size,
+                                    length_penalty=kwargs.get("length_penalty", 0.0))
         return self.stepwise_forward(encoded, None, None, **kwargs) 
 
     def stepwise_forward(self, encoded, caps, cap_lens, **kwargs):
         """Step-by-step decoding, when `caps` is provided, it means teacher forcing training"""
         if cap_lens is not None: # scheduled sampling training
-            max_length = max(cap_lens) - 1
+            max_length = int(max(cap_lens)) - 1
         else: # inference
             max_length = kwargs.get("max_length", self.max_length)
         decoder_input = {}
@@ -137,7 +252,8 @@ class CaptionModel(nn.Module):
             decoder_input["enc_mem"] = encoded["audio_embeds_pooled"].unsqueeze(1)
             w_t = torch.tensor([self.start_idx,] * output["seqs"].size(0)).long()
         else:
-            w_t = output["seqs"][:, t - 1]
+            # copied since `seqs` is modified in place later while the embedding keeps its input for backward
+            w_t = output["seqs"][:, t - 1].clone()
             if caps is not None and random.random() < kwargs["ss_ratio"]: # training, scheduled sampling
                 w_t = caps[:, t]
             decoder_input["state"] = output["state"]
@@ -173,60 +289,73 @@ class CaptionModel(nn.Module):
         # sampled_logprobs: [N,], w_t: [N,]
         return {"w_t": w_t, "probs": sampled_logprobs}
 
-    def beam_search(self, encoded, max_length, beam_size):
+    def beam_search(self, encoded, max_length, beam_size, **kwargs):
+        """Batched beam search, the batch and beam dimensions are folded together
+        as N * beam_size rows: row `n * beam_size + b` is the b-th beam of the n-th clip"""
+        length_penalty = kwargs.get("length_penalty", 0.0)
+        N = encoded["audio_embeds"].size(0)
         output = {}
         self.prepare_output(encoded, output, max_length)
-        # instance by instance beam seach
-        for i in range(encoded["audio_embeds"].size(0)):
-            output_i = {}
-            self.prepare_beamsearch_output(output_i, beam_size, encoded, max_length)
-            decoder_input = {}
-            for t in range(max_length):
-                output_t = self.beamsearch_step(decoder_input, encoded, output_i, i, t, beam_size)
-                logits_t = output_t["logits"].squeeze(1)
-                logprobs_t = torch.log_softmax(logits_t, dim=1)
-                logprobs_t = output_i["top_k_logprobs"].unsqueeze(1).expand_as(logprobs_t) + logprobs_t
-                if t == 0: # for the first step, all k seqs will have the same probs
-                    top_k_logprobs, top_k_words = logprobs_t[0].topk(beam_size, 0, True, True)
-                else: # unroll and find top logprobs, and their unrolled indices
-                    top_k_logprobs, top_k_words = logprobs_t.view(-1).topk(beam_size, 0, True, True)
-                output_i["top_k_logprobs"] = top_k_logprobs
-                output_i["prev_word_inds"] = top_k_words // self.vocab_size  # [beam_size,]
-                output_i["next_word_inds"] = top_k_words % self.vocab_size  # [beam_size,]
-                if t == 0:
-                    output_i["seqs"] = output_i["next_word_inds"].unsqueeze(1)
-                else:
-                    output_i["seqs"] = torch.cat([output_i["seqs"][output_i["prev_word_inds"]], 
-                                                  output_i["next_word_inds"].unsqueeze(1)], dim=1)
-                self.beamsearch_process_step(output_i, output_t)
-            self.beamsearch_process(output, output_i, i)
+        output_b = {}
+        self.prepare_beamsearch_output(output_b, beam_size, encoded, max_length)
+        decoder_input = {}
+        # offsets of each clip's first beam in the folded rows
+        beam_offsets = torch.arange(N, device=output_b["top_k_logprobs"].device).unsqueeze(1) * beam_size
+        for t in range(max_length):
+            output_t = self.beamsearch_step(decoder_input, encoded, output_b, t, beam_size)
+            logits_t = output_t["logits"].squeeze(1)
+            logprobs_t = torch.log_softmax(logits_t, dim=1) # [N * beam_size, vocab_size]
+            if t > 0: # finished hypotheses can only be extended by <end>, with no extra cost
+                finished = output_b["finished"]
+                logprobs_t[finished] = float("-inf")
+                logprobs_t[finished, self.end_idx] = 0
+            logprobs_t = output_b["top_k_logprobs"].unsqueeze(1).expand_as(logprobs_t) + logprobs_t
+            logprobs_t = logprobs_t.view(N, -1)
+            if t == 0: # for the first step, all k seqs of a clip have the same probs
+                logprobs_t = logprobs_t[:, :self.vocab_size]
+            # unroll and find top logprobs, and their unrolled indices
+            top_k_logprobs, top_k_words = logprobs_t.topk(beam_size, 1, True, True) # [N, beam_size]
+            output_b["top_k_logprobs"] = top_k_logprobs.view(-1)
+            prev_word_inds = top_k_words // self.vocab_size + beam_offsets
+            output_b["prev_word_inds"] = prev_word_inds.view(-1) # [N * beam_size,]
+            output_b["next_word_inds"] = (top_k_words % self.vocab_size).view(-1) # [N * beam_size,]
+            if t == 0:
+                output_b["seqs"] = output_b["next_word_inds"].unsqueeze(1)
+            else:
+                output_b["seqs"] = torch.cat([output_b["seqs"][output_b["prev_word_inds"]],
+                                              output_b["next_word_inds"].unsqueeze(1)], dim=1)
+            output_b["finished"] = output_b["next_word_inds"] == self.end_idx
+            self.beamsearch_process_step(output_b, output_t)
+            if output_b["finished"].all():
+                break
+        self.beamsearch_select(output_b, N, beam_size, length_penalty)
+        self.beamsearch_process(output, output_b)
         return output
 
     def prepare_beamsearch_output(self, output, beam_size, encoded, max_length):
-        output["top_k_logprobs"] = torch.zeros(beam_size).to(encoded["audio_embeds"].device)
+        N = encoded["audio_embeds"].size(0)
+        output["top_k_logprobs"] = torch.zeros(N * beam_size).to(encoded["audio_embeds"].device)
 
-    def beamsearch_step(self, decoder_input, encoded, output, i, t, beam_size):
-        self.prepare_beamsearch_decoder_input(decoder_input, encoded, output, i, t, beam_size)
+    def beamsearch_step(self, decoder_input, encoded, output, t, beam_size):
+        self.prepare_beamsearch_decoder_input(decoder_input, encoded, output, t, beam_size)
         output_t = self.decoder(**decoder_input)
         # decoder_input["state"] = output_t["states"]
         return output_t
 
-    def prepare_beamsearch_decoder_input(self, decoder_input, encoded, output, i, t, beam_size):
+    def prepare_beamsearch_decoder_input(self, decoder_input, encoded, output, t, beam_size):
         if t == 0:
-            enc_mem = encoded["audio_embeds_pooled"][i].reshape(1, -1).repeat(beam_size, 1)
-            enc_mem = enc_mem.unsqueeze(1) # [beam_size, 1, enc_mem_size]
+            enc_mem = encoded["audio_embeds_pooled"].repeat_interleave(beam_size, 0)
+            enc_mem = enc_mem.unsqueeze(1) # [N * beam_size, 1, enc_mem_size]
             decoder_input["enc_mem"] = enc_mem
 
-            # state = encoded["audio_embeds_pooled"][i]
-            # decoder_input["state"] = state.reshape(1, -1).repeat(beam_size, 1).unsqueeze(0)
             state = encoded["state"]
             if state is not None: # state: [num_layers, N, enc_hid_size]
-                state = state[:, i, :].unsqueeze(1).repeat(1, beam_size, 1)
-                state = state.contiguous() # [num_layers, beam_size, enc_hid_size]
+                state = state.repeat_interleave(beam_size, 1)
+                state = state.contiguous() # [num_layers, N * beam_size, enc_hid_size]
 
             decoder_input["state"] = state
 
-            w_t = torch.tensor([self.start_idx,] * beam_size).long()
+            w_t = torch.tensor([self.start_idx,] * enc_mem.size(0)).long()
         else:
             w_t = output["next_word_inds"]
             decoder_input["state"] = output["state"][:, output["prev_word_inds"], :].contiguous()
@@ -235,8 +364,19 @@ class CaptionModel(nn.Module):
     def beamsearch_process_step(self, output, output_t):
         output["state"] = output_t["states"]
 
-    def beamsearch_process(self, output, output_i, i):
-        output["seqs"][i] = output_i["seqs"][0]
+    def beamsearch_select(self, output, N, beam_size, length_penalty=0.0):
+        """Pick the best hypothesis of each clip, scores are normalized by `length ** length_penalty`"""
+        seqs = output["seqs"]
+        is_end = (seqs == self.end_idx).long()
+        # hypothesis length: tokens up to (and including) the first <end>
+        lengths = ((is_end.cumsum(1) - is_end) == 0).sum(1).float()
+        scores = output["top_k_logprobs"] / lengths.to(output["top_k_logprobs"].device) ** length_penalty
+        best = scores.view(N, beam_size).argmax(1)
+        output["best_inds"] = best + torch.arange(N, device=best.device) * beam_size # [N,]
+
+    def beamsearch_process(self, output, output_b):
+        seqs = output_b["seqs"][output_b["best_inds"]]
+        output["seqs"][:, :seqs.size(1)] = seqs
 
 
 class CaptionSentenceModel(CaptionModel):
@@ -34,43 +34,115 @@ class BaseRunner(object):
             torch.backends.cudnn.deterministic = True
             torch.backends.cudnn.benchmark = False
         self.device = torch.device(device)
+        # computes features from waveforms when the config has `frontend_args`
+        self.frontend = None
+        # set by `_init_distributed` in DDP training
+        self.rank = 0
+        self.local_rank = 0
+        self.world_size = 1
+
+    def _init_distributed(self, config, local_rank=None):
+        """Joins the process group of DDP training. Processes are launched by `torchrun`, which
+        sets LOCAL_RANK, or `torch.distributed.launch`, which passes `--local_rank`. The backend
+        is nccl on GPUs and gloo on CPU-only nodes, unless `dist_backend` is given."""
+        if local_rank is None:
+            local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        backend = config.get("dist_backend", "nccl" if torch.cuda.is_available() else "gloo")
+        torch.distributed.init_process_group(backend=backend)
+        self.rank = torch.distributed.get_rank()
+        self.local_rank = local_rank
+        self.world_size = torch.distributed.get_world_size()
+        if backend == "nccl":
+            torch.cuda.set_device(self.local_rank)
+            self.device = torch.device("cuda", self.local_rank)
+        else:
+            self.device = torch.device("cpu")
+            # torchrun defaults OMP_NUM_THREADS to 1, share the cores of the node among its processes
+            local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+            torch.set_num_threads(config.get(
+                "num_threads", max(1, (os.cpu_count() or 1) // local_world_size)))
+
+    def _get_ddp_model(self, model):
+        if self.device.type == "cuda":
+            return torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=[self.local_rank,], output_device=self.local_rank,
+                find_unused_parameters=True)
+        return torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+
+    @staticmethod
+    def _all_gather_object(obj):
+        """[obj of rank 0, obj of rank 1, ...], [obj,] without DDP"""
+        if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+            return [obj,]
+        objs = [None] * torch.distributed.get_world_size()
+        torch.distributed.all_gather_object(objs, obj)
+        return objs
+
+    def _gather_predictions(self, key2pred):
+        """Merges `key2pred` of all ranks in place, so that every rank holds all predictions"""
+        for rank_key2pred in self._all_gather_object(key2pred):
+            key2pred.update(rank_key2pred)
+
+    @staticmethod
+    def _broadcast_object(obj, src=0):
+        if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+            return obj
+        objs = [obj]
+        torch.distributed.broadcast_object_list(objs, src=src)
+        return objs[0]
 
     def _get_dataloaders(self, config, vocabulary):
         augments = train_util.parse_augments(config["augments"])
         if config["distributed"]:
             config["dataloader_args"]["batch_size"] //= self.world_size
+        dataloader_args = dict(config["dataloader_args"])
+        # options of preloading training features into shared memory
+        preload_features = dataloader_args.pop("preload_features", False)
+        preload_dtype = dataloader_args.pop("preload_dtype", "float32")
+        # number of decoded waveforms cached by each worker when features are computed on the fly
+        waveform_cache_size = dataloader_args.pop("waveform_cache_size", 256)
+        if "frontend_args" in config:
+            assert not preload_features, "features computed on the fly cannot be preloaded"
+        # options of training batches: length-bucketed batching or audio-level batching
+        sampler_args = {
+            "bucket_sampler": dataloader_args.pop("bucket_sampler", False),
+            "max_frames": dataloader_args.pop("max_frames", None),
+            "bucket_size": dataloader_args.pop("bucket_size", 100),
+            "audio_level_batch": dataloader_args.pop("audio_level_batch", False)
+        }
+        sampler_args["waveform_cache_size"] = waveform_cache_size
 
         if "caption_file" in config:
-            h5file_df = pd.read_csv(config["h5_csv"], sep="\t")
-            h5file_dict = dict(zip(h5file_df["audio_id"], h5file_df["hdf5_path"]))
+            h5file_dict = self._get_feature_dict(config, config["h5_csv"])
             caption_info = json.load(open(config["caption_file"], "r"))["audios"]
             val_size = int(len(caption_info) * (1 - config["train_percent"] / 100.))
             val_audio_idxs = np.random.choice(len(caption_info), val_size, replace=False)
             train_audio_idxs = [idx for idx in range(len(caption_info)) if idx not in val_audio_idxs]
-            train_dataset = ac_dataset.CaptionDataset(
-                h5file_dict=h5file_dict,
-                caption_info=caption_info,
-                vocabulary=vocabulary,
-                transform=augments
-            )
-            # TODO DistributedCaptionSampler
-            # train_sampler = torch.utils.data.DistributedSampler(train_dataset) if config["distributed"] else None
-            train_sampler = ac_dataset.CaptionSampler(train_dataset, train_audio_idxs, True)
-            train_dataloader = torch.utils.data.DataLoader(
-                train_dataset,
-                collate_fn=ac_dataset.collate_fn([0, 1], 1),
-                sampler=train_sampler,
-                **config["dataloader_args"]
-            )
+            feature_store = None
+            if preload_features:
+                feature_store = ac_dataset.FeatureStore(
+                    h5file_dict,
+                    [info["audio_id"] for info in caption_info],
+                    preload_dtype
+                )
+            train_dataset_args = {
+                "h5file_dict": h5file_dict,
+                "caption_info": caption_info,
+                "vocabulary": vocabulary,
+                "transform": augments,
+                "feature_store": feature_store,
+                "caption_file": config["caption_file"]
+            }
+            train_dataloader = self._get_train_dataloader(
+                config, train_dataset_args, train_audio_idxs, dataloader_args, sampler_args)
             val_audio_ids = [caption_info[audio_idx]["audio_id"] for audio_idx in val_audio_idxs]
-            val_dataset = ac_dataset.CaptionEvalDataset(
-                h5file_dict={audio_id: h5file_dict[audio_id] for audio_id in val_audio_ids}
-            )
-            val_dataloader = torch.utils.data.DataLoader(
-                val_dataset,
-                collate_fn=ac_dataset.collate_fn([1]),
-                **config["dataloader_args"]
+            val_dataset = self._get_eval_dataset(
+                config,
+                {audio_id: h5file_dict[audio_id] for audio_id in val_audio_ids},
+                feature_store=feature_store,
+                waveform_cache_size=waveform_cache_size
             )
+            val_dataloader = self._get_val_dataloader(config, val_dataset, dataloader_args)
             train_key2refs = {}
             for audio_idx in train_audio_idxs:
                 audio_id = caption_info[audio_idx]["audio_id"]
@@ -84,35 +156,33 @@ class BaseRunner(object):
                 for caption in caption_info[audio_idx]["captions"]:
                     val_key2refs[audio_id].append(caption["token" if config["zh"] else "caption"])
         else:
-            train_h5file_df = pd.read_csv(config["train_h5_csv"], sep="\t")
-            train_h5file_dict = dict(zip(train_h5file_df["audio_id"], train_h5file_df["hdf5_path"]))
+            train_h5file_dict = self._get_feature_dict(config, config["train_h5_csv"])
             train_caption_info = json.load(open(config["train_caption_file"], "r"))["audios"]
-            val_h5file_df = pd.read_csv(config["val_h5_csv"], sep="\t")
-            val_h5file_dict = dict(zip(val_h5file_df["audio_id"], val_h5file_df["hdf5_path"]))
+            val_h5file_dict = self._get_feature_dict(config, config["val_h5_csv"])
             val_caption_info = json.load(open(config["val_caption_file"], "r"))["audios"]
-            train_dataset = ac_dataset.CaptionDataset(
-                h5file_dict=train_h5file_dict,
-                caption_info=train_caption_info,
-                vocabulary=vocabulary,
-                transform=augments
-            )
-            # TODO DistributedCaptionSampler
-            # train_sampler = torch.utils.data.DistributedSampler(train_dataset) if config["distributed"] else None
-            train_sampler = ac_dataset.CaptionSampler(train_dataset, shuffle=True)
-            train_dataloader = torch.utils.data.DataLoader(
-                train_dataset,
-                collate_fn=ac_dataset.collate_fn([0, 1], 1),
-                sampler=train_sampler,
-                **config["dataloader_args"]
-            )
-            val_dataset = ac_dataset.CaptionEvalDataset(
-                h5file_dict=val_h5file_dict
-            )
-            val_dataloader = torch.utils.data.DataLoader(
-                val_dataset,
-                collate_fn=ac_dataset.collate_fn([1]),
-                **config["dataloader_args"]
+            feature_store = None
+            if preload_features:
+                feature_store = ac_dataset.FeatureStore(
+                    train_h5file_dict,
+                    [info["audio_id"] for info in train_caption_info],
+                    preload_dtype
+                )
+            train_dataset_args = {
+                "h5file_dict": train_h5file_dict,
+                "caption_info": train_caption_info,
+                "vocabulary": vocabulary,
+                "transform": augments,
+                "feature_store": feature_store,
+                "caption_file": config["train_caption_file"]
+            }
+            train_dataloader = self._get_train_dataloader(
+                config, train_dataset_args, None, dataloader_args, sampler_args)
+            val_dataset = self._get_eval_dataset(
+                config,
+                val_h5file_dict,
+                waveform_cache_size=waveform_cache_size
             )
+            val_dataloader = self._get_val_dataloader(config, val_dataset, dataloader_args)
             train_key2refs = {}
             for audio_idx in range(len(train_caption_info)):
                 audio_id = train_caption_info[audio_idx]["audio_id"]
@@ -133,6 +203,126 @@ class BaseRunner(object):
             "val_key2refs": val_key2refs
         }
 
+    @staticmethod
+    def _get_val_dataloader(config, val_dataset, dataloader_args):
+        # validation clips are split across ranks, predictions are gathered by `_gather_predictions`
+        val_sampler = None
+        if config["distributed"]:
+            val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+        if config.get("async_validation", False):
+            # the loader is iterated in a background thread, its own generator keeps the
+            # global random state of training untouched
+            dataloader_args = dict(dataloader_args, generator=torch.Generator())
+        return torch.utils.data.DataLoader(
+            val_dataset,
+            collate_fn=ac_dataset.collate_fn([1]),
+            sampler=val_sampler,
+            **dataloader_args
+        )
+
+    @staticmethod
+    def _get_feature_dict(config, csv_file):
+        """<audio_id>: <hdf5_path> of a feature csv, or <audio_id>: <file_name> of a wav csv
+        when features are computed on the fly (`frontend_args` in config)"""
+        df = pd.read_csv(csv_file, sep="\t")
+        column = "file_name" if "frontend_args" in config else "hdf5_path"
+        return dict(zip(df["audio_id"], df[column]))
+
+    @staticmethod
+    def _get_eval_dataset(config, feature_dict, feature_store=None, waveform_cache_size=256):
+        if "frontend_args" in config:
+            return ac_dataset.CaptionWaveformEvalDataset(
+                feature_dict, config["frontend_args"]["sample_rate"], waveform_cache_size)
+        return ac_dataset.CaptionEvalDataset(h5file_dict=feature_dict, feature_store=feature_store)
+
+    @staticmethod
+    def _get_frontend(config):
+        if "frontend_args" not in config:
+            return None
+        import models
+        return models.LogmelFrontEnd(**config["frontend_args"])
+
+    def _get_train_dataloader(self, config, train_dataset_args, audio_subset_indices,
+                              dataloader_args, sampler_args):
+        if "frontend_args" in config:
+            assert not sampler_args["audio_level_batch"] and not sampler_args["bucket_sampler"], \
+                "audio-level batching and bucket sampler need HDF5 features"
+            assert not config["augments"], "augments are applied to HDF5 features only"
+            train_dataset = ac_dataset.CaptionWaveformDataset(
+                wav_dict=train_dataset_args["h5file_dict"],
+                caption_info=train_dataset_args["caption_info"],
+                vocabulary=train_dataset_args["vocabulary"],
+                sample_rate=config["frontend_args"]["sample_rate"],
+                cache_size=sampler_args["waveform_cache_size"],
+                caption_file=train_dataset_args["caption_file"])
+            train_sampler = self._get_caption_sampler(config, train_dataset, audio_subset_indices)
+            dataloader_args = dict(dataloader_args)
+            if dataloader_args.get("num_workers", 0) > 0:
+                # keep the waveform caches of workers across epochs
+                dataloader_args.setdefault("persistent_workers", True)
+            return torch.utils.data.DataLoader(
+                train_dataset,
+                collate_fn=ac_dataset.collate_fn([0, 1], 1),
+                sampler=train_sampler,
+                **dataloader_args
+            )
+        if sampler_args["audio_level_batch"]:
+            # a batch consists of `batch_size` clips with all their captions
+            assert not sampler_args["bucket_sampler"], \
+                "audio-level batching and bucket sampler cannot be used together"
+            train_dataset = ac_dataset.CaptionAudioDataset(
+                audio_subset_indices=audio_subset_indices, **train_dataset_args)
+            if config["distributed"]:
+                train_sampler = torch.utils.data.distributed.DistributedSampler(
+                    train_dataset, shuffle=True, seed=self.seed)
+            else:
+                train_sampler = torch.utils.data.RandomSampler(train_dataset)
+            return torch.utils.data.DataLoader(
+                train_dataset,
+                collate_fn=ac_dataset.audio_collate_fn(),
+                sampler=train_sampler,
+                **dataloader_args
+            )
+        if "distill_args" in config:
+            # with the soft targets of the teachers for each caption
+            train_dataset = ac_dataset.CaptionDistillDataset(
+                soft_target_file=config["distill_args"]["soft_targets"], **train_dataset_args)
+        else:
+            train_dataset = ac_dataset.CaptionDataset(**train_dataset_args)
+        if sampler_args["bucket_sampler"]:
+            dataloader_args = dict(dataloader_args)
+            sampler_kwargs = {
+                "batch_size": dataloader_args.pop("batch_size", 1),
+                "max_frames": sampler_args["max_frames"],
+                "bucket_size": sampler_args["bucket_size"],
+                "drop_last": dataloader_args.pop("drop_last", False)
+            }
+            if config["distributed"]:
+                train_batch_sampler = ac_dataset.CaptionDistributedBucketBatchSampler(
+                    train_dataset, audio_subset_indices, seed=self.seed, **sampler_kwargs)
+            else:
+                train_batch_sampler = ac_dataset.CaptionBucketBatchSampler(
+                    train_dataset, audio_subset_indices, seed=self.seed, **sampler_kwargs)
+            return torch.utils.data.DataLoader(
+                train_dataset,
+                collate_fn=ac_dataset.collate_fn([0, 1], 1),
+                batch_sampler=train_batch_sampler,
+                **dataloader_args
+            )
+        train_sampler = self._get_caption_sampler(config, train_dataset, audio_subset_indices)
+        return torch.utils.data.DataLoader(
+            train_dataset,
+            collate_fn=ac_dataset.collate_fn([0, 1], 1),
+            sampler=train_sampler,
+            **dataloader_args
+        )
+
+    def _get_caption_sampler(self, config, train_dataset, audio_subset_indices):
+        if config["distributed"]:
+            return ac_dataset.CaptionDistributedSampler(
+                train_dataset, audio_subset_indices, shuffle=True, seed=self.seed)
+        return ac_dataset.CaptionSampler(train_dataset, audio_subset_indices, True)
+
     @staticmethod
     def _get_model(config, vocab_size):
         raise NotImplementedError
@@ -158,7 +348,9 @@ class BaseRunner(object):
         raise NotImplementedError
 
     @staticmethod
-    def _eval_prediction(key2refs, key2pred, scorers, pretokenized=False):
+    def _eval_prediction(key2refs, key2pred, scorers, pretokenized=False, tokenizer="python"):
+        """tokenizer: `python` for the in-process PTB tokenizer (`utils.ptb_tokenizer`, tokenized
+        captions are cached), `java` for the Stanford PTBTokenizer of pycocoevalcap"""
         if not pretokenized:
             refs4eval = {}
             for key, refs in key2refs.items():
@@ -180,7 +372,10 @@ class BaseRunner(object):
                         "caption": pred
                     })
 
-            from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+            if tokenizer == "java":
+                from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+            else:
+                from utils.ptb_tokenizer import PTBTokenizer
 
             tokenizer = PTBTokenizer()
             key2refs = tokenizer.tokenize(refs4eval)
@@ -193,6 +388,21 @@ class BaseRunner(object):
         return output
 
 
+    @staticmethod
+    def _get_eval_scorers(zh, spice_cache_dir=None):
+        """Scorers of `evaluate`, METEOR runs in a Java process kept for the whole process and
+        SPICE results are cached in `spice_cache_dir` (see `utils.scorer_service`)"""
+        from pycocoevalcap.bleu.bleu import Bleu
+        from pycocoevalcap.rouge.rouge import Rouge
+        from pycocoevalcap.cider.cider import Cider
+        from utils.scorer_service import get_meteor, CachedSpice
+
+        scorers = [Bleu(n=4, zh=zh), Rouge(zh=zh), Cider(zh=zh)]
+        if not zh:
+            scorers.append(get_meteor())
+            scorers.append(CachedSpice(spice_cache_dir))
+        return scorers
+
     def evaluate(self,
                  experiment_path: str,
                  h5file_csv: str,
@@ -201,7 +411,10 @@ class BaseRunner(object):
                  caption_output: str = "eval_output.json",
                  score_output: str = "scores.txt",
                  **kwargs):
-        """kwargs: {'max_length': int, 'method': str, 'beam_size': int}"""
+        """kwargs: {'max_length': int, 'method': str, 'beam_size': int, 'length_penalty': float,
+                    'tokenizer': 'python' | 'java', 'spice_cache_dir': str}"""
+        tokenizer = kwargs.pop("tokenizer", "python")
+        spice_cache_dir = kwargs.pop("spice_cache_dir", None)
         experiment_path = Path(experiment_path)
         dump = torch.load(str(experiment_path / "saved.pth"),
                           map_location="cpu")
@@ -215,9 +428,11 @@ class BaseRunner(object):
         zh = config["zh"]
         model = model.to(self.device)
 
-        h5file_df = pd.read_csv(h5file_csv, sep="\t")
-        h5file_dict = dict(zip(h5file_df["audio_id"], h5file_df["hdf5_path"]))
-        dataset = ac_dataset.CaptionEvalDataset(h5file_dict)
+        self.frontend = self._get_frontend(config)
+        if self.frontend is not None:
+            self.frontend = self.frontend.to(self.device)
+        h5file_dict = self._get_feature_dict(config, h5file_csv)
+        dataset = self._get_eval_dataset(config, h5file_dict)
         dataloader = torch.utils.data.DataLoader(
             dataset,
             shuffle=False,
@@ -262,17 +477,8 @@ class BaseRunner(object):
             })
         json.dump({"predictions": pred_data}, open(experiment_path / caption_output, "w"), indent=4)
 
-        from pycocoevalcap.bleu.bleu import Bleu
-        from pycocoevalcap.rouge.rouge import Rouge
-        from pycocoevalcap.cider.cider import Cider
-        from pycocoevalcap.meteor.meteor import Meteor
-        from pycocoevalcap.spice.spice import Spice
-
-        scorers = [Bleu(n=4, zh=zh), Rouge(zh=zh), Cider(zh=zh)]
-        if not zh:
-            scorers.append(Meteor())
-            scorers.append(Spice())
-        scores_output = self._eval_prediction(key2refs, key2pred, scorers)
+        scorers = self._get_eval_scorers(zh, spice_cache_dir)
+        scores_output = self._eval_prediction(key2refs, key2pred, scorers, tokenizer=tokenizer)
 
         with open(str(experiment_path / score_output), "w") as f:
             spider = 0
@@ -307,7 +513,7 @@ class BaseRunner(object):
                       feature_scp: str,
                       output: str="test_prediction.csv",
                       **kwargs):
-        """kwargs: {'max_length': int, 'method': str, 'beam_size': int}"""
+        """kwargs: {'max_length': int, 'method': str, 'beam_size': int, 'length_penalty': float}"""
 
         dump = torch.load(str(Path(experiment_path) / "saved.pth"), map_location="cpu")
         # Some scaler (sklearn standardscaler)
@@ -356,61 +562,79 @@ class BaseRunner(object):
         pred_df = pd.DataFrame(predictions)
         pred_df.to_csv(str(Path(experiment_path) / output), index=False)
 
-    def ensemble(self,
-                 exp_path_file: str,
-                 feature_file: str,
-                 feature_scp: str,
-                 prediction: str,
-                 dcase_format: bool = False,
-                 label: str = None,
-                 score_output: str = "scores.txt",
-                 **kwargs):
-        from models.seq_train_model import ScstWrapper
-
-        config = None
-        vocabulary = None
-        scaler = None
-        zh = None
-        models = []
+    def _load_ensemble_members(self, exp_path_file):
+        """Models of the experiments listed in `exp_path_file` (one per line, `#` for comments),
+        returned with the configuration of the first experiment"""
         exp_paths = []
         with open(exp_path_file, "r") as reader:
             for line in reader.readlines():
-                if not line.startswith("#"):
+                if line.strip() and not line.startswith("#"):
                     exp_paths.append(line.strip())
 
+        config = None
+        vocabulary = None
+        models = []
         for path in exp_paths:
-            dump = torch.load(str(Path(path) / "saved.pth"), map_location="cpu")
+            member_config = train_util.parse_config_or_kwargs(Path(path) / "config.yaml")
             if config is None:
-                config = dump["config"]
-                vocabulary = torch.load(config["vocab_file"])
-                scaler = dump["scaler"]
-                zh = config["zh"]
-            model = self._get_model(config, vocabulary)
-            model.load_state_dict(dump["model"])
-            if isinstance(model, ScstWrapper):
-                model = model.model
-            model = model.to(self.device)
+                config = member_config
+                vocabulary = pickle.load(open(config["vocab_file"], "rb"))
+            dump = torch.load(str(Path(path) / "saved.pth"), map_location="cpu")
+            model = self._get_model(member_config, len(vocabulary))
+            model_state_dict = dump["model"]
+            if "modelwrapper" in member_config: # e.g. ScstWrapper, the captioning model is `model.model`
+                model_state_dict = {key[len("model."):]: value for key, value
+                                    in model_state_dict.items() if key.startswith("model.")}
+            model.load_state_dict(model_state_dict)
             models.append(model)
+        return models, config
 
-        dataset = SJTUDatasetEval(
-            feature=feature_file,
-            eval_scp=feature_scp,
-            transform=None if scaler is None else [scaler.transform]
-        )
+    def ensemble(self,
+                 exp_path_file: str,
+                 h5file_csv: str,
+                 caption_file: str = None,
+                 caption_output: str = "ensemble_output.json",
+                 score_output: str = "ensemble_scores.txt",
+                 **kwargs):
+        """Decode with an ensemble of the experiments listed in `exp_path_file` (one per line)
+        kwargs: {'max_length': int, 'method': str, 'beam_size': int, 'length_penalty': float, 'combine': str,
+                 'num_workers': int, 'batch_size': int, 'tokenizer': str, 'spice_cache_dir': str}
+        combine: how word distributions of members are merged, `mean_prob` (default) | `log_linear`
+        num_workers: members decoded in parallel, see `EnsembleCaptionModel`
+        tokenizer: `python` (default) | `java`, see `_eval_prediction`
+        spice_cache_dir: cache of SPICE results, see `utils.scorer_service.CachedSpice`
+        """
+        tokenizer = kwargs.pop("tokenizer", "python")
+        spice_cache_dir = kwargs.pop("spice_cache_dir", None)
+        from models.ensemble_model import EnsembleCaptionModel
+
+        models, config = self._load_ensemble_members(exp_path_file)
+        vocabulary = pickle.load(open(config["vocab_file"], "rb"))
+        zh = config["zh"]
+        model = EnsembleCaptionModel(models,
+                                     combine=kwargs.pop("combine", "mean_prob"),
+                                     num_workers=kwargs.pop("num_workers", None))
+        model = model.to(self.device)
+        model.eval()
+
+        self.frontend = self._get_frontend(config)
+        if self.frontend is not None:
+            self.frontend = self.frontend.to(self.device)
+        h5file_dict = self._get_feature_dict(config, h5file_csv)
+        dataset = self._get_eval_dataset(config, h5file_dict)
         dataloader = torch.utils.data.DataLoader(
             dataset,
             shuffle=False,
-            collate_fn=collate_fn((1,)),
-            batch_size=kwargs.get("batch_size", 32),
-            num_workers=0
+            collate_fn=ac_dataset.collate_fn([1,]),
+            batch_size=kwargs.get("batch_size", 32)
         )
 
         key2pred = {}
-        pred_data = []
 
         def _inference(engine, batch):
             keys = batch[0]
-            output = self._ensemble_batch(models, batch, **kwargs)
+            with torch.no_grad():
+                output = self._forward(model, batch, mode="eval", **kwargs)
             seqs = output["seqs"].cpu().numpy()
             for idx, seq in enumerate(seqs):
                 caption = self._convert_idx2sentence(seq, vocabulary, zh)
@@ -420,240 +644,43 @@ class BaseRunner(object):
         sampler = Engine(_inference)
         pbar.attach(sampler)
         sampler.run(dataloader)
-        
+        model.close()
+
+        pred_data = []
         for key, pred in key2pred.items():
-            if dcase_format:
-                pred_data.append({
-                    "file_name": key,
-                    "caption_predicted": pred[0]
-                })
-            else:
-                pred_data.append({
-                    "filename": key,
-                    "caption": "".join(pred[0]) if zh else pred[0],
-                    "tokens": pred[0] if zh else pred[0].split()
-                })
-        pred_df = pd.DataFrame(pred_data)
-        if dcase_format:
-            pred_df.to_csv(prediction, index=False)
-        else:
-            pred_df.to_json(prediction)
+            pred_data.append({
+                "filename": key,
+                "caption": "".join(pred[0]) if zh else pred[0],
+                "tokens": " ".join(pred[0]) if zh else pred[0] 
+            })
+        json.dump({"predictions": pred_data}, open(caption_output, "w"), indent=4)
 
-        if label is None:
+        if caption_file is None:
             return
 
-        label_df = pd.read_json(label, dtype={"audio_key": str})
-        if zh:
-            key2refs = label_df.groupby("audio_key")["tokens"].apply(list).to_dict()
-        else:
-            key2refs = label_df.groupby("audio_key")["caption"].apply(list).to_dict()
-
-        refs4eval = {}
-        for key, refs in key2refs.items():
-            refs4eval[key] = []
-            for idx, ref in enumerate(refs):
-                refs4eval[key].append({
-                    "audio_id": key,
-                    "id": idx,
-                    "caption": ref
-                })
-
-        preds4eval = {}
-        for key, preds in key2pred.items():
-            preds4eval[key] = []
-            for idx, pred in enumerate(preds):
-                preds4eval[key].append({
-                    "audio_id": key,
-                    "id": idx,
-                    "caption": pred
-                })
-
-        from pycocoevalcap.bleu.bleu import Bleu
-        from pycocoevalcap.rouge.rouge import Rouge
-        from pycocoevalcap.cider.cider import Cider
-        from pycocoevalcap.meteor.meteor import Meteor
-        from pycocoevalcap.spice.spice import Spice
-        from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
-
-        tokenizer = PTBTokenizer()
-        key2refs = tokenizer.tokenize(refs4eval)
-        key2pred = tokenizer.tokenize(preds4eval)
-
-        f = open(score_output, "w")
-
-        scorer = Bleu(n=4, zh=zh)
-        score, scores = scorer.compute_score(key2refs, key2pred)
-        for n in range(4):
-            f.write("Bleu-{}: {:6.3f}\n".format(n + 1, score[n]))
-
-        scorer = Rouge(zh=zh)
-        score, scores = scorer.compute_score(key2refs, key2pred)
-        f.write("ROUGE: {:6.3f}\n".format(score))
-
-        scorer = Cider(zh=zh)
-        score, scores = scorer.compute_score(key2refs, key2pred)
-        f.write("CIDEr: {:6.3f}\n".format(score))
-        cider = score
-
-        if not zh:
-            scorer = Meteor()
-            score, scores = scorer.compute_score(key2refs, key2pred)
-            f.write("Meteor: {:6.3f}\n".format(score))
-
-            scorer = Spice()
-            score, scores = scorer.compute_score(key2refs, key2pred)
-            f.write("Spice: {:6.3f}\n".format(score))
-            spice = score
-            f.write("Spider: {:6.3f}\n".format((cider + spice) / 2))
-
-        # from audiocaptioneval.sentbert.sentencebert import SentenceBert
-        # scorer = SentenceBert(zh=zh)
-        # if caption_embedding_path is not None:
-            # key2ref_embeds = np.load(caption_embedding_path, allow_pickle=True)
-            # score, scores = scorer.compute_score(key2ref_embeds, key2pred)
-        # else:
-            # score, scores = scorer.compute_score(key2refs, key2pred)
-        # f.write("SentenceBert: {:6.3f}\n".format(score))
-
-        from utils.diverse_eval import diversity_evaluate
-        score = diversity_evaluate(pred_df)
-        f.write("Diversity: {:6.3f}\n".format(score))
-
-        f.close()
+        captions = json.load(open(caption_file, "r"))["audios"]
+        key2refs = {}
+        for audio_idx in range(len(captions)):
+            audio_id = captions[audio_idx]["audio_id"]
+            key2refs[audio_id] = []
+            for caption in captions[audio_idx]["captions"]:
+                key2refs[audio_id].append(caption["token" if zh else "caption"])
 
-    def _ensemble_batch(self, models, batch, **kwargs):
-        method = kwargs.get("method", "greedy")
-        max_length = kwargs.get("max_length", 20)
-        start_idx = models[0].start_idx
-        end_idx = models[0].end_idx
-        num_models = len(models)
-        with torch.no_grad():
-            feats = batch[1]
-            feat_lens = batch[-1]
+        scorers = self._get_eval_scorers(zh, spice_cache_dir)
+        scores_output = self._eval_prediction(key2refs, key2pred, scorers, tokenizer=tokenizer)
 
-            feats = feats.float().to(self.device)
-            for model in models:
-                model.eval()
-            
-            encoded = []
-            for model in models:
-                encoded.append(model.encoder(feats, feat_lens))
-
-            if method == "beam":
-                return self._ensemble_batch_beam_search(models, encoded, **kwargs)
-
-            N = feats.shape[0]
-            seqs = torch.empty(N, max_length, dtype=torch.long).fill_(end_idx)
-            
-            decoder_inputs = [{} for _ in range(num_models)]
-            outputs = [{} for _ in range(num_models)]
-
-            for t in range(max_length):
-                # prepare input word (shared by all models)
-                if t == 0:
-                    w_t = torch.tensor([start_idx,] * N).long()
-                else:
-                    w_t = seqs[:, t-1]
-
-                # prepare decoder input
-                if t == 0:
-                    for model_idx, model in enumerate(models):
-                        cur_input = decoder_inputs[model_idx]
-                        cur_input["state"] = model.decoder.init_hidden(N).to(self.device)
-                        cur_input["enc_mem"] = encoded[model_idx]["audio_embeds"]
-                        cur_input["enc_mem_lens"] = encoded[model_idx]["audio_embeds_lens"]
-                else:
-                    for model_idx, model in enumerate(models):
-                        cur_input = decoder_inputs[model_idx]
-                        cur_input["state"] = outputs[model_idx]["states"]
-
-                for model_idx in range(num_models):
-                    decoder_inputs[model_idx]["word"] = w_t.unsqueeze(1)
-
-                # forward each model
-                for model_idx, model in enumerate(models):
-                    outputs[model_idx] = model.decoder(**decoder_inputs[model_idx])
-
-                # ensemble word probabilities and greedy decoder word
-                probs_t = torch.stack(
-                    [torch.softmax(output["logits"].squeeze(1), -1) for output in outputs]).mean(dim=0)
-                sampled_probs, w = torch.max(probs_t.detach(), dim=1)
-                w = w.detach().long()
-                seqs[:, t] = w
-
-                # decide whether to stop
-                unfinished_t = seqs[:, t] != end_idx
-                if t == 0:
-                    unfinished = unfinished_t
-                else:
-                    unfinished *= unfinished_t
-                seqs[:, t][~unfinished] = end_idx
-                if unfinished.sum() == 0:
-                    break
-        return {"seqs": seqs}
-        
-    def _ensemble_batch_beam_search(self, models, encoded, **kwargs):
-        # encoded: [{"audio_embeds": ..., "audio_embeds_lens": ...}, {"audio_embeds": ..., "audio_embeds_lens": ...}, ...]
-        beam_size = kwargs.get("beam_size", 5)
-        N = len(encoded[0]["audio_embeds_lens"])
-        max_length = kwargs.get("max_length", 20)
-        start_idx = models[0].start_idx
-        end_idx = models[0].end_idx
-        vocab_size = models[0].vocab_size
-        num_models = len(models)
-        seqs = torch.empty(N, max_length, dtype=torch.long).fill_(end_idx)
-        
-        decoder_inputs = [{} for _ in range(num_models)]
-        outputs = [{} for _ in range(num_models)]
-        for i in range(N):
-            top_k_logprobs = torch.zeros(beam_size).to(self.device)
-            for t in range(max_length):
-                # prepare input word (shared by all models)
-                if t == 0:
-                    w_t = torch.tensor([start_idx,] * beam_size).long()
-                else:
-                    w_t = next_word_inds
-
-                # prepare decoder input
-                if t == 0:
-                    for model_idx, model in enumerate(models):
-                        cur_input = decoder_inputs[model_idx]
-                        cur_input["state"] = model.decoder.init_hidden(beam_size).to(self.device)
-                        cur_input["enc_mem"] = encoded[model_idx]["audio_embeds"][i].unsqueeze(0).repeat(beam_size, 1, 1)
-                        cur_input["enc_mem_lens"] = encoded[model_idx]["audio_embeds_lens"][i].repeat(beam_size)
-                else:
-                    for model_idx, model in enumerate(models):
-                        cur_input = decoder_inputs[model_idx]
-                        cur_input["state"] = outputs[model_idx]["states"][:, prev_word_inds, :].contiguous()
-
-                for model_idx in range(num_models):
-                    decoder_inputs[model_idx]["word"] = w_t.unsqueeze(1)
-
-                # forward each model
-                for model_idx, model in enumerate(models):
-                    outputs[model_idx] = model.decoder(**decoder_inputs[model_idx])
-
-                # ensemble word probabilities and greedy decoder word
-                probs_t = torch.stack(
-                    [torch.softmax(output["logits"].squeeze(1), -1) for output in outputs]).mean(dim=0)
-
-                # merge current probability with previous timesteps to select words with the highest probs
-                logprobs_t = torch.log(probs_t)
-                logprobs_t = top_k_logprobs.unsqueeze(1).expand_as(logprobs_t) + logprobs_t
-                if t == 0: # for the first step, all k seqs have the same probs
-                    top_k_logprobs, top_k_words = logprobs_t[0].topk(beam_size, 0, True, True)
-                else: # unroll and find top logprobs, and their unrolled indices
-                    top_k_logprobs, top_k_words = logprobs_t.view(-1).topk(beam_size, 0, True, True)
-                prev_word_inds = top_k_words // vocab_size
-                next_word_inds = top_k_words % vocab_size
-
-                # generate new beam
-                if t == 0:
-                    seqs_i = next_word_inds.unsqueeze(1)
+        with open(score_output, "w") as f:
+            spider = 0
+            for name, score in scores_output.items():
+                if name == "Bleu":
+                    for n in range(4):
+                        f.write("Bleu-{}: {:6.3f}\n".format(n + 1, score[n]))
                 else:
-                    seqs_i = torch.cat([seqs_i[prev_word_inds], next_word_inds.unsqueeze(1)], dim=1)
-            seqs[i] = seqs_i[0]
-        return {"seqs": seqs}
+                    f.write("{}: {:6.3f}\n".format(name, score))
+                    if name in ["CIDEr", "SPICE"]:
+                        spider += score
+            if not zh:
+                f.write("SPIDEr: {:6.3f}\n".format(spider / 2))
 
 
 
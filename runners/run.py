@@ -2,14 +2,18 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
+import hashlib
 import pickle
 import datetime
 import uuid
+import contextlib
 from pathlib import Path
 
 import fire
 import numpy as np
 import torch
+from tqdm import tqdm
 from ignite.engine.engine import Engine, Events
 from ignite.metrics import Accuracy, Loss, RunningAverage
 from ignite.handlers import ModelCheckpoint
@@ -19,6 +23,7 @@ from ignite.utils import convert_tensor
 sys.path.append(os.getcwd())
 import models
 import utils.train_util as train_util
+import datasets.caption_dataset as ac_dataset
 from utils.build_vocab import Vocabulary
 from runners.base_runner import BaseRunner
 
@@ -87,6 +92,8 @@ class Runner(BaseRunner):
         feats = convert_tensor(feats.float(),
                                device=self.device,
                                non_blocking=True)
+        if self.frontend is not None: # waveforms to log mel spectrograms
+            feats, feat_lens = self.frontend(feats, feat_lens)
 
         if mode == "train":
             caps = convert_tensor(caps.long(),
@@ -110,37 +117,106 @@ class Runner(BaseRunner):
 
         return output
 
-    def train(self, config, **kwargs):
+    def _prepare_soft_targets(self, config, vocabulary):
+        """Top-k word distributions of the teacher ensemble (`distill_args["teachers"]`, experiment
+        directories listed one per line) for every training caption under teacher forcing, written to
+        `distill_args["soft_targets"]`, which is reused while teachers, captions and `topk` do not change.
+        Teachers see the features without augmentation.
+        Return:
+            whether the soft targets were computed
+        """
+        from models.ensemble_model import EnsembleCaptionModel
+
+        distill_args = config["distill_args"]
+        topk = distill_args.get("topk", 20)
+        combine = distill_args.get("combine", "mean_prob")
+        caption_file = config["caption_file"] if "caption_file" in config else config["train_caption_file"]
+        h5_csv = config["h5_csv"] if "h5_csv" in config else config["train_h5_csv"]
+
+        hasher = hashlib.sha1()
+        hasher.update(ac_dataset.CaptionTokenIds.compute_hash(caption_file, vocabulary).encode("utf-8"))
+        hasher.update(open(distill_args["teachers"], "rb").read())
+        hasher.update("{}_{}".format(topk, combine).encode("utf-8"))
+        digest = hasher.hexdigest()
+        if os.path.exists(distill_args["soft_targets"]) and \
+                ac_dataset.read_soft_target_attrs(distill_args["soft_targets"]).get("digest") == digest:
+            return False
+
+        # the training run does not depend on whether the soft targets are computed
+        rng_state = train_util.get_rng_state()
+        teachers, _ = self._load_ensemble_members(distill_args["teachers"])
+        teacher = EnsembleCaptionModel(teachers, combine=combine,
+                                       num_workers=distill_args.get("num_workers", None))
+        teacher = teacher.to(self.device)
+        teacher.eval()
+
+        caption_info = json.load(open(caption_file, "r"))["audios"]
+        dataset = ac_dataset.CaptionDataset(
+            self._get_feature_dict(config, h5_csv), caption_info, vocabulary, caption_file=caption_file)
+        token_ids = dataset._token_ids
+        # captions in order, batches are not sorted so items are matched by position
+        elems = [(audio_idx, cap_idx) for audio_idx in range(len(caption_info))
+                 for cap_idx in range(len(caption_info[audio_idx]["captions"]))]
+        batch_size = config["dataloader_args"]["batch_size"]
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            sampler=elems,
+            collate_fn=ac_dataset.collate_fn([0, 1]),
+            batch_size=batch_size,
+            num_workers=config["dataloader_args"].get("num_workers", 0)
+        )
+
+        indices = np.zeros((len(token_ids.tokens), topk), dtype=np.int64)
+        probs = np.zeros((len(token_ids.tokens), topk), dtype=np.float32)
+        with torch.no_grad():
+            for batch_idx, batch in enumerate(tqdm(dataloader, ascii=True, ncols=100)):
+                feats, caps, _, feat_lens, cap_lens = batch
+                feats = feats.float().to(self.device)
+                caps = caps.long().to(self.device)
+                logprobs = teacher.forced_logprobs(feats, feat_lens, caps, cap_lens)
+                top_logprobs, top_indices = logprobs.topk(topk, dim=-1)
+                # renormalized over the top k words
+                top_probs = torch.softmax(top_logprobs, dim=-1).cpu().numpy()
+                top_indices = top_indices.cpu().numpy()
+                for idx, elem in enumerate(elems[batch_idx * batch_size: (batch_idx + 1) * batch_size]):
+                    # rows of the words after <start>
+                    start = token_ids.offsets[token_ids._index(*elem)] + 1
+                    length = int(cap_lens[idx]) - 1
+                    indices[start: start + length] = top_indices[idx, :length]
+                    probs[start: start + length] = top_probs[idx, :length]
+        teacher.close()
+        ac_dataset.write_soft_targets(distill_args["soft_targets"], token_ids, indices, probs,
+                                      digest=digest, topk=topk, combine=combine)
+        train_util.set_rng_state(rng_state)
+        return True
+
+    def train(self, config, resume=None, **kwargs):
         """Trains a model on the given configurations.
         :param config: A training configuration. Note that all parameters in the config can also be manually adjusted with --ARG=VALUE
+        :param resume: checkpoint to continue training from, `True` for `checkpoint.pth` in the experiment directory
         :param **kwargs: parameters to overwrite yaml config
         """
         from pycocoevalcap.cider.cider import Cider
 
+        local_rank = kwargs.pop("local_rank", None)
         conf = train_util.parse_config_or_kwargs(config, **kwargs)
         conf["seed"] = self.seed
         
         assert "distributed" in conf
 
         if conf["distributed"]:
-            torch.distributed.init_process_group(backend="nccl")
-            self.local_rank = torch.distributed.get_rank()
-            self.world_size = torch.distributed.get_world_size()
-            assert kwargs["local_rank"] == self.local_rank
-            torch.cuda.set_device(self.local_rank)
-            self.device = torch.device("cuda", self.local_rank)
+            self._init_distributed(conf, local_rank)
             # self.group = torch.distributed.new_group()
 
-        if not conf["distributed"] or not self.local_rank:
-            outputdir = str(
-                Path(conf["outputpath"]) / 
-                conf["model"] /
-                # "{}_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%m"),
-                               # uuid.uuid1().hex)
-                conf["remark"] /
-                "seed_{}".format(self.seed)
-            )
-
+        outputdir = str(
+            Path(conf["outputpath"]) / 
+            conf["model"] /
+            # "{}_{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%m"),
+                           # uuid.uuid1().hex)
+            conf["remark"] /
+            "seed_{}".format(self.seed)
+        )
+        if not conf["distributed"] or not self.rank:
             Path(outputdir).mkdir(parents=True, exist_ok=True)
             # # Early init because of creating dir
             # checkpoint_handler = ModelCheckpoint(
@@ -161,13 +237,31 @@ class Runner(BaseRunner):
 
         zh = conf["zh"]
         vocabulary = pickle.load(open(conf["vocab_file"], "rb"))
+        distill_args = conf.get("distill_args", None)
+        if distill_args is not None:
+            # distillation: soft targets of the teacher ensemble are computed once by the main process
+            assert not conf["dataloader_args"].get("audio_level_batch", False) and \
+                "frontend_args" not in conf, "distillation needs caption-level batches of HDF5 features"
+            distill_args.setdefault("soft_targets", str(Path(outputdir) / "soft_targets.h5"))
+            if not conf["distributed"] or not self.rank:
+                if self._prepare_soft_targets(conf, vocabulary):
+                    logger.info("Soft targets of {} stored in {}".format(
+                        distill_args["teachers"], distill_args["soft_targets"]))
+            if conf["distributed"]:
+                torch.distributed.barrier()
+            distill_criterion = train_util.SoftTargetLoss()
+            distill_alpha = distill_args.get("alpha", 1.0)
         dataloaders = self._get_dataloaders(conf, vocabulary)
         train_dataloader = dataloaders["train_dataloader"]
         val_dataloader = dataloaders["val_dataloader"]
         val_key2refs = dataloaders["val_key2refs"]
         data_dim = train_dataloader.dataset.data_dim
+        self.frontend = self._get_frontend(conf)
+        if self.frontend is not None:
+            self.frontend = self.frontend.to(self.device)
+            data_dim = self.frontend.mel_bins
         conf["input_dim"] = data_dim
-        if not conf["distributed"] or not self.local_rank:
+        if not conf["distributed"] or not self.rank:
             feature_data = conf["h5_csv"] if "h5_csv" in conf else conf["train_h5_csv"]
             logger.info(
                 "Feature: {} Input dimension: {} Vocab Size: {}".format(
@@ -175,39 +269,99 @@ class Runner(BaseRunner):
 
         model = self._get_model(conf, len(vocabulary))
         model = model.to(self.device)
+        # validation runs on a copy of the model in the background while training goes on
+        async_validation = conf.get("async_validation", False)
+        if async_validation:
+            validator = train_util.BackgroundValidator(model)
+        # the outputs of a frozen encoder are computed once and cached, unless features are augmented
+        use_encoder_cache = False
+        if conf["model_args"].get("freeze_encoder", False) and conf.get("encoder_cache", True):
+            if conf["augments"]:
+                if not conf["distributed"] or not self.rank:
+                    logger.info("Augmentation is used, encoder outputs are not cached")
+            else:
+                use_encoder_cache = True
+                Path(outputdir).mkdir(parents=True, exist_ok=True)
+                model.encoder_cache = models.EncoderOutputCache(
+                    str(Path(outputdir) / "encoder_cache_{}.h5".format(self.rank)))
         if conf["distributed"]:
-            model = torch.nn.parallel.distributed.DistributedDataParallel(
-                model, device_ids=[self.local_rank,], output_device=self.local_rank,
-                find_unused_parameters=True)
+            model = self._get_ddp_model(model)
         optimizer = getattr(
             torch.optim, conf["optimizer"]
         )(model.parameters(), **conf["optimizer_args"])
 
-        if not conf["distributed"] or not self.local_rank:
+        if not conf["distributed"] or not self.rank:
             train_util.pprint_dict(model, logger.info, formatter="pretty")
             train_util.pprint_dict(optimizer, logger.info, formatter="pretty")
+            if conf.get("grad_accum_steps", 1) > 1:
+                logger.info("Effective batch size: {} ({} x {} accumulation steps x {} processes)".format(
+                    conf["dataloader_args"]["batch_size"] * conf["grad_accum_steps"] * self.world_size,
+                    conf["dataloader_args"]["batch_size"], conf["grad_accum_steps"], self.world_size))
 
         if conf["label_smoothing"]:
             criterion = train_util.LabelSmoothingLoss(len(vocabulary), smoothing=conf["smoothing"])
         else:
             criterion = torch.nn.CrossEntropyLoss().to(self.device)
         crtrn_imprvd = train_util.criterion_improver(conf['improvecriterion'])
+        audio_level_batch = conf["dataloader_args"].get("audio_level_batch", False)
+        # mixed precision, loss scaling is only needed for fp16
+        amp_dtype = train_util.get_amp_dtype(conf.get("amp", False), self.device)
+        scaler = torch.cuda.amp.GradScaler(
+            enabled=amp_dtype == torch.float16 and self.device.type == "cuda")
+        throughput_meter = train_util.ThroughputMeter(self.device)
+
+        # gradients of grad_accum_steps micro-batches are accumulated before each optimizer step
+        grad_accum_steps = conf.get("grad_accum_steps", 1)
 
         def _train_batch(engine, batch):
-            if conf["distributed"]:
-                train_dataloader.sampler.set_epoch(engine.state.epoch)
             model.train()
+            is_first, is_last, window_size = train_util.accumulation_window(
+                engine, grad_accum_steps)
             with torch.enable_grad():
-                optimizer.zero_grad()
-                output = self._forward(
-                    model, batch, "train",
-                    ss_ratio=conf["ss_args"]["ss_ratio"]
-                )
-                loss = criterion(output["packed_logits"], output["targets"]).to(self.device)
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), conf["max_grad_norm"])
-                optimizer.step()
+                if is_first:
+                    optimizer.zero_grad()
+                forward_kwargs = {"ss_ratio": conf["ss_args"]["ss_ratio"]}
+                if audio_level_batch:
+                    forward_kwargs["caption_audio_idxs"] = batch[3]
+                if use_encoder_cache and audio_level_batch:
+                    # keys are per caption (sorted by length), the cache is keyed by the clips of `feats`
+                    audio_ids = [None] * batch[0].size(0)
+                    for key, audio_idx in zip(batch[2], batch[3].tolist()):
+                        audio_ids[audio_idx] = key
+                    forward_kwargs["audio_ids"] = audio_ids
+                elif use_encoder_cache:
+                    forward_kwargs["audio_ids"] = batch[2]
+                # gradients are only all-reduced on the last micro-batch of the window
+                if conf["distributed"] and not is_last:
+                    sync_context = model.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
+                with sync_context:
+                    with train_util.autocast(self.device, amp_dtype):
+                        output = self._forward(model, batch, "train", **forward_kwargs)
+                        loss = criterion(output["packed_logits"], output["targets"]).to(self.device)
+                        if distill_args is not None:
+                            # CaptionDistillDataset: [feats, caps, keys, target_indices, target_probs, feat_lens, cap_lens]
+                            cap_lens = batch[-1]
+                            target_indices, target_probs = [
+                                convert_tensor(torch.nn.utils.rnn.pack_padded_sequence(
+                                    targets[:, 1:], cap_lens - 1, batch_first=True).data,
+                                    device=self.device, non_blocking=True)
+                                for targets in (batch[3], batch[4])]
+                            distill_loss = distill_criterion(
+                                output["packed_logits"], target_indices, target_probs)
+                            loss = distill_alpha * distill_loss + (1 - distill_alpha) * loss
+                    scaler.scale(loss / window_size).backward()
+                if is_last:
+                    # gradients are unscaled before clipping
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), conf["max_grad_norm"])
+                    scaler.step(optimizer)
+                    scaler.update()
+                output["packed_logits"] = output["packed_logits"].float()
                 output["loss"] = loss.item()
+                output["optimizer_step"] = is_last
+                throughput_meter.update(len(batch[1]))
                 return output
 
         trainer = Engine(_train_batch)
@@ -238,17 +392,62 @@ class Runner(BaseRunner):
         evaluator = Engine(_inference)
 
         def eval_val(engine, key2pred, key2refs):
-            scorer = Cider(zh=zh)
-            score_output = self._eval_prediction(key2refs, key2pred, [scorer])
-            engine.state.metrics["score"] = score_output["CIDEr"]
+            # each rank decodes a part of the validation set, the main process scores all predictions
+            self._gather_predictions(key2pred)
+            score = None
+            if not conf["distributed"] or not self.rank:
+                scorer = Cider(zh=zh)
+                score_output = self._eval_prediction(key2refs, key2pred, [scorer])
+                score = score_output["CIDEr"]
+            engine.state.metrics["score"] = self._broadcast_object(score)
             key2pred.clear()
 
-        evaluator.add_event_handler(
-            Events.EPOCH_COMPLETED, eval_val, key2pred, val_key2refs)
+        if not async_validation:
+            evaluator.add_event_handler(
+                Events.EPOCH_COMPLETED, eval_val, key2pred, val_key2refs)
+        else:
+            # results of the background validation are reported through `evaluator` events
+            def _validate(val_model):
+                # runs in the background thread, predictions of all ranks are scored in `finish_validation`
+                val_key2pred = {}
+                val_model.eval()
+                with torch.no_grad():
+                    for batch in val_dataloader:
+                        keys = batch[0]
+                        output = self._forward(val_model, batch, "validation")
+                        seqs = output["seqs"].cpu().numpy()
+                        for (idx, seq) in enumerate(seqs):
+                            candidate = self._convert_idx2sentence(seq, vocabulary, zh)
+                            val_key2pred[keys[idx]] = [candidate,]
+                score = None
+                if not conf["distributed"]:
+                    score = self._eval_prediction(val_key2refs, val_key2pred, [Cider(zh=zh)])["CIDEr"]
+                return {"key2pred": val_key2pred, "score": score}
+
+            def finish_validation(engine):
+                if not validator.pending:
+                    return
+                output = validator.result()
+                evaluator.state.epoch = validator.epoch
+                if output["score"] is None:
+                    eval_val(evaluator, output["key2pred"], val_key2refs)
+                else:
+                    evaluator.state.metrics["score"] = output["score"]
+                if not conf["distributed"] or not self.rank:
+                    logger.info("Validation Results - Epoch : {:<4} score {:5<.2g} ".format(
+                        validator.epoch, evaluator.state.metrics["score"]))
+                evaluator.fire_event(Events.EPOCH_COMPLETED)
+
+            def start_validation(engine):
+                # the last validation is collected first, so results are reported at fixed points
+                finish_validation(engine)
+                validator.submit(model if not conf["distributed"] else model.module,
+                                 engine.state.epoch, _validate, training_states())
 
         pbar.attach(evaluator)
 
         # Learning rate scheduler
+        scheduler = None
         if "scheduler" in conf:
             try:
                 scheduler = getattr(torch.optim.lr_scheduler, conf["scheduler"])(
@@ -256,62 +455,195 @@ class Runner(BaseRunner):
             except AttributeError:
                 import utils.lr_scheduler
                 if conf["scheduler"] == "ExponentialDecayScheduler":
-                    conf["scheduler_args"]["total_iters"] = len(train_dataloader) * conf["epochs"]
+                    conf["scheduler_args"]["total_iters"] = train_util.optimizer_steps_per_epoch(
+                        len(train_dataloader), grad_accum_steps) * conf["epochs"]
                 scheduler = getattr(utils.lr_scheduler, conf["scheduler"])(
                     optimizer, **conf["scheduler_args"])
-            if scheduler.__class__.__name__ in ["StepLR", "ReduceLROnPlateau", "ExponentialLR", "MultiStepLR"]:
+            if async_validation and scheduler.__class__.__name__ in ["StepLR", "ExponentialLR", "MultiStepLR"]:
+                # not waiting for the background validation
+                trainer.add_event_handler(
+                    Events.EPOCH_COMPLETED, train_util.update_lr, scheduler)
+            elif scheduler.__class__.__name__ in ["StepLR", "ReduceLROnPlateau", "ExponentialLR", "MultiStepLR"]:
                 evaluator.add_event_handler(
                     Events.EPOCH_COMPLETED, train_util.update_lr,
                     scheduler, "score")
             else:
                 trainer.add_event_handler(
-                    Events.ITERATION_COMPLETED, train_util.update_lr, scheduler, None)
+                    Events.ITERATION_COMPLETED, train_util.update_lr_on_step, scheduler)
         
+        def training_states():
+            # saved with the best model, taken with the validated snapshot when validating in the background
+            return {
+                "optimizer": optimizer.state_dict(),
+                "lr_scheduler": scheduler.state_dict() if scheduler is not None else None,
+                "scaler": scaler.state_dict()
+            }
+
+        if hasattr(train_dataloader.batch_sampler, "padding_ratio") and \
+                (not conf["distributed"] or not self.rank):
+            def log_padding_ratio(engine):
+                padding_ratio = train_dataloader.batch_sampler.padding_ratio()
+                logger.info("Padding ratio - feature: {:.3f} caption: {:.3f}".format(
+                    padding_ratio["feature"], padding_ratio["caption"]))
+            trainer.add_event_handler(Events.EPOCH_COMPLETED, log_padding_ratio)
+
+        trainer.add_event_handler(Events.EPOCH_STARTED, throughput_meter.reset)
+        if not conf["distributed"] or not self.rank:
+            def log_throughput(engine):
+                logger.info("Epoch {} training ({}): {}".format(
+                    engine.state.epoch,
+                    "fp32" if amp_dtype is None else "amp {}".format(amp_dtype),
+                    throughput_meter.summary()))
+            trainer.add_event_handler(Events.EPOCH_COMPLETED, log_throughput)
+
+        if use_encoder_cache and (not conf["distributed"] or not self.rank):
+            def log_encoder_cache(engine):
+                encoder_cache = model.encoder_cache if not conf["distributed"] else model.module.encoder_cache
+                logger.info("Encoder cache: {} clips, hits: {} misses: {}".format(
+                    len(encoder_cache), encoder_cache.hits, encoder_cache.misses))
+            trainer.add_event_handler(Events.EPOCH_COMPLETED, log_encoder_cache)
+
         # Scheduled sampling
         if conf["ss"]:
             trainer.add_event_handler(
                 Events.GET_BATCH_COMPLETED, train_util.update_ss_ratio, conf, len(train_dataloader))
 
+        if async_validation:
+            # validation of epoch n is reported at the end of epoch n + 1 (or of training)
+            trainer.add_event_handler(Events.EPOCH_COMPLETED, start_validation)
+            trainer.add_event_handler(Events.COMPLETED, finish_validation)
+        elif conf["distributed"] and self.rank:
+            # the other ranks decode their part of the validation set, the main process
+            # runs the validation in `log_results`
+            trainer.add_event_handler(
+                Events.EPOCH_COMPLETED, train_util.run_val, evaluator, val_dataloader)
+
         #########################
         # Events for main process: mostly logging and saving
         #########################
-        if not conf["distributed"] or not self.local_rank:
+        if not conf["distributed"] or not self.rank:
+            # checkpoints are written by a background thread
+            checkpoint_writer = train_util.AsyncCheckpointWriter()
             # logging training and validation loss and metrics
-            trainer.add_event_handler(
-                Events.EPOCH_COMPLETED, train_util.log_results, optimizer, evaluator, val_dataloader,
-                logger.info, metrics.keys(), ["score"])
-            # saving best model
+            if async_validation:
+                trainer.add_event_handler(
+                    Events.EPOCH_COMPLETED, train_util.log_results, optimizer, None, None,
+                    logger.info, metrics.keys())
+            else:
+                trainer.add_event_handler(
+                    Events.EPOCH_COMPLETED, train_util.log_results, optimizer, evaluator, val_dataloader,
+                    logger.info, metrics.keys(), ["score"])
+            # saving best model, the validated snapshot when validating in the background
             evaluator.add_event_handler(
                 Events.EPOCH_COMPLETED, train_util.save_model_on_improved, crtrn_imprvd,
-                "score", {
-                    "model": model.state_dict() if not conf["distributed"] else model.module.state_dict(),
+                "score", lambda: {
                     # "config": conf,
-                    "optimizer": optimizer.state_dict(),
-                    "lr_scheduler": scheduler.state_dict()
-                }, str(Path(outputdir) / "saved.pth")
-            )
-            # regular checkpoint
-            checkpoint_handler = ModelCheckpoint(
-                outputdir,
-                "run",
-                n_saved=1,
-                require_empty=False,
-                create_dir=False,
-                score_function=lambda engine: engine.state.metrics["score"],
-                score_name="score")
-            evaluator.add_event_handler(
-                Events.EPOCH_COMPLETED, checkpoint_handler, {
-                    "model": model,
-                }
+                    "model": validator.model.state_dict(), **validator.states
+                } if async_validation else {
+                    "model": model.state_dict() if not conf["distributed"] else model.module.state_dict(),
+                    **training_states()
+                }, str(Path(outputdir) / "saved.pth"), checkpoint_writer
             )
             # dump configuration
             train_util.store_yaml(conf, str(Path(outputdir) / "config.yaml"))
 
+        # regular checkpoint, created on all ranks since ignite synchronizes its distributed
+        # context when it is created, the file is only written by rank 0
+        checkpoint_handler = ModelCheckpoint(
+            outputdir,
+            "run",
+            n_saved=1,
+            require_empty=False,
+            create_dir=False,
+            score_function=lambda engine: engine.state.metrics["score"],
+            score_name="score")
+        evaluator.add_event_handler(
+            Events.EPOCH_COMPLETED, checkpoint_handler, {
+                "model": model if not async_validation else validator.model,
+            }
+        )
+
+        # full training state for resuming, every `checkpoint_interval` epochs after validation
+        checkpoint_path = str(Path(outputdir) / "checkpoint.pth")
+
+        def save_checkpoint(engine):
+            # RNG states of all ranks, the next epoch starts from them
+            rng_states = self._all_gather_object(train_util.get_rng_state())
+            if conf["distributed"] and self.rank:
+                return
+            checkpoint_writer.save({
+                "model": model.state_dict() if not conf["distributed"] else model.module.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "lr_scheduler": scheduler.state_dict() if scheduler is not None else None,
+                "scaler": scaler.state_dict(),
+                "trainer": {"epoch": engine.state.epoch, "iteration": engine.state.iteration},
+                "ss_ratio": conf["ss_args"]["ss_ratio"],
+                "criterion_improver": crtrn_imprvd.state_dict(),
+                # files kept by ModelCheckpoint (ignite >= 0.4.3)
+                "checkpoint_handler": checkpoint_handler.state_dict()
+                    if hasattr(checkpoint_handler, "state_dict") else None,
+                "rng_states": rng_states,
+                # epoch (and seed) of a sampler shuffling on its own, e.g. the bucket sampler
+                "batch_sampler": train_dataloader.batch_sampler.state_dict()
+                    if hasattr(train_dataloader.batch_sampler, "state_dict") else None,
+            }, checkpoint_path)
+
+        # samplers shuffling by the epoch, the epoch is restored with the trainer state when resuming
+        trainer.add_event_handler(Events.EPOCH_STARTED, train_util.set_sampler_epoch, train_dataloader)
+
+        trainer.add_event_handler(
+            Events.EPOCH_COMPLETED(every=conf.get("checkpoint_interval", 1)), save_checkpoint)
+
+        if resume:
+            resume_path = checkpoint_path if resume is True else resume
+            checkpoint = train_util.load_checkpoint(resume_path)
+            (model if not conf["distributed"] else model.module).load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            if scheduler is not None:
+                scheduler.load_state_dict(checkpoint["lr_scheduler"])
+            scaler.load_state_dict(checkpoint["scaler"])
+            conf["ss_args"]["ss_ratio"] = checkpoint["ss_ratio"]
+            crtrn_imprvd.load_state_dict(checkpoint["criterion_improver"])
+            if checkpoint["checkpoint_handler"] is not None:
+                handler_state = checkpoint["checkpoint_handler"]
+                if async_validation:
+                    # the validation of the checkpointed epoch finished later and may have replaced
+                    # the kept file, it is validated (and saved) again after resuming
+                    for key in ("saved", "_saved"):
+                        if key in handler_state:
+                            handler_state[key] = [(priority, filename) for priority, filename in handler_state[key]
+                                                  if (Path(outputdir) / filename).exists()]
+                checkpoint_handler.load_state_dict(handler_state)
+            trainer.load_state_dict({
+                "epoch": checkpoint["trainer"]["epoch"],
+                "epoch_length": len(train_dataloader),
+                "max_epochs": conf["epochs"]
+            })
+            rng_states = checkpoint["rng_states"]
+            train_util.set_rng_state(rng_states[self.rank % len(rng_states)])
+            if checkpoint.get("batch_sampler") is not None:
+                train_dataloader.batch_sampler.load_state_dict(checkpoint["batch_sampler"])
+            if async_validation:
+                # the checkpoint is saved before the validation of its epoch finishes
+                validator.submit(model if not conf["distributed"] else model.module,
+                                 checkpoint["trainer"]["epoch"], _validate, training_states())
+            if not conf["distributed"] or not self.rank:
+                logger.info("Resume training from {} (epoch {})".format(
+                    resume_path, checkpoint["trainer"]["epoch"]))
+
         #########################
         # Start training
         #########################
         trainer.run(train_dataloader, max_epochs=conf["epochs"])
-        if not conf["distributed"] or not self.local_rank:
+        if async_validation:
+            validator.shutdown()
+        if not conf["distributed"] or not self.rank:
+            checkpoint_writer.close()
+        if use_encoder_cache:
+            encoder_cache = model.encoder_cache if not conf["distributed"] else model.module.encoder_cache
+            encoder_cache.close()
+            os.remove(encoder_cache.cache_file)
+        if not conf["distributed"] or not self.rank:
             return outputdir
 
 
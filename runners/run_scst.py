@@ -8,6 +8,9 @@ import logging
 import datetime
 import random
 import uuid
+import pickle
+import contextlib
+from pathlib import Path
 from pprint import pformat
 
 from tqdm import tqdm
@@ -25,8 +28,8 @@ from ignite.metrics import Accuracy, Loss, RunningAverage, Average
 sys.path.append(os.getcwd())
 import models
 import utils.train_util as train_util
+import utils.score_util as score_util
 from utils.build_vocab import Vocabulary
-from datasets.caption_dataset import SJTUDataset, collate_fn
 from runners.run import Runner as XeRunner
 
 
@@ -35,33 +38,27 @@ class ScstRunner(XeRunner):
 
     def _get_model(self, config, vocab_size):
         basemodel = super()._get_model(config, vocab_size)
-        model = getattr(models.seq_train_model, config["modelwrapper"])(basemodel)
+        model = getattr(models.seq_train_model, config["modelwrapper"])(
+            basemodel, **config.get("modelwrapper_args", {}))
         return model
 
     def _forward(self, model, batch, mode, **kwargs):
         assert mode in ("train", "validation", "eval")
 
-        if mode == "eval":
-            # SJTUDataSetEval
+        if mode in ("validation", "eval"):
+            # CaptionEvalDataset: [keys, feats, feat_lens]
             feats = batch[1]
             feat_lens = batch[-1]
 
             feats = convert_tensor(feats.float(),
                                    device=self.device,
                                    non_blocking=True)
+            if self.frontend is not None:
+                feats, feat_lens = self.frontend(feats, feat_lens)
             output = model(feats, feat_lens, **kwargs)
             return output
-        
-        if mode == "validation":
-            feats = batch[0]
-            feat_lens = batch[-2]
-            feats = convert_tensor(feats.float(),
-                                   device=self.device,
-                                   non_blocking=True)
-            output = model(feats, feat_lens, **kwargs)
-            return output
-
 
+        # CaptionDataset: [feats, caps, keys, feat_lens, cap_lens]
         feats = batch[0]
         keys = batch[2]
         feat_lens = batch[-2]
@@ -69,26 +66,35 @@ class ScstRunner(XeRunner):
         feats = convert_tensor(feats.float(),
                                device=self.device,
                                non_blocking=True)
+        if self.frontend is not None:
+            feats, feat_lens = self.frontend(feats, feat_lens)
         
         assert "key2refs" in kwargs, "missing references in scst"
         assert "vocabulary" in kwargs, "missing vocabulary in scst"
         output = model(feats, feat_lens, keys, kwargs["key2refs"], kwargs["vocabulary"],
-                       max_length=max(cap_lens)-1, scorer=kwargs["scorer"])
+                       max_length=int(max(cap_lens)) - 1, scorer=kwargs["scorer"])
         
         return output
 
-    def train(self, config, **kwargs):
+    def train(self, config, resume=None, **kwargs):
         """Trains a model on the given configurations.
         :param config:str: A training configuration. Note that all parameters in the config can also be manually adjusted with --ARG=VALUE
+        :param resume: checkpoint to continue training from, `True` for `checkpoint.pth` in the experiment directory
         :param **kwargs: parameters to overwrite yaml config
         """
 
         from pycocoevalcap.cider.cider import Cider
-        from pycocoevalcap.spider.spider import Spider
 
+        local_rank = kwargs.pop("local_rank", None)
         conf = train_util.parse_config_or_kwargs(config, **kwargs)
         conf["seed"] = self.seed
         zh = conf["zh"]
+
+        assert "distributed" in conf
+
+        if conf["distributed"]:
+            self._init_distributed(conf, local_rank)
+
         outputdir = os.path.join(
             conf["outputpath"], conf["modelwrapper"],
             # "{}_{}".format(
@@ -97,7 +103,8 @@ class ScstRunner(XeRunner):
             conf["remark"], "seed_{}".format(self.seed)
         )
 
-        # Early init because of creating dir
+        # Early init because of creating dir, created on all ranks since ignite synchronizes
+        # its distributed context here, the directory and files are only written by rank 0
         checkpoint_handler = ModelCheckpoint(
             outputdir,
             "run",
@@ -107,48 +114,84 @@ class ScstRunner(XeRunner):
             score_function=lambda engine: engine.state.metrics["score"],
             score_name="score")
 
-        logger = train_util.genlogger(os.path.join(outputdir, "train.log"))
-        # print passed config parameters
-        logger.info("Storing files in: {}".format(outputdir))
-        train_util.pprint_dict(conf, logger.info)
-
-        vocabulary = torch.load(conf["vocab_file"])
-        train_loader, val_loader, info = self._get_dataloaders(conf, vocabulary)
-        conf["inputdim"] = info["inputdim"]
-        logger.info("<== Estimating Scaler ({}) ==>".format(info["scaler"].__class__.__name__))
-        logger.info(
+        if not conf["distributed"] or not self.rank:
+            logger = train_util.genlogger(os.path.join(outputdir, "train.log"))
+            # print passed config parameters
+            logger.info("Storing files in: {}".format(outputdir))
+            train_util.pprint_dict(conf, logger.info)
+
+        vocabulary = pickle.load(open(conf["vocab_file"], "rb"))
+        dataloaders = self._get_dataloaders(conf, vocabulary)
+        train_loader = dataloaders["train_dataloader"]
+        val_loader = dataloaders["val_dataloader"]
+        train_key2refs = dataloaders["train_key2refs"]
+        val_key2refs = dataloaders["val_key2refs"]
+        data_dim = train_loader.dataset.data_dim
+        self.frontend = self._get_frontend(conf)
+        if self.frontend is not None:
+            self.frontend = self.frontend.to(self.device)
+            data_dim = self.frontend.mel_bins
+        conf["input_dim"] = data_dim
+        if not conf["distributed"] or not self.rank:
+            feature_data = conf["h5_csv"] if "h5_csv" in conf else conf["train_h5_csv"]
+            logger.info(
                 "Feature: {} Input dimension: {} Vocab Size: {}".format(
-                conf["feature_file"], info["inputdim"], len(vocabulary)))
-        train_key2refs = info["train_key2refs"]
-        val_key2refs = info["val_key2refs"]
+                    feature_data, data_dim, len(vocabulary)))
 
-        model = self._get_model(conf, vocabulary)
+        model = self._get_model(conf, len(vocabulary))
         model = model.to(self.device)
-        train_util.pprint_dict(model, logger.info, formatter="pretty")
+        if conf["distributed"]:
+            model = self._get_ddp_model(model)
         optimizer = getattr(
             torch.optim, conf["optimizer"]
         )(model.parameters(), **conf["optimizer_args"])
-        train_util.pprint_dict(optimizer, logger.info, formatter="pretty")
+        if not conf["distributed"] or not self.rank:
+            train_util.pprint_dict(model, logger.info, formatter="pretty")
+            train_util.pprint_dict(optimizer, logger.info, formatter="pretty")
 
         crtrn_imprvd = train_util.criterion_improver(conf["improvecriterion"])
 
-        scorer_dict = {"cider": Cider(zh=zh), "spider": Spider()}
         if "train_scorer" not in conf:
             conf["train_scorer"] = "cider"
-        train_scorer = scorer_dict[conf["train_scorer"]]
+        if conf["train_scorer"] == "spider":
+            from pycocoevalcap.spider.spider import Spider
+            train_scorer = Spider()
+        elif conf["train_scorer"] == "ciderd":
+            # CIDEr-D on word indices, reference tf-idf vectors are computed once
+            train_scorer = score_util.BatchCiderD(
+                train_loader.dataset.get_reference_token_ids(train_key2refs.keys()),
+                num_workers=conf.get("reward_num_workers", 0))
+        else:
+            train_scorer = Cider(zh=zh)
+        # gradients of grad_accum_steps micro-batches are accumulated before each optimizer step
+        grad_accum_steps = conf.get("grad_accum_steps", 1)
+
         def _train_batch(engine, batch):
             # import pdb; pdb.set_trace()
             # set num batch tracked?
             model.train()
+            is_first, is_last, window_size = train_util.accumulation_window(
+                engine, grad_accum_steps)
             with torch.enable_grad():
-                optimizer.zero_grad()
+                if is_first:
+                    optimizer.zero_grad()
                 # train_scorer = scorer_dict[conf["train_scorer"]]
-                output = self._forward(model, batch, "train", 
-                                       key2refs=train_key2refs, 
-                                       scorer=train_scorer,
-                                       vocabulary=vocabulary)
-                output["loss"].backward()
-                optimizer.step()
+                if conf["distributed"] and not is_last:
+                    sync_context = model.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
+                with sync_context:
+                    output = self._forward(model, batch, "train", 
+                                           key2refs=train_key2refs, 
+                                           scorer=train_scorer,
+                                           vocabulary=vocabulary)
+                    (output["loss"] / window_size).backward()
+                if is_last:
+                    if "max_grad_norm" in conf:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), conf["max_grad_norm"])
+                    optimizer.step()
+                output["loss"] = output["loss"].item()
+                output["optimizer_step"] = is_last
                 return output
 
         trainer = Engine(_train_batch)
@@ -160,7 +203,7 @@ class ScstRunner(XeRunner):
 
         def _inference(engine, batch):
             model.eval()
-            keys = batch[2]
+            keys = batch[0]
             with torch.no_grad():
                 # val_scorer = Cider(zh=zh)
                 # output = self._forward(model, batch, "train", 
@@ -192,25 +235,34 @@ class ScstRunner(XeRunner):
         # pbar.attach(evaluator, ["running_loss"])
         pbar.attach(evaluator) 
 
-        trainer.add_event_handler(
-              Events.EPOCH_COMPLETED, train_util.log_results, evaluator, val_loader,
-              logger.info, metrics.keys(), ["score"])
-
         def eval_val(engine, key2pred, key2refs, scorer):
-            score, scores = scorer.compute_score(key2refs, key2pred)
-            engine.state.metrics["score"] = score
+            self._gather_predictions(key2pred)
+            score = None
+            if not conf["distributed"] or not self.rank:
+                score_output = self._eval_prediction(key2refs, key2pred, [scorer])
+                score = score_output["CIDEr"]
+            engine.state.metrics["score"] = self._broadcast_object(score)
             key2pred.clear()
 
         evaluator.add_event_handler(
             Events.EPOCH_COMPLETED, eval_val, key2pred, val_key2refs, Cider(zh=zh))
 
-        evaluator.add_event_handler(
-            Events.EPOCH_COMPLETED, train_util.save_model_on_improved, crtrn_imprvd,
-            "score", {
-                "model": model.state_dict(),
-                "config": conf,
-                "scaler": info["scaler"]
-            }, os.path.join(outputdir, "saved.pth"))
+        if conf["distributed"] and self.rank:
+            trainer.add_event_handler(
+                Events.EPOCH_COMPLETED, train_util.run_val, evaluator, val_loader)
+
+        if not conf["distributed"] or not self.rank:
+            checkpoint_writer = train_util.AsyncCheckpointWriter()
+            trainer.add_event_handler(
+                  Events.EPOCH_COMPLETED, train_util.log_results, optimizer, evaluator, val_loader,
+                  logger.info, metrics.keys(), ["score"])
+
+            evaluator.add_event_handler(
+                Events.EPOCH_COMPLETED, train_util.save_model_on_improved, crtrn_imprvd,
+                "score", lambda: {
+                    "model": model.state_dict() if not conf["distributed"] else model.module.state_dict(),
+                    "config": conf,
+                }, os.path.join(outputdir, "saved.pth"), checkpoint_writer)
 
         evaluator.add_event_handler(
             Events.EPOCH_COMPLETED, checkpoint_handler, {
@@ -218,8 +270,59 @@ class ScstRunner(XeRunner):
             }
         )
 
+        checkpoint_path = os.path.join(outputdir, "checkpoint.pth")
+
+        def save_checkpoint(engine):
+            rng_states = self._all_gather_object(train_util.get_rng_state())
+            if conf["distributed"] and self.rank:
+                return
+            checkpoint_writer.save({
+                "model": model.state_dict() if not conf["distributed"] else model.module.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "trainer": {"epoch": engine.state.epoch, "iteration": engine.state.iteration},
+                "criterion_improver": crtrn_imprvd.state_dict(),
+                # files kept by ModelCheckpoint (ignite >= 0.4.3)
+                "checkpoint_handler": checkpoint_handler.state_dict()
+                    if hasattr(checkpoint_handler, "state_dict") else None,
+                "rng_states": rng_states,
+                # epoch (and seed) of a sampler shuffling on its own, e.g. the bucket sampler
+                "batch_sampler": train_loader.batch_sampler.state_dict()
+                    if hasattr(train_loader.batch_sampler, "state_dict") else None,
+            }, checkpoint_path)
+
+        # samplers shuffling by the epoch, the epoch is restored with the trainer state when resuming
+        trainer.add_event_handler(Events.EPOCH_STARTED, train_util.set_sampler_epoch, train_loader)
+
+        trainer.add_event_handler(
+            Events.EPOCH_COMPLETED(every=conf.get("checkpoint_interval", 1)), save_checkpoint)
+
+        if resume:
+            resume_path = checkpoint_path if resume is True else resume
+            checkpoint = train_util.load_checkpoint(resume_path)
+            (model if not conf["distributed"] else model.module).load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            crtrn_imprvd.load_state_dict(checkpoint["criterion_improver"])
+            if checkpoint["checkpoint_handler"] is not None:
+                checkpoint_handler.load_state_dict(checkpoint["checkpoint_handler"])
+            trainer.load_state_dict({
+                "epoch": checkpoint["trainer"]["epoch"],
+                "epoch_length": len(train_loader),
+                "max_epochs": conf["epochs"]
+            })
+            rng_states = checkpoint["rng_states"]
+            train_util.set_rng_state(rng_states[self.rank % len(rng_states)])
+            if checkpoint.get("batch_sampler") is not None:
+                train_loader.batch_sampler.load_state_dict(checkpoint["batch_sampler"])
+            if not conf["distributed"] or not self.rank:
+                logger.info("Resume training from {} (epoch {})".format(
+                    resume_path, checkpoint["trainer"]["epoch"]))
+
         trainer.run(train_loader, max_epochs=conf["epochs"])
-        return outputdir
+        if conf["train_scorer"] == "ciderd":
+            train_scorer.close()
+        if not conf["distributed"] or not self.rank:
+            checkpoint_writer.close()
+            return outputdir
 
 
 if __name__ == "__main__":
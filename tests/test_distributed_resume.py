@@ -0,0 +1,120 @@
+import json
+import os
+import pickle
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+h5py = pytest.importorskip("h5py")
+pytest.importorskip("ignite")
+pytest.importorskip("pycocoevalcap")
+import utils.train_util as train_util
+from utils.build_vocab import Vocabulary
+
+
+ROOT = Path(__file__).resolve().parents[1]
+WORDS = "a dog barks while cars pass by and birds sing loudly in the rain".split()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def config(tmp_path_factory):
+    """A small model trained on 16 clips of random features with 3 captions each"""
+    data_dir = tmp_path_factory.mktemp("data")
+    rng = np.random.RandomState(0)
+    audios = []
+    with h5py.File(data_dir / "lms.h5", "w") as store:
+        for i in range(16):
+            audio_id = "clip{}.wav".format(i)
+            store[audio_id] = rng.randn(rng.randint(40, 80), 16).astype(np.float32)
+            captions = []
+            for j in range(3):
+                tokens = list(rng.choice(WORDS, rng.randint(3, 8)))
+                captions.append({"caption": " ".join(tokens).capitalize() + ".",
+                                 "tokens": " ".join(tokens), "cap_id": str(j)})
+            audios.append({"audio_id": audio_id, "captions": captions})
+    with open(data_dir / "lms.csv", "w") as writer:
+        writer.write("audio_id\thdf5_path\n")
+        for audio in audios:
+            writer.write("{}\t{}\n".format(audio["audio_id"], data_dir / "lms.h5"))
+    json.dump({"audios": audios}, open(data_dir / "text.json", "w"))
+    vocabulary = Vocabulary()
+    for word in ["<pad>", "<start>", "<end>", "<unk>"] + WORDS:
+        vocabulary.add_word(word)
+    pickle.dump(vocabulary, open(data_dir / "vocab.pkl", "wb"))
+
+    config = {
+        "outputpath": str(data_dir / "experiments"),
+        "train_h5_csv": str(data_dir / "lms.csv"),
+        "train_caption_file": str(data_dir / "text.json"),
+        "val_h5_csv": str(data_dir / "lms.csv"),
+        "val_caption_file": str(data_dir / "text.json"),
+        "vocab_file": str(data_dir / "vocab.pkl"),
+        "zh": False,
+        "dataloader_args": {"batch_size": 4, "num_workers": 0},
+        "augments": [],
+        "distributed": True,
+        "dist_backend": "gloo",
+        "encodermodel": "CNN10QEncoder",
+        "encodermodel_args": {"embed_size": 512},
+        "decodermodel": "RNNBahdanauAttnDecoder",
+        "decodermodel_args": {"embed_size": 16, "rnn_type": "GRU", "num_layers": 1,
+                              "hidden_size": 16, "dropout": 0.5},
+        "model": "Seq2SeqAttnModel",
+        "model_args": {},
+        "improvecriterion": "score",
+        "optimizer": "Adam",
+        "optimizer_args": {"lr": 0.001},
+        "max_grad_norm": 0.5,
+        "scheduler": "StepLR",
+        "scheduler_args": {"step_size": 1},
+        "ss": False,
+        "ss_args": {"ss_mode": "linear", "ss_ratio": 1.0, "final_ss_ratio": 1.0},
+        "label_smoothing": False,
+    }
+    config_file = data_dir / "config.yaml"
+    # json is a subset of yaml
+    json.dump(config, open(config_file, "w"))
+    return config_file
+
+
+def train(config_file, remark, epochs, resume=False, sampler_args=""):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(ROOT)] + os.environ.get("PYTHONPATH", "").split(os.pathsep)), OMP_NUM_THREADS="1")
+    command = [sys.executable, "-m", "torch.distributed.run", "--nproc_per_node", "2",
+               "--master_port", str(free_port()), "runners/run.py", "train", str(config_file),
+               "--remark", remark, "--epochs", str(epochs), "--resume", str(resume)]
+    if sampler_args:
+        command += ["--dataloader_args", sampler_args]
+    result = subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode == 0, result.stdout[-3000:]
+
+
+@pytest.mark.parametrize("sampler", ["caption", "bucket"])
+def test_resumed_distributed_training_is_exact(config, sampler):
+    """Interrupting DDP training after 2 epochs and resuming it to 3 epochs gives the same model
+    as training 3 epochs in one run, the distributed samplers shuffle by the epoch"""
+    sampler_args = ""
+    if sampler == "bucket":
+        sampler_args = '{"batch_size":4,"num_workers":0,"bucket_sampler":True,"max_frames":200}'
+    train(config, sampler + "_full", 3, sampler_args=sampler_args)
+    train(config, sampler + "_resumed", 2, sampler_args=sampler_args)
+    train(config, sampler + "_resumed", 3, resume=True, sampler_args=sampler_args)
+    experiment_dir = Path(json.load(open(config))["outputpath"]) / "Seq2SeqAttnModel"
+    full = train_util.load_checkpoint(experiment_dir / (sampler + "_full") / "seed_1" / "checkpoint.pth")
+    resumed = train_util.load_checkpoint(
+        experiment_dir / (sampler + "_resumed") / "seed_1" / "checkpoint.pth")
+    assert full["trainer"] == resumed["trainer"]
+    for key, value in full["model"].items():
+        assert torch.equal(value, resumed["model"][key]), key
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+pytest.importorskip("h5py")
+import models
+import utils.train_util as train_util
+
+
+class ToyEncoder(torch.nn.Module):
+
+    def __init__(self):
+        super(ToyEncoder, self).__init__()
+        self.gru = torch.nn.GRU(4, 6, batch_first=True)
+        # autocast runs linear layers in bf16 on CPU
+        self.fc = torch.nn.Linear(6, 6)
+
+    def forward(self, feats, feat_lens):
+        audio_embeds, state = self.gru(feats)
+        audio_embeds = self.fc(audio_embeds)
+        return {"audio_embeds": audio_embeds, "audio_embeds_lens": torch.as_tensor(feat_lens),
+                "state": state, "audio_embeds_pooled": audio_embeds.mean(1)}
+
+
+@pytest.mark.parametrize("amp", [False, "bf16"])
+def test_encoder_cache_under_autocast(tmp_path, amp):
+    torch.manual_seed(0)
+    encoder = ToyEncoder()
+    feats = torch.randn(3, 10, 4)
+    feat_lens = torch.tensor([10, 8, 5])
+    audio_ids = ["a", "b", "c"]
+    cache = models.EncoderOutputCache(str(tmp_path / "encoder_cache.h5"))
+    device = torch.device("cpu")
+    amp_dtype = train_util.get_amp_dtype(amp, device)
+    with train_util.autocast(device, amp_dtype):
+        encoded = cache.encode(encoder, feats, feat_lens, audio_ids)
+        # read back from the cache, in another order
+        cached = cache.encode(encoder, feats[[2, 0]], feat_lens[[2, 0]], ["c", "a"])
+    assert cache.misses == 3 and cache.hits == 2
+    assert encoded["audio_embeds"].dtype == torch.float32
+    with torch.no_grad():
+        reference = encoder(feats, feat_lens)
+    # bf16 keeps about 3 significant digits
+    atol = 1e-6 if amp_dtype is None else 2e-2
+    for i, length in enumerate(feat_lens.tolist()):
+        torch.testing.assert_close(encoded["audio_embeds"][i, :length],
+                                   reference["audio_embeds"][i, :length], rtol=0, atol=atol)
+    torch.testing.assert_close(encoded["state"], reference["state"], rtol=0, atol=atol)
+    torch.testing.assert_close(cached["audio_embeds"][1, :10], encoded["audio_embeds"][0, :10])
+    cache.close()
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+librosa = pytest.importorskip("librosa")
+pytest.importorskip("kaldiio")
+pytest.importorskip("pypeln")
+from data import extract_feature
+
+
+SAMPLE_RATE = 44100
+PARAMS = [
+    # defaults of `extract_feature.py lms`
+    dict(n_fft=2048, hop_length=1024, win_length=2048, n_mels=128, fmin=0, fmax=8000, htk=False),
+    # window shorter than n_fft, htk mel scale
+    dict(n_fft=1024, hop_length=320, win_length=800, n_mels=64, fmin=50, fmax=14000, htk=True),
+]
+# maximum absolute differences from librosa, in dB (power_to_db) and in log mel (lms)
+TOLERANCES = {"numpy": {"db": 1e-4, "lms": 1e-5}, "torch": {"db": 1e-2, "lms": 1e-3}}
+
+
+@pytest.fixture(scope="module")
+def signal():
+    """3 s of two sines and white noise"""
+    rng = np.random.RandomState(0)
+    t = np.arange(3 * SAMPLE_RATE) / SAMPLE_RATE
+    y = 0.5 * np.sin(2 * np.pi * 440 * t) + 0.2 * np.sin(2 * np.pi * 3000 * t) + 0.05 * rng.randn(len(t))
+    return y.astype(np.float32)
+
+
+def librosa_melspectrogram(y, params):
+    return librosa.feature.melspectrogram(
+        y=y, sr=SAMPLE_RATE, n_fft=params["n_fft"], hop_length=params["hop_length"],
+        win_length=params["win_length"], n_mels=params["n_mels"], fmin=params["fmin"],
+        fmax=params["fmax"], htk=params["htk"], pad_mode="reflect")
+
+
+@pytest.mark.parametrize("params", PARAMS)
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+@pytest.mark.parametrize("frame_batch", [4096, 7])
+def test_melspectrogram_matches_librosa(signal, params, backend, frame_batch):
+    reference = librosa_melspectrogram(signal, params)
+    mel_spectrum = extract_feature.melspectrogram(
+        signal, SAMPLE_RATE, backend=backend, frame_batch=frame_batch, **params)
+    assert mel_spectrum.shape == reference.shape
+    np.testing.assert_allclose(librosa.power_to_db(mel_spectrum), librosa.power_to_db(reference),
+                               rtol=0, atol=TOLERANCES[backend]["db"])
+
+
+@pytest.mark.parametrize("params", PARAMS)
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_extractlms_matches_librosa(signal, params, backend):
+    reference = np.log(librosa_melspectrogram(signal, params) + np.spacing(1))
+    lms = extract_feature.extractlms(signal, fs=SAMPLE_RATE, backend=backend, **params)
+    np.testing.assert_allclose(lms, reference, rtol=0, atol=TOLERANCES[backend]["lms"])
@@ -0,0 +1,31 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from utils.ptb_tokenizer import PTBTokenizer, tokenize_caption
+
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+# outputs of pycocoevalcap's Java PTBTokenizer, stored by `utils/ptb_tokenizer.py save_fixture`
+FIXTURES = sorted(FIXTURE_DIR.glob("ptb_*.json"))
+
+
+@pytest.mark.parametrize("fixture_file", FIXTURES, ids=lambda path: path.stem)
+def test_tokenize_caption_matches_java(fixture_file):
+    fixture = json.load(open(fixture_file, "r"))
+    mismatches = [(item["caption"], item["tokens"], tokenize_caption(item["caption"]))
+                  for item in fixture if tokenize_caption(item["caption"]) != item["tokens"]]
+    assert not mismatches, "{} / {} captions differ, e.g. {}".format(
+        len(mismatches), len(fixture), mismatches[:5])
+
+
+def test_tokenizer_keeps_keys_and_order():
+    captions = {
+        "a": [{"caption": "A dog barks, then a man's voice."}, {"caption": "Birds chirp!"}],
+        "b": [{"caption": "Rain (heavy) falls..."}],
+    }
+    assert PTBTokenizer().tokenize(captions) == {
+        "a": ["a dog barks then a man 's voice", "birds chirp"],
+        "b": ["rain -lrb- heavy -rrb- falls"],
+    }
@@ -0,0 +1,130 @@
+import re
+import json
+from functools import lru_cache
+
+import fire
+
+
+# punctuation tokens removed after tokenization, the same list as pycocoevalcap
+# (brackets are lowercased by -lowerCase, so they are not removed there either)
+PUNCTUATIONS = {"''", "'", "``", "`", "-LRB-", "-RRB-", "-LCB-", "-RCB-",
+                ".", "?", "!", ",", ":", "-", "--", "...", ";"}
+
+# abbreviations keeping their final period
+ABBREVIATIONS = {"mr.", "mrs.", "ms.", "dr.", "st.", "mt.", "ft.", "jr.", "sr.", "vs.",
+                 "etc.", "inc.", "ltd.", "co.", "corp.", "no.", "approx."}
+
+_RULES = [(re.compile(pattern), repl) for pattern, repl in [
+    # quotes
+    (r'^"', r" `` "),
+    (r'([ (\[{<])"', r"\1 `` "),
+    (r'"', r" '' "),
+    # brackets
+    (r"\(", r" -lrb- "),
+    (r"\)", r" -rrb- "),
+    (r"\[", r" -lsb- "),
+    (r"\]", r" -rsb- "),
+    (r"\{", r" -lcb- "),
+    (r"\}", r" -rcb- "),
+    # ellipsis and dashes
+    (r"\.\.\.+", r" ... "),
+    (r"(?<!\.)\.\.(?=[^.\s])", r" . . "),
+    (r"--+", r" -- "),
+    (r"(^| )-( |$)", r" - "),
+    # punctuation, commas and colons inside numbers are kept
+    (r";", r" ; "),
+    (r"[?!]+", r" \g<0> "),
+    (r",(?!\d)|(?<!\d),", r" , "),
+    (r":(?!\d)|(?<!\d):", r" : "),
+    (r"\$", r" $ "),
+    (r"%", r" % "),
+    # runs of asterisks are tokens, slashes are only split off when standing alone
+    (r"\*+", r" \g<0> "),
+    # contractions
+    (r"\b(can)(not)\b", r"\1 \2"),
+    (r"\b(gon|wan)(na)\b", r"\1 \2"),
+    (r"\b(got)(ta)\b", r"\1 \2"),
+    (r"\b(lem|gim)(me)\b", r"\1 \2"),
+    (r"([^' ])('s|'m|'d|'ll|'re|'ve|n't)(?=[ .']|$)", r"\1 \2"),
+    (r"([^' ])(?<! 'n)(?<!^'n)'(?= |$)", r"\1 ' "),
+    (r"(^| )'(?=[^ ])(?!(s|m|d|ll|re|ve|n|n')([ .']|$))", r"\1 ` "),
+]]
+
+
+def _split_period(token):
+    if token == "..":
+        return [".", "."]
+    if len(token) > 2 and token.endswith("..") and not token.endswith("..."):
+        # the first period may belong to an abbreviation
+        if token[:-1] in ABBREVIATIONS or re.fullmatch(r"([a-z]\.)+", token[:-1]):
+            return [token[:-1], "."]
+        return [token[:-2], ".", "."]
+    if len(token) > 1 and token.endswith(".") and token not in ABBREVIATIONS and \
+            not re.fullmatch(r"([a-z]\.)+|\.+", token):
+        return [token[:-1], "."]
+    return [token]
+
+
+@lru_cache(maxsize=1 << 18)
+def tokenize_caption(caption: str):
+    """Tokenize a caption like Stanford PTBTokenizer (-preserveLines -lowerCase, as called by
+    pycocoevalcap) and remove punctuation tokens. Results are cached, references are the same in
+    every evaluation."""
+    text = caption.replace("\n", " ").lower()
+    text = text.replace("‘", "'").replace("’", "'").replace("“", '"').replace("”", '"')
+    for pattern, repl in _RULES:
+        text = pattern.sub(repl, text)
+    tokens = []
+    for token in text.split():
+        if re.fullmatch(r"/+", token):
+            tokens.extend(token)
+        else:
+            tokens.extend(_split_period(token))
+    return " ".join(token for token in tokens if token not in PUNCTUATIONS)
+
+
+class PTBTokenizer(object):
+    """In-process replacement of `pycocoevalcap.tokenizer.ptbtokenizer.PTBTokenizer`, which starts
+    a Java process for each call"""
+
+    def tokenize(self, captions_for_image):
+        """
+        Args:
+            captions_for_image: {<key>: [{"caption": ...}, ...]}
+        Return:
+            {<key>: [tokenized caption, ...]}
+        """
+        return {key: [tokenize_caption(item["caption"]) for item in items]
+                for key, items in captions_for_image.items()}
+
+
+def _load_captions(caption_file):
+    captions = {}
+    for audio_item in json.load(open(caption_file, "r"))["audios"]:
+        captions[audio_item["audio_id"]] = [
+            {"caption": caption["caption"]} for caption in audio_item["captions"]]
+    return captions
+
+
+def save_fixture(caption_file: str, fixture_file: str):
+    """Store the Java PTBTokenizer outputs of all captions in `caption_file` as a fixture"""
+    from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer as JavaPTBTokenizer
+    captions = _load_captions(caption_file)
+    tokenized = JavaPTBTokenizer().tokenize(captions)
+    fixture = [{"caption": item["caption"], "tokens": tokens} for key in captions
+               for item, tokens in zip(captions[key], tokenized[key])]
+    json.dump(fixture, open(fixture_file, "w"), indent=4)
+
+
+def check_fixture(fixture_file: str, max_print: int = 20):
+    """Compare the outputs of `tokenize_caption` with a fixture of Java PTBTokenizer outputs"""
+    fixture = json.load(open(fixture_file, "r"))
+    mismatches = [item for item in fixture if tokenize_caption(item["caption"]) != item["tokens"]]
+    for item in mismatches[:max_print]:
+        print("caption: {}\n   java: {}\n python: {}".format(
+            item["caption"], item["tokens"], tokenize_caption(item["caption"])))
+    print("{} / {} captions match".format(len(fixture) - len(mismatches), len(fixture)))
+
+
+if __name__ == "__main__":
+    fire.Fire({"save_fixture": save_fixture, "check_fixture": check_fixture})
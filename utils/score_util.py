@@ -51,6 +51,138 @@ def compute_batch_score(decode_res,
         results[i] = key2score[keys[i]]
     return results 
 
+
+def _count_ngrams(words, n):
+    counts = {}
+    for k in range(1, n + 1):
+        for i in range(len(words) - k + 1):
+            ngram = tuple(words[i: i + k])
+            counts[ngram] = counts.get(ngram, 0) + 1
+    return counts
+
+
+_reward_scorer = None
+
+
+def _init_reward_worker(scorer):
+    global _reward_scorer
+    _reward_scorer = scorer
+
+
+def _score_reward_chunk(args):
+    return _reward_scorer._score(*args)
+
+
+class BatchCiderD(object):
+
+    def __init__(self, key2refs, n=4, sigma=6.0, num_workers=0):
+        """CIDEr-D of word index sequences, e.g. SCST rewards. Document frequencies are computed
+        once over all references in `key2refs` (the training corpus) and reference tf-idf vectors
+        are cached, so a batch is scored without string conversion or tokenization.
+
+        Args:
+            key2refs (Dict): <key> -> [word indices of reference 1, reference 2, ...]
+                (without <start> and <end>)
+            n (int, optional): Defaults to 4. Maximum n-gram length
+            sigma (float, optional): Defaults to 6.0. Standard deviation of the length penalty
+            num_workers (int, optional): Defaults to 0. Processes scoring a batch in parallel
+        """
+        self.n = n
+        self.sigma = sigma
+        key2ref_counts = {
+            key: [_count_ngrams([int(w) for w in ref], n) for ref in refs]
+            for key, refs in key2refs.items()
+        }
+        self.document_frequency = {}
+        for ref_counts in key2ref_counts.values():
+            for ngram in set(ngram for counts in ref_counts for ngram in counts):
+                self.document_frequency[ngram] = self.document_frequency.get(ngram, 0) + 1
+        self.ref_len = np.log(float(len(key2ref_counts)))
+        self.key2ref_vecs = {
+            key: [self._counts2vec(counts) for counts in ref_counts]
+            for key, ref_counts in key2ref_counts.items()
+        }
+        self._pool = None
+        if num_workers > 0:
+            import multiprocessing
+            # workers inherit the reference vectors by fork
+            self._pool = multiprocessing.get_context("fork").Pool(
+                num_workers, initializer=_init_reward_worker, initargs=(self,))
+        self._num_workers = num_workers
+
+    def _counts2vec(self, counts):
+        vec = [{} for _ in range(self.n)]
+        norm = [0.0 for _ in range(self.n)]
+        length = 0
+        for ngram, term_freq in counts.items():
+            df = np.log(max(1.0, self.document_frequency.get(ngram, 0.0)))
+            k = len(ngram) - 1
+            vec[k][ngram] = float(term_freq) * (self.ref_len - df)
+            norm[k] += vec[k][ngram] ** 2
+            if k == 1:
+                length += term_freq
+        norm = [np.sqrt(x) for x in norm]
+        return vec, norm, length
+
+    def _sim(self, hyp, ref):
+        vec_hyp, norm_hyp, length_hyp = hyp
+        vec_ref, norm_ref, length_ref = ref
+        delta = float(length_hyp - length_ref)
+        val = np.zeros(self.n)
+        for k in range(self.n):
+            for ngram, value in vec_hyp[k].items():
+                if ngram in vec_ref[k]:
+                    # clipped by the reference tf-idf
+                    val[k] += min(value, vec_ref[k][ngram]) * vec_ref[k][ngram]
+            if norm_hyp[k] != 0 and norm_ref[k] != 0:
+                val[k] /= norm_hyp[k] * norm_ref[k]
+            val[k] *= np.e ** (-(delta ** 2) / (2 * self.sigma ** 2))
+        return val
+
+    def _score(self, keys, seqs):
+        scores = np.zeros(len(keys))
+        for i, (key, seq) in enumerate(zip(keys, seqs)):
+            hyp = self._counts2vec(_count_ngrams(seq, self.n))
+            refs = self.key2ref_vecs[key]
+            score = np.zeros(self.n)
+            for ref in refs:
+                score += self._sim(hyp, ref)
+            scores[i] = np.mean(score) / len(refs) * 10.0
+        return scores
+
+    def score(self, keys, seqs, end_idx, start_idx=None):
+        """CIDEr-D of each row of `seqs` (word indices, cut at the first `end_idx`) against
+        the references of `keys`
+
+        Args:
+            keys (List): Keys of the references of each sequence, may repeat
+            seqs (np.ndarray or List): Decoded word indices, [N, T] or N sequences of any length
+        Return:
+            scores of the sequences, [N,]
+        """
+        hyps = []
+        for seq in seqs:
+            words = []
+            for w_t in seq:
+                w_t = int(w_t)
+                if w_t == end_idx:
+                    break
+                if w_t != start_idx:
+                    words.append(w_t)
+            hyps.append(words)
+        if self._pool is None or len(hyps) < 2 * self._num_workers:
+            return self._score(keys, hyps)
+        chunk_size = (len(hyps) + self._num_workers - 1) // self._num_workers
+        chunks = [(keys[i: i + chunk_size], hyps[i: i + chunk_size])
+                  for i in range(0, len(hyps), chunk_size)]
+        return np.concatenate(self._pool.map(_score_reward_chunk, chunks))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
 # def compute_batch_score(decode_res,
                         # refs,
                         # keys,
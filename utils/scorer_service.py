@@ -0,0 +1,141 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+
+
+_meteor = None
+_meteor_lock = threading.Lock()
+
+
+def get_meteor():
+    """The METEOR scorer of this process, its Java process is started once and every
+    `compute_score` call pipes a batch through it"""
+    global _meteor
+    with _meteor_lock:
+        if _meteor is None:
+            from pycocoevalcap.meteor.meteor import Meteor
+            _meteor = Meteor()
+    return _meteor
+
+
+def _float_convert(obj):
+    try:
+        return float(obj)
+    except:
+        return np.nan
+
+
+class CachedSpice(object):
+
+    def __init__(self, cache_dir=None):
+        """SPICE (same results as `pycocoevalcap.spice.spice.Spice`) with two caches on disk:
+        scores of each (hypothesis, references) item, addressed by the hash of its content, and the
+        scene graphs of parsed captions (the `-cache` of SPICE). Items scored before are not passed to
+        SPICE again and Java is not started when all items are cached, so repeated evaluations on the
+        same evaluation set only parse new hypotheses.
+
+        Args:
+            cache_dir (str, optional): Defaults to None. Cache directory, `$SPICE_CACHE_DIR` or `~/.cache/spice` if None
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(
+                "SPICE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "spice"))
+        self.cache_dir = cache_dir
+        self.score_dir = os.path.join(cache_dir, "scores")
+        self.scene_graph_dir = os.path.join(cache_dir, "scene_graphs")
+        os.makedirs(self.score_dir, exist_ok=True)
+        os.makedirs(self.scene_graph_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def method(self):
+        return "SPICE"
+
+    @staticmethod
+    def _item_hash(hypothesis, references):
+        content = json.dumps([hypothesis, sorted(references)], ensure_ascii=False)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def _score_path(self, digest):
+        # sharded by the first two characters of the hash
+        return os.path.join(self.score_dir, digest[:2], digest[2:] + ".json")
+
+    def _read_score(self, digest):
+        path = self._score_path(digest)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as reader:
+            return json.load(reader)
+
+    def _write_score(self, digest, score):
+        path = self._score_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as writer:
+            json.dump(score, writer)
+        os.replace(tmp_path, path)
+
+    def _run_spice(self, items):
+        """items: [{"image_id": ..., "test": ..., "refs": [...]}], return SPICE scores of each item"""
+        from pycocoevalcap.spice import spice as spice_module
+        spice_dir = os.path.dirname(os.path.abspath(spice_module.__file__))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, "input.json")
+            out_file = os.path.join(tmp_dir, "output.json")
+            with open(in_file, "w") as writer:
+                json.dump(items, writer, indent=2)
+            spice_cmd = ["java", "-jar", "-Xmx8G", spice_module.SPICE_JAR, in_file,
+                         "-cache", self.scene_graph_dir,
+                         "-out", out_file,
+                         "-subset",
+                         "-silent"]
+            subprocess.check_call(spice_cmd, cwd=spice_dir)
+            with open(out_file, "r") as reader:
+                results = json.load(reader)
+        return {item["image_id"]: item["scores"] for item in results}
+
+    def compute_score(self, gts, res):
+        assert sorted(gts.keys()) == sorted(res.keys())
+        img_ids = list(gts.keys())
+
+        img_id_to_scores = {}
+        digests = {}
+        uncached = []
+        for img_id in img_ids:
+            hypo = res[img_id]
+            ref = gts[img_id]
+            # Sanity check.
+            assert type(hypo) is list
+            assert len(hypo) == 1
+            assert type(ref) is list
+            assert len(ref) >= 1
+            digest = self._item_hash(hypo[0], ref)
+            score = self._read_score(digest)
+            if score is None:
+                digests[img_id] = digest
+                uncached.append({"image_id": img_id, "test": hypo[0], "refs": ref})
+            else:
+                img_id_to_scores[img_id] = score
+        self.hits += len(img_ids) - len(uncached)
+        self.misses += len(uncached)
+
+        if uncached:
+            for img_id, score in self._run_spice(uncached).items():
+                img_id_to_scores[img_id] = score
+                self._write_score(digests[img_id], score)
+
+        spice_scores = []
+        scores = []
+        for img_id in img_ids:
+            spice_scores.append(_float_convert(img_id_to_scores[img_id]["All"]["f"]))
+            score_set = {}
+            for category, score_tuple in img_id_to_scores[img_id].items():
+                score_set[category] = {k: _float_convert(v) for k, v in score_tuple.items()}
+            scores.append(score_set)
+        average_score = np.mean(np.array(spice_scores))
+        return average_score, scores
@@ -2,7 +2,15 @@
 #!/usr/bin/env python3
 import os
 import sys
+import copy
+import time
+import queue
+import random
 import logging
+import resource
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import torch
 import numpy as np
@@ -110,6 +118,16 @@ def criterion_improver(mode):
             best_value = x
             return True
         return False
+
+    def state_dict():
+        return {"best_value": best_value}
+
+    def load_state_dict(state_dict):
+        nonlocal best_value
+        best_value = state_dict["best_value"]
+
+    inner.state_dict = state_dict
+    inner.load_state_dict = load_state_dict
     return inner
 
 
@@ -121,11 +139,17 @@ def log_results(engine,
                 train_metrics=["loss", "accuracy"],
                 val_metrics=["loss", "accuracy"],
                 ):
+    """val_evaluator: run on val_dataloader before logging, only training metrics are logged
+    when it is None (e.g. validation runs in the background)"""
     train_results = engine.state.metrics
-    val_evaluator.run(val_dataloader)
-    val_results = val_evaluator.state.metrics
+    if val_evaluator is not None:
+        val_evaluator.run(val_dataloader)
+        val_results = val_evaluator.state.metrics
+    else:
+        val_metrics = []
     output_str_list = [
-        "Validation Results - Epoch : {:<4}".format(engine.state.epoch)
+        "{} Results - Epoch : {:<4}".format(
+            "Validation" if val_evaluator is not None else "Training", engine.state.epoch)
     ]
     for metric in train_metrics:
         output = train_results[metric]
@@ -153,12 +177,180 @@ def save_model_on_improved(engine,
                            criterion_improved, 
                            metric_key,
                            dump,
-                           save_path):
+                           save_path,
+                           writer=None):
+    """dump: dict to save, or a function returning it (evaluated when saving)
+    writer: AsyncCheckpointWriter to save in the background, saved synchronously by default"""
     if criterion_improved(engine.state.metrics[metric_key]):
-        torch.save(dump, save_path)
+        if callable(dump):
+            dump = dump()
+        if writer is not None:
+            writer.save(dump, save_path)
+        else:
+            torch.save(dump, save_path)
     # torch.save(dump, str(Path(save_path).parent / "model.last.pth"))
 
 
+def clone_to_cpu(obj):
+    """Copies tensors in (nested) dicts, lists and tuples to CPU, e.g. a snapshot of
+    state dicts that are updated in place by later training steps"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, clone_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_to_cpu(value) for value in obj)
+    return obj
+
+
+class AsyncCheckpointWriter(object):
+
+    def __init__(self):
+        """Saves checkpoints in a background thread. `save` only copies the tensors to CPU,
+        the file is written to a temporary path and then renamed, so an interrupted write
+        never replaces the previous checkpoint. At most one checkpoint waits for writing."""
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            obj, save_path = item
+            try:
+                tmp_path = save_path + ".tmp"
+                torch.save(obj, tmp_path)
+                os.replace(tmp_path, save_path)
+            except Exception as e:
+                self._error = e
+
+    def save(self, obj, save_path):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((clone_to_cpu(obj), str(save_path)))
+
+    def close(self):
+        """Waits for pending checkpoints to be written"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class BackgroundValidator(object):
+
+    def __init__(self, model):
+        """Validates snapshots of `model` in a background thread while training goes on.
+        The snapshot is kept in `self.model` until the next `submit`, at most one
+        validation runs at a time."""
+        self.model = copy.deepcopy(model)
+        self.model.requires_grad_(False)
+        self.epoch = None
+        self.states = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+
+    @property
+    def pending(self):
+        return self._future is not None
+
+    def submit(self, model, epoch, validate_fn, states=None):
+        """Copies the weights of `model` and runs `validate_fn(snapshot)` in the background.
+        `states` (e.g. state dicts of the optimizer and scheduler) are copied along with the
+        weights and kept in `self.states`, so the snapshot can be saved with matching states."""
+        assert not self.pending, "result of the last validation is not collected"
+        self.model.load_state_dict(model.state_dict())
+        self.states = copy.deepcopy(states)
+        self.epoch = epoch
+        self._future = self._executor.submit(validate_fn, self.model)
+
+    def result(self):
+        """Waits for the last validation and returns the output of `validate_fn`"""
+        output = self._future.result()
+        self._future = None
+        return output
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def load_checkpoint(path):
+    # training states hold numpy and python objects besides tensors
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError: # torch < 1.13 has no `weights_only`
+        return torch.load(path, map_location="cpu")
+
+
+def get_rng_state():
+    state = {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def get_amp_dtype(amp, device):
+    """amp: False, True (fp16 on GPU, bf16 on CPU), "fp16" or "bf16" """
+    if not amp:
+        return None
+    if amp is True:
+        amp = "fp16" if device.type == "cuda" else "bf16"
+    assert amp in ("fp16", "bf16"), "amp should be one of False, True, fp16, bf16"
+    return torch.float16 if amp == "fp16" else torch.bfloat16
+
+
+def autocast(device, dtype=None):
+    """Mixed precision context (torch >= 1.10), no-op when dtype is None"""
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+class ThroughputMeter(object):
+
+    def __init__(self, device):
+        """Samples per second and peak memory of an epoch"""
+        self.device = device
+        self.num_samples = 0
+        self.start_time = time.time()
+
+    def reset(self, engine=None):
+        self.num_samples = 0
+        self.start_time = time.time()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def update(self, num_samples):
+        self.num_samples += num_samples
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        if self.device.type == "cuda":
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+            memory_str = "peak GPU memory {:.0f} MB".format(peak_memory)
+        else:
+            # peak resident memory of the process (KB on Linux), not reset between epochs
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+            memory_str = "peak RSS {:.0f} MB".format(peak_memory)
+        return "{:.1f} samples/s, {:.1f}s, {}".format(
+            self.num_samples / max(elapsed, 1e-8), elapsed, memory_str)
+
+
 def update_lr(engine, scheduler, metric=None):
     if scheduler.__class__.__name__ == "ReduceLROnPlateau":
         assert metric is not None, "need validation metric for ReduceLROnPlateau"
@@ -168,6 +360,38 @@ def update_lr(engine, scheduler, metric=None):
         scheduler.step()
 
 
+def accumulation_window(engine, grad_accum_steps):
+    """Position of the current iteration in its gradient accumulation window
+
+    The last window of an epoch may be shorter than grad_accum_steps.
+    returns: (is_first, is_last, window_size), the optimizer steps when is_last
+    """
+    epoch_length = engine.state.epoch_length
+    iteration = (engine.state.iteration - 1) % epoch_length
+    window_start = iteration - iteration % grad_accum_steps
+    window_size = min(grad_accum_steps, epoch_length - window_start)
+    return iteration == window_start, iteration == window_start + window_size - 1, window_size
+
+
+def optimizer_steps_per_epoch(num_iter, grad_accum_steps):
+    return (num_iter + grad_accum_steps - 1) // grad_accum_steps
+
+
+def update_lr_on_step(engine, scheduler):
+    """Iteration-level scheduler step, skipped on micro-batches that only accumulate gradients"""
+    if engine.state.output.get("optimizer_step", True):
+        scheduler.step()
+
+
+def set_sampler_epoch(engine, dataloader):
+    """Sets the epoch (0-based) of the (batch) sampler of `dataloader` that shuffles by the epoch, attached
+    to Events.EPOCH_STARTED so that it is set before the loader is iterated (also after resuming)"""
+    for sampler in (dataloader.batch_sampler, dataloader.sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(engine.state.epoch - 1)
+            return
+
+
 def update_ss_ratio(engine, config, num_iter):
     num_epoch = config["epochs"]
     mode = config["ss_args"]["ss_mode"]
@@ -231,6 +455,15 @@ class LabelSmoothingLoss(torch.nn.Module):
         return torch.mean(torch.sum(-true_dist * pred, dim=self.dim))
 
 
+class SoftTargetLoss(torch.nn.Module):
+    """Cross entropy against top-k truncated soft targets, e.g. word distributions of a teacher"""
+
+    def forward(self, logit, target_indices, target_probs):
+        # logit: [N, classes], target_indices / target_probs: [N, k]
+        logprobs = logit.log_softmax(dim=-1).gather(-1, target_indices)
+        return torch.mean(torch.sum(-target_probs * logprobs, dim=-1))
+
+
 def fix_batchnorm(model):
     classname = model.__class__.__name__
     if classname.find("BatchNorm") != -1: